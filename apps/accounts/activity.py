@@ -0,0 +1,63 @@
+from django.db.models import Q
+
+from apps.appointments.models import AppointmentEvent
+
+from .models import ActionLog
+
+
+# Workflow transitions record an AppointmentEvent only; their activity entries
+# are built from it. ActionLog rows with these actions predate that and each
+# has a matching event, so they are skipped.
+WORKFLOW_ACTIONS = {code for code, _label in AppointmentEvent.EVENT_CHOICES}
+
+
+def _filtered(logs, events, *, on_date=None, since=None):
+    if on_date:
+        logs = logs.filter(created_at__date=on_date)
+        events = events.filter(created_at__date=on_date)
+    if since:
+        logs = logs.filter(created_at__gte=since)
+        events = events.filter(created_at__gte=since)
+    return logs, events
+
+
+def _sources():
+    logs = ActionLog.objects.select_related("user").exclude(action__in=WORKFLOW_ACTIONS)
+    events = AppointmentEvent.objects.select_related(
+        "performed_by", "appointment__patient", "room"
+    )
+    return logs, events
+
+
+def recent_activity(*, action="", on_date=None, since=None, search="", limit=50):
+    """The newest ``limit`` activity entries, as ActionLog instances.
+
+    Entries derived from workflow events are unsaved and have no id. A search
+    matches event entries on patient, room or username rather than on their
+    description text.
+    """
+    logs, events = _filtered(*_sources(), on_date=on_date, since=since)
+    if action in WORKFLOW_ACTIONS:
+        logs, events = logs.none(), events.filter(event_type=action)
+    elif action:
+        logs, events = logs.filter(action=action), events.none()
+
+    if search:
+        logs = logs.filter(
+            Q(description__icontains=search) | Q(user__username__icontains=search)
+        )
+        events = events.filter(
+            Q(appointment__patient__full_name__icontains=search)
+            | Q(performed_by__username__icontains=search)
+            | Q(room__name__icontains=search)
+        )
+
+    entries = list(logs[:limit])
+    entries.extend(event.as_action_log() for event in events[:limit])
+    entries.sort(key=lambda entry: entry.created_at, reverse=True)
+    return entries[:limit]
+
+
+def activity_count(*, on_date=None, since=None):
+    logs, events = _filtered(*_sources(), on_date=on_date, since=since)
+    return logs.count() + events.count()
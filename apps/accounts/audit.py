@@ -0,0 +1,117 @@
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .models import ActionLog
+
+
+logger = logging.getLogger(__name__)
+
+
+class ActionLogWriter(threading.Thread):
+    """Writes buffered ActionLog rows with one ``bulk_create`` per flush.
+
+    It flushes once ACTION_LOG_BATCH_SIZE rows are waiting, every
+    ACTION_LOG_FLUSH_SECONDS otherwise, and when the process exits.
+    """
+
+    def __init__(self):
+        super().__init__(name="action-log-writer", daemon=True)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def add(self, entry):
+        with self.lock:
+            self.pending.append(entry)
+            full = len(self.pending) >= settings.ACTION_LOG_BATCH_SIZE
+        if full:
+            self.wakeup.set()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(settings.ACTION_LOG_FLUSH_SECONDS)
+            self.wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Write the waiting rows and return how many were written.
+
+        Rows that fail to write are kept for the next flush, up to
+        ACTION_LOG_MAX_PENDING; beyond that the oldest are dropped.
+        """
+        with self.lock:
+            entries, self.pending = self.pending, []
+        if not entries:
+            return 0
+
+        try:
+            ActionLog.objects.bulk_create(
+                entries, batch_size=settings.ACTION_LOG_BATCH_SIZE
+            )
+        except Exception:
+            logger.exception("Writing %s action log entries failed.", len(entries))
+            with self.lock:
+                self.pending[:0] = entries
+                overflow = len(self.pending) - settings.ACTION_LOG_MAX_PENDING
+                if overflow > 0:
+                    del self.pending[:overflow]
+                    logger.error("Dropped %s unwritten action log entries.", overflow)
+            return 0
+        return len(entries)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def buffer_action_log(entry):
+    """Queue an unsaved ActionLog for the writer thread, starting it if needed."""
+    global _writer
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = ActionLogWriter()
+            _writer.start()
+    _writer.add(entry)
+
+
+def flush_action_logs():
+    """Write every buffered entry now; returns how many were written."""
+    if _writer is None:
+        return 0
+    return _writer.flush()
+
+
+atexit.register(flush_action_logs)
+
+
+_local = threading.local()
+
+
+@contextmanager
+def synchronous_action_logs():
+    """Save entries logged in this thread inside the block before returning.
+
+    For commands that write many entries in one go, where the writer thread
+    would only compete with them for the database. Also usable as a decorator.
+    """
+    previous = getattr(_local, "sync", False)
+    _local.sync = True
+    try:
+        yield
+    finally:
+        _local.sync = previous
+
+
+def writes_synchronously():
+    """Whether ``log_action`` saves entries before returning in this thread."""
+    return settings.ACTION_LOG_WRITE == "sync" or getattr(_local, "sync", False)
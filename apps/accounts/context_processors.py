@@ -13,11 +13,9 @@ def role_navigation(request):
     nav_rooms = []
 
     if role in {"admin", "nurse"}:
-        from apps.appointments.models import CareRoom
+        from apps.appointments.rooms import active_rooms
 
-        nav_rooms = list(
-            CareRoom.objects.filter(is_active=True).order_by("sort_order", "name")[:5]
-        )
+        nav_rooms = active_rooms()[:5]
 
     return {
         "user_role": role,
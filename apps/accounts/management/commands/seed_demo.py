@@ -6,10 +6,12 @@ from django.core.management.base import BaseCommand
 from django.core.management import call_command
 from django.utils import timezone
 
+from apps.accounts.audit import synchronous_action_logs
 from apps.accounts.models import UserProfile
 from apps.accounts.utils import log_action
 from apps.appointments.models import Appointment, CareRoom
 from apps.appointments import workflow as appointment_workflow
+from apps.appointments.capacity import rebuild_doctor_capacity
 from apps.appointments.workflow import transition_appointment
 from apps.patients.models import Patient
 
@@ -421,6 +423,9 @@ class Command(BaseCommand):
             self.style.SUCCESS(f"Created {count} appointments ({summary})")
         )
 
+    # Seeding writes hundreds of logs; the buffered writer would only compete
+    # with it for the database.
+    @synchronous_action_logs()
     def handle(self, *args, **options):
         rng = random.Random(options["seed"])
 
@@ -482,6 +487,8 @@ class Command(BaseCommand):
             )
         finally:
             appointment_workflow.broadcast_workflow_event = original_broadcast
+        # Seeding skips the capacity rule, so point the ledger at one real session.
+        rebuild_doctor_capacity()
 
         self.stdout.write(self.style.SUCCESS("Comprehensive demo data is ready."))
 
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 
 class ActionLog(models.Model):
@@ -37,7 +38,8 @@ class ActionLog(models.Model):
         max_length=255, blank=True
     )  # Human-readable description
     ip_address = models.GenericIPAddressField(null=True, blank=True)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the action happens, not when a buffered write reaches the table.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         ordering = ["-created_at"]
@@ -1,24 +1,75 @@
 from functools import wraps
 
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.shortcuts import redirect
 from django.urls import reverse
 
 from .models import UserProfile
 
 
+ROLE_CACHE_KEY = "accounts:role:{user_id}"
+ACTIVE_CACHE_KEY = "accounts:active:{user_id}"
+# Remembered on the user instance, so one request resolves its role once.
+ROLE_MEMO_ATTR = "_clinic_role"
+
+
 def get_user_role(user):
+    """Return the user's role, or ``""`` when they have none.
+
+    The profile's role is memoized on the user instance and cached per user id
+    for ``ROLE_CACHE_SECONDS``; saving or deleting the user or their profile
+    drops the cache entry (see ``signals``).
+    """
     if not user or not user.is_authenticated:
         return ""
     if user.is_superuser:
         return "admin"
 
-    try:
-        return user.profile.role
-    except UserProfile.DoesNotExist:
-        if user.is_staff:
-            return "receptionist"
-        return ""
+    role = getattr(user, ROLE_MEMO_ATTR, None)
+    if role is None:
+        role = _profile_role(user)
+        setattr(user, ROLE_MEMO_ATTR, role)
+    if role:
+        return role
+    if user.is_staff:
+        return "receptionist"
+    return ""
+
+
+def _profile_role(user):
+    """The role on the user's profile, or ``""`` when they have no profile."""
+    key = ROLE_CACHE_KEY.format(user_id=user.pk)
+    role = cache.get(key)
+    if role is None:
+        try:
+            role = user.profile.role
+        except UserProfile.DoesNotExist:
+            role = ""
+        cache.set(key, role, settings.ROLE_CACHE_SECONDS)
+    return role
+
+
+def user_is_active(user_id):
+    """Whether ``user_id`` is an existing, active account; cached like roles."""
+    key = ACTIVE_CACHE_KEY.format(user_id=user_id)
+    active = cache.get(key)
+    if active is None:
+        active = get_user_model().objects.filter(pk=user_id, is_active=True).exists()
+        cache.set(key, active, settings.ROLE_CACHE_SECONDS)
+    return active
+
+
+def forget_user_role(user_id):
+    """Drop the cached role and active flag of ``user_id``."""
+    cache.delete_many(
+        [
+            ROLE_CACHE_KEY.format(user_id=user_id),
+            ACTIVE_CACHE_KEY.format(user_id=user_id),
+        ]
+    )
 
 
 def role_home_url(user):
@@ -29,15 +80,13 @@ def role_home_url(user):
     if role == "doctor":
         return reverse("appointments:doctor_feed")
     if role == "nurse":
-        from apps.appointments.models import CareRoom
-
-        room = (
-            CareRoom.objects.filter(is_active=True)
-            .order_by("sort_order", "name")
-            .first()
-        )
-        if room:
-            return reverse("appointments:room_feed", kwargs={"room_code": room.code})
+        from apps.appointments.rooms import active_rooms
+
+        rooms = active_rooms()
+        if rooms:
+            return reverse(
+                "appointments:room_feed", kwargs={"room_code": rooms[0].code}
+            )
         return reverse("accounts:profile")
 
     if user and user.is_authenticated:
@@ -0,0 +1,30 @@
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import UserProfile
+from .permissions import ROLE_MEMO_ATTR, forget_user_role
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def forget_profile_role(sender, instance, **kwargs):
+    _forget_role(instance.user_id)
+    if UserProfile.user.is_cached(instance):
+        instance.user.__dict__.pop(ROLE_MEMO_ATTR, None)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def forget_account_role(sender, instance, **kwargs):
+    _forget_role(instance.pk)
+
+
+def _forget_role(user_id):
+    # Dropped now for the writer's own requests, and again on commit, since a
+    # request caching the role in between would keep the one from before.
+    forget_user_role(user_id)
+    transaction.on_commit(partial(forget_user_role, user_id))
@@ -1,9 +1,19 @@
+from unittest import mock
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from apps.accounts.models import UserProfile
-from apps.appointments.models import CareRoom
+from apps.accounts import audit
+from apps.accounts.models import ActionLog, UserProfile
+from apps.accounts.permissions import ROLE_CACHE_KEY, get_user_role
+from apps.accounts.utils import log_action
+from apps.appointments.models import Appointment, CareRoom
+from apps.appointments.workflow import transition_appointment
+from apps.patients.models import Patient
 
 
 class RoleAccessTests(TestCase):
@@ -93,3 +103,147 @@ class RoleAccessTests(TestCase):
             response,
             reverse("appointments:room_feed", kwargs={"room_code": self.room.code}),
         )
+
+
+class RoleCacheTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user("staff", password="pass1234")
+        self.profile = UserProfile.objects.create(user=self.user, role="doctor")
+
+    def _fresh_user(self):
+        return get_user_model().objects.get(pk=self.user.pk)
+
+    def test_role_is_cached_across_requests(self):
+        self.assertEqual(get_user_role(self._fresh_user()), "doctor")
+
+        user = self._fresh_user()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_role(user), "doctor")
+
+    def test_saving_the_profile_drops_the_cached_role(self):
+        get_user_role(self._fresh_user())
+
+        self.profile.role = "nurse"
+        self.profile.save()
+
+        self.assertEqual(get_user_role(self._fresh_user()), "nurse")
+
+    def test_role_cached_before_the_commit_is_dropped_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.profile.role = "nurse"
+            self.profile.save()
+            cache.set(ROLE_CACHE_KEY.format(user_id=self.user.pk), "doctor")
+
+        self.assertEqual(get_user_role(self._fresh_user()), "nurse")
+
+    def test_feed_render_does_not_query_the_profile(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("appointments:doctor_feed"))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("appointments:doctor_feed"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            any("accounts_userprofile" in query["sql"] for query in queries)
+        )
+
+
+@override_settings(ACTION_LOG_WRITE="buffered", ACTION_LOG_BATCH_SIZE=2)
+class ActionLogWriterTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("staff", password="pass1234")
+        # An unstarted writer, so only the test decides when to flush.
+        self.writer = audit.ActionLogWriter()
+        patcher = mock.patch.object(audit, "_writer", self.writer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_entries_are_written_in_one_batch_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = log_action(self.user, action="login", description="first")
+            log_action(self.user, action="logout", description="second")
+
+        self.assertIsNone(first.pk)
+        self.assertFalse(ActionLog.objects.exists())
+        self.assertTrue(self.writer.wakeup.is_set())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(audit.flush_action_logs(), 2)
+        self.assertEqual(
+            list(ActionLog.objects.order_by("id").values_list("action", flat=True)),
+            ["login", "logout"],
+        )
+
+    def test_rolled_back_actions_are_not_logged(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            log_action(self.user, action="login")
+
+        self.assertEqual(self.writer.pending, [])
+
+    def test_sync_mode_saves_before_returning(self):
+        entry = log_action(self.user, action="login", sync=True)
+
+        self.assertIsNotNone(entry.pk)
+        self.assertEqual(self.writer.pending, [])
+
+    def test_synchronous_block_saves_before_returning(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with audit.synchronous_action_logs():
+                inside = log_action(self.user, action="login")
+            outside = log_action(self.user, action="logout")
+
+        self.assertIsNotNone(inside.pk)
+        self.assertIsNone(outside.pk)
+        self.assertEqual(self.writer.pending, [outside])
+
+
+class ActivityFeedTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.admin = User.objects.create_superuser(
+            "admin", email="admin@example.com", password="pass1234"
+        )
+        self.receptionist = User.objects.create_user("reception", password="pass1234")
+        UserProfile.objects.create(user=self.receptionist, role="receptionist")
+        self.appointment = Appointment.objects.create(
+            patient=Patient.objects.create(
+                full_name="Audit Patient", phone="+251900000001", sex="F"
+            ),
+            status=Appointment.STATUS_PLANNED,
+        )
+        log_action(self.receptionist, action="created_patient", sync=True)
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="check_in",
+            user=self.receptionist,
+        )
+        self.client.force_login(self.admin)
+
+    def test_transitions_write_no_action_log_row(self):
+        self.assertEqual(
+            list(ActionLog.objects.values_list("action", flat=True)),
+            ["created_patient"],
+        )
+
+    def test_api_logs_include_workflow_events(self):
+        response = self.client.get(reverse("api-logs"))
+
+        entries = {entry["action"]: entry for entry in response.json()}
+        self.assertEqual(set(entries), {"created_patient", "checked_in"})
+        self.assertEqual(entries["checked_in"]["user"], "reception")
+        self.assertEqual(entries["checked_in"]["target_id"], self.appointment.id)
+        self.assertEqual(
+            entries["checked_in"]["description"], "Checked in patient: Audit Patient"
+        )
+
+    def test_activity_page_filters_workflow_entries(self):
+        response = self.client.get(
+            reverse("activity"), {"action": "checked_in", "q": "audit"}
+        )
+
+        self.assertEqual(
+            [log.action for log in response.context["logs"]], ["checked_in"]
+        )
+        self.assertEqual(response.context["stats"]["total_count"], 2)
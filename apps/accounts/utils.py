@@ -1,3 +1,8 @@
+from functools import partial
+
+from django.db import transaction
+
+from .audit import buffer_action_log, writes_synchronously
 from .models import ActionLog
 
 
@@ -9,9 +14,14 @@ def get_client_ip(request):
     return request.META.get('REMOTE_ADDR')
 
 
-def log_action(request_or_user, action, target_type="", target_id=None, description=""):
+def log_action(request_or_user, action, target_type="", target_id=None, description="", sync=False):
     """
-    Create an ActionLog entry.
+    Record an ActionLog entry.
+    
+    Unless ``sync`` is set, ACTION_LOG_WRITE is "sync" or the call runs inside
+    ``synchronous_action_logs()``, the entry is handed to the buffered writer
+    once the current transaction commits, and saved with others in one insert
+    shortly after.
     
     Args:
         request_or_user: Either an HttpRequest object or a User object
@@ -19,28 +29,37 @@ def log_action(request_or_user, action, target_type="", target_id=None, descript
         target_type: String e.g. "patient", "appointment" (optional)
         target_id: Integer ID of the target object (optional)
         description: Human-readable description of the action (optional)
+        sync: Save the entry before returning, for callers that need its id
     
     Returns:
-        The created ActionLog instance
+        The ActionLog instance; it has no id yet when buffered
     """
-    # Handle both request and user being passed
-    if hasattr(request_or_user, 'user'):
-        # It's a request object
-        user = request_or_user.user if request_or_user.user.is_authenticated else None
-        ip_address = get_client_ip(request_or_user)
-    else:
-        # It's a user object
-        user = request_or_user if request_or_user and hasattr(request_or_user, 'is_authenticated') and request_or_user.is_authenticated else None
-        ip_address = None
-    
-    return ActionLog.objects.create(
+    user, ip_address = _log_actor(request_or_user)
+    entry = ActionLog(
         user=user,
         action=action,
         target_type=target_type,
         target_id=target_id,
         description=description,
-        ip_address=ip_address
+        ip_address=ip_address,
     )
+    if sync or writes_synchronously():
+        entry.save()
+    else:
+        transaction.on_commit(partial(buffer_action_log, entry))
+    return entry
+
+
+def _log_actor(request_or_user):
+    """Return the (user, ip_address) an ActionLog entry is attributed to."""
+    # Handle both request and user being passed
+    if hasattr(request_or_user, 'user'):
+        # It's a request object
+        user = request_or_user.user if request_or_user.user.is_authenticated else None
+        return user, get_client_ip(request_or_user)
+    # It's a user object
+    user = request_or_user if request_or_user and hasattr(request_or_user, 'is_authenticated') and request_or_user.is_authenticated else None
+    return user, None
 
 
 def log_patient_action(request, action, patient, description=""):
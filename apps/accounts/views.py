@@ -4,10 +4,10 @@ from django.contrib.auth.views import LoginView
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth import get_user_model
 from django.contrib import messages
-from django.db.models import Q
 from django.utils import timezone
 from django.http import JsonResponse
 from datetime import timedelta
+from .activity import activity_count, recent_activity
 from .models import ActionLog, UserProfile
 from .utils import log_action
 from .permissions import role_home_url, role_required
@@ -61,46 +61,35 @@ def home_redirect(request):
 @role_required("admin")
 def activity(request):
     """Display activity logs with filtering and pagination."""
-    logs = ActionLog.objects.select_related("user")
-
-    # Filter by action type
     action_filter = request.GET.get("action", "")
-    if action_filter:
-        logs = logs.filter(action=action_filter)
 
     # Filter by date range
     date_filter = request.GET.get("date", "")
+    on_date = since = None
     if date_filter == "today":
-        logs = logs.filter(created_at__date=timezone.localdate())
+        on_date = timezone.localdate()
     elif date_filter == "week":
-        week_ago = timezone.now() - timedelta(days=7)
-        logs = logs.filter(created_at__gte=week_ago)
+        since = timezone.now() - timedelta(days=7)
     elif date_filter == "month":
-        month_ago = timezone.now() - timedelta(days=30)
-        logs = logs.filter(created_at__gte=month_ago)
+        since = timezone.now() - timedelta(days=30)
 
     # Search by description or username
     search = request.GET.get("q", "").strip()
-    if search:
-        logs = logs.filter(
-            Q(description__icontains=search) | Q(user__username__icontains=search)
-        )
 
     # TODO: Add pagination later
     # For now, limit to 50 most recent logs
-    logs = logs[:50]
+    logs = recent_activity(
+        action=action_filter, on_date=on_date, since=since, search=search, limit=50
+    )
 
     # Get action choices for filter dropdown
     action_choices = ActionLog.ACTION_CHOICES
 
     # Activity stats for the header
-    today = timezone.localdate()
     stats = {
-        "today_count": ActionLog.objects.filter(created_at__date=today).count(),
-        "week_count": ActionLog.objects.filter(
-            created_at__gte=timezone.now() - timedelta(days=7)
-        ).count(),
-        "total_count": ActionLog.objects.count(),
+        "today_count": activity_count(on_date=timezone.localdate()),
+        "week_count": activity_count(since=timezone.now() - timedelta(days=7)),
+        "total_count": activity_count(),
     }
 
     return render(
@@ -120,7 +109,7 @@ def activity(request):
 @login_required
 @role_required("admin")
 def api_logs(request):
-    logs = ActionLog.objects.select_related("user")[:50]
+    logs = recent_activity(limit=50)
     payload = [
         {
             "id": log.id,
@@ -1,5 +1,11 @@
 from django.contrib import admin
-from .models import Appointment, CareRoom, AppointmentEvent
+from .models import (
+    Appointment,
+    AppointmentEvent,
+    CareRoom,
+    DoctorCapacity,
+    WorkflowOutbox,
+)
 
 
 @admin.register(Appointment)
@@ -11,9 +17,10 @@ class AppointmentAdmin(admin.ModelAdmin):
         "reason",
         "status",
         "assigned_room",
+        "doctor",
         "created_at",
     )
-    list_filter = ("status", "assigned_room")
+    list_filter = ("status", "assigned_room", "doctor")
     search_fields = ("patient__full_name", "status", "reason", "assigned_room__name")
 
 
@@ -50,3 +57,29 @@ class AppointmentEventAdmin(admin.ModelAdmin):
 
     def has_add_permission(self, request):
         return False
+
+
+@admin.register(WorkflowOutbox)
+class WorkflowOutboxAdmin(admin.ModelAdmin):
+    list_display = ("id", "created_at", "delivered_at", "attempts", "last_error")
+    list_filter = ("delivered_at",)
+    readonly_fields = (
+        "groups",
+        "payload",
+        "attempts",
+        "last_error",
+        "created_at",
+        "delivered_at",
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(DoctorCapacity)
+class DoctorCapacityAdmin(admin.ModelAdmin):
+    list_display = ("doctor", "active_appointment", "updated_at")
+    readonly_fields = ("doctor", "active_appointment", "updated_at")
+
+    def has_add_permission(self, request):
+        return False
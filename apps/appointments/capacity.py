@@ -0,0 +1,176 @@
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db.models import Count
+from django.utils import timezone
+
+from .models import Appointment, DoctorCapacity
+
+
+def _occupies(appointment):
+    """Whether a ledger's appointment still keeps its doctor busy today.
+
+    Rows changed outside the workflow (admin edits, yesterday's forgotten
+    session) stop counting on their own instead of blocking the queue.
+    """
+    return (
+        appointment is not None
+        and appointment.status == Appointment.STATUS_WITH_DOCTOR
+        and timezone.localdate(appointment.scheduled_at) == timezone.localdate()
+    )
+
+
+def on_shift_doctor_ids():
+    """Ids of the active staff with the doctor role, lowest first."""
+    return list(
+        get_user_model()
+        .objects.filter(
+            is_active=True,
+            profile__role="doctor",
+            profile__is_active_staff=True,
+        )
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def doctor_capacities(doctor_ids, *, lock=False):
+    """Return the capacity rows of ``doctor_ids`` in doctor id order, creating
+    any that are missing.
+
+    With ``lock``, call inside ``transaction.atomic`` and after locking the
+    appointment, so every transition takes its locks in the same order.
+    """
+    doctor_ids = sorted(set(doctor_ids))
+    queryset = DoctorCapacity.objects.all()
+    if lock:
+        # Only the ledger rows: PostgreSQL cannot lock the nullable side of the
+        # outer join to the active appointment.
+        queryset = queryset.select_for_update(of=("self",))
+    queryset = (
+        queryset.select_related("active_appointment")
+        .filter(doctor_id__in=doctor_ids)
+        .order_by("doctor_id")
+    )
+    capacities = list(queryset)
+    if len(capacities) < len(doctor_ids):
+        for doctor_id in doctor_ids:
+            DoctorCapacity.objects.get_or_create(doctor_id=doctor_id)
+        capacities = list(queryset.all())
+    return capacities
+
+
+def lock_doctor_capacities(doctor_ids):
+    return doctor_capacities(doctor_ids, lock=True)
+
+
+def lock_doctor_capacity(doctor_id):
+    return lock_doctor_capacities([doctor_id])[0]
+
+
+def doctor_is_busy(capacity=None, *, doctor_id=None, exclude_appointment_id=None):
+    """Read a doctor's ledger, unlocked unless a locked ``capacity`` is passed."""
+    if capacity is None:
+        capacity = (
+            DoctorCapacity.objects.select_related("active_appointment")
+            .filter(doctor_id=doctor_id)
+            .first()
+        )
+    if capacity is None or capacity.active_appointment_id == exclude_appointment_id:
+        return False
+    return _occupies(capacity.active_appointment)
+
+
+def all_doctors_busy():
+    """Whether check-ins are paused: every doctor on shift is with a patient."""
+    doctor_ids = on_shift_doctor_ids()
+    if not doctor_ids:
+        return False
+    capacities = DoctorCapacity.objects.select_related("active_appointment").filter(
+        doctor_id__in=doctor_ids
+    )
+    busy = sum(1 for capacity in capacities if _occupies(capacity.active_appointment))
+    return busy == len(doctor_ids)
+
+
+def _waiting_counts(doctor_ids):
+    rows = (
+        Appointment.objects.filter(
+            doctor_id__in=doctor_ids,
+            status=Appointment.STATUS_WAITING_DOCTOR,
+            scheduled_at__date=timezone.localdate(),
+        )
+        .values("doctor_id")
+        .annotate(waiting=Count("id"))
+    )
+    return {row["doctor_id"]: row["waiting"] for row in rows}
+
+
+def route_check_in(*, enforce_capacity=True, lock=True):
+    """Pick the doctor for a new check-in, or ``None`` when no doctor is on shift.
+
+    The shortest waiting queue wins; ties go to a free doctor, then to the one
+    whose ledger changed longest ago (free the longest, or in session the
+    longest). With ``enforce_capacity`` a check-in needs a free doctor.
+    """
+    return route_check_ins(1, enforce_capacity=enforce_capacity, lock=lock)[0]
+
+
+def route_check_ins(count, *, enforce_capacity=True, lock=True):
+    """Pick doctors for ``count`` check-ins in a row, as ``route_check_in`` would.
+
+    Each pick joins its doctor's waiting queue before the next one is made.
+    Without ``lock`` the capacity rows are read unlocked, so a concurrent
+    accept may leave a pick slightly out of date.
+    """
+    doctor_ids = on_shift_doctor_ids()
+    if not doctor_ids:
+        return [None] * count
+
+    capacities = doctor_capacities(doctor_ids, lock=lock)
+    busy = {
+        capacity.doctor_id: _occupies(capacity.active_appointment)
+        for capacity in capacities
+    }
+    if enforce_capacity:
+        capacities = [
+            capacity for capacity in capacities if not busy[capacity.doctor_id]
+        ]
+        if not capacities:
+            raise ValidationError(
+                "Every doctor is currently with a patient. Please wait until a session is finished."
+            )
+
+    waiting = _waiting_counts(doctor_ids)
+    picks = []
+    for _index in range(count):
+        chosen = min(
+            capacities,
+            key=lambda capacity: (
+                waiting.get(capacity.doctor_id, 0),
+                busy[capacity.doctor_id],
+                capacity.updated_at,
+                capacity.doctor_id,
+            ),
+        )
+        waiting[chosen.doctor_id] = waiting.get(chosen.doctor_id, 0) + 1
+        picks.append(chosen.doctor_id)
+    return picks
+
+
+def rebuild_doctor_capacity():
+    """Point each doctor's ledger at their latest patient in session today."""
+    active = {}
+    for appointment in Appointment.objects.filter(
+        status=Appointment.STATUS_WITH_DOCTOR,
+        scheduled_at__date=timezone.localdate(),
+        doctor__isnull=False,
+    ).order_by("id"):
+        active[appointment.doctor_id] = appointment
+
+    DoctorCapacity.objects.exclude(doctor_id__in=active).update(
+        active_appointment=None
+    )
+    for doctor_id, appointment in active.items():
+        DoctorCapacity.objects.update_or_create(
+            doctor_id=doctor_id, defaults={"active_appointment": appointment}
+        )
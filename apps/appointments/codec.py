@@ -0,0 +1,99 @@
+import json
+from datetime import datetime
+
+from .models import Appointment
+from .rooms import all_rooms
+
+
+JSON_SUBPROTOCOL = "clinicflow.json.v1"
+COMPACT_SUBPROTOCOL = "clinicflow.compact.v1"
+
+WIRE_JSON = "json"
+WIRE_COMPACT = "compact"
+
+STATUS_CODES = [code for code, _label in Appointment.STATUS_CHOICES]
+WIRE_ACTIONS = [
+    "created_appointment",
+    "check_in",
+    "doctor_accept",
+    "transfer_to_room",
+    "room_accept",
+    "room_transfer",
+    "complete",
+]
+
+_STATUS_INDEX = {code: index for index, code in enumerate(STATUS_CODES)}
+_ACTION_INDEX = {action: index for index, action in enumerate(WIRE_ACTIONS)}
+
+
+def _epoch_ms(timestamp):
+    if not timestamp:
+        return None
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def compact_row(payload):
+    """Positional form of a workflow payload; labels come from the hello frame.
+
+    Order: seq, appointment_id, patient_id, patient_name, action, status,
+    scheduled_time, reason, room_id, actor, timestamp (epoch ms),
+    queue_position, eta_minutes, queue_updates.
+    """
+    action = payload.get("action")
+    status = payload.get("status")
+    return [
+        payload.get("seq"),
+        payload.get("appointment_id"),
+        payload.get("patient_id"),
+        payload.get("patient_name"),
+        _ACTION_INDEX.get(action, action),
+        _STATUS_INDEX.get(status, status),
+        payload.get("scheduled_time"),
+        payload.get("reason"),
+        payload.get("room_id"),
+        payload.get("actor"),
+        _epoch_ms(payload.get("timestamp")),
+        payload.get("queue_position"),
+        payload.get("eta_minutes"),
+        payload.get("queue_updates") or [],
+    ]
+
+
+def encode(payload, wire):
+    if wire == WIRE_COMPACT:
+        return json.dumps(compact_row(payload), separators=(",", ":"))
+    return json.dumps(payload)
+
+
+def encode_frames(payload):
+    """Encode ``payload`` once for every wire format a socket can negotiate."""
+    return {wire: encode(payload, wire) for wire in (WIRE_JSON, WIRE_COMPACT)}
+
+
+def join_frames(frames):
+    """Combine pre-encoded event frames into one batch frame without re-encoding."""
+    return "[" + ",".join(frames) + "]"
+
+
+def snapshot_frame(seq, payloads, wire):
+    if wire == WIRE_COMPACT:
+        rows = [compact_row(payload) for payload in payloads]
+    else:
+        rows = payloads
+    return json.dumps(
+        {"type": "snapshot", "seq": seq, "rows": rows}, separators=(",", ":")
+    )
+
+
+def hello_frame():
+    """Label dictionaries a compact client needs to expand positional rows."""
+    rooms = {str(room.id): [room.code, room.name] for room in all_rooms()}
+    return json.dumps(
+        {
+            "type": "hello",
+            "statuses": [list(choice) for choice in Appointment.STATUS_CHOICES],
+            "actions": WIRE_ACTIONS,
+            "rooms": rooms,
+        },
+        separators=(",", ":"),
+    )
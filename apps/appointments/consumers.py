@@ -1,21 +1,494 @@
+import asyncio
 import json
+import logging
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
 
+from asgiref.sync import sync_to_async
+from channels.db import DatabaseSyncToAsync, database_sync_to_async
+from channels.exceptions import ChannelFull
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import PermissionDenied, ValidationError
 
-from .realtime import WORKFLOW_GROUP
+from apps.accounts.permissions import get_user_role
+
+from .codec import (
+    COMPACT_SUBPROTOCOL,
+    JSON_SUBPROTOCOL,
+    WIRE_COMPACT,
+    WIRE_JSON,
+    encode,
+    hello_frame,
+    join_frames,
+    snapshot_frame,
+)
+from .metrics import (
+    COALESCED,
+    RESYNC_LAG,
+    RESYNC_QUEUE,
+    SENT,
+    STAGE_FANOUT,
+    STAGE_RENDER,
+    increment,
+    now_ms,
+    observe,
+)
+from .models import Appointment
+from .presence import (
+    PRESENCE_GROUP,
+    counts_diff,
+    current_counts,
+    heartbeat,
+    leave,
+    presence_board,
+    presence_entry,
+    presence_frame,
+    sweep_if_due,
+)
+from .realtime import (
+    CONTROL_GROUP,
+    TOPIC_ROLES,
+    TOPIC_ROOM,
+    catch_up,
+    join_topic,
+    remember_serving_loop,
+)
+from .tokens import connect_token
+from .workflow import ACTION_RULES, transition_appointment
+
+
+logger = logging.getLogger(__name__)
+
+CLOSE_FORBIDDEN = 4003
+CLOSE_RESYNC = 4009
+CLOSE_SERVICE_RESTART = 1012
+MAX_RENDER_SAMPLES = 50
+MAX_BATCH_WINDOW_MS = 1000
+# The only scope keys an open socket keeps; headers, cookies, the session and
+# the user object are dropped once connect has read what it needs.
+RETAINED_SCOPE_KEYS = ("type", "path")
+
+_action_executor = ThreadPoolExecutor(
+    max_workers=settings.FLOW_ACTION_WORKERS, thread_name_prefix="flow-action"
+)
+
+
+def _perform_action(user_id, action, appointment_id, room_id):
+    # The socket may outlive the account it was opened with.
+    user = (
+        get_user_model()
+        .objects.select_related("profile")
+        .filter(pk=user_id, is_active=True)
+        .first()
+    )
+    if user is None:
+        raise PermissionDenied("Your account is no longer active.")
+    appointment, _event = transition_appointment(
+        appointment_id=appointment_id,
+        action=action,
+        user=user,
+        room_id=room_id,
+    )
+    return {
+        "appointment_id": appointment.id,
+        "status": appointment.status,
+        "message": f"{appointment.patient.full_name} -> {appointment.get_status_display()}",
+    }
+
+
+perform_action = DatabaseSyncToAsync(
+    _perform_action, thread_sensitive=False, executor=_action_executor
+)
 
 
 class ClinicFlowConsumer(AsyncWebsocketConsumer):
+    """Live board socket, subscribed to one topic (frontdesk, doctor or a room).
+
+    The topic comes from the ``topic``/``room`` query parameters, or later from a
+    ``{"type": "subscribe", "topic": ..., "room": ...}`` message. Right after
+    subscribing the board gets a ``snapshot`` frame with its rows and the current
+    sequence. Passing ``resume_from=<seq>`` instead replays only the buffered
+    events the board missed, falling back to a snapshot when the gap is no longer
+    buffered.
+
+    Events wait in a small outbound queue where a newer update for the same
+    appointment replaces the one not yet sent. With ``batch=<ms>`` the queue is
+    flushed once per window as one JSON array; without it, a batch the
+    dispatcher published together still goes out as one array. A socket whose queue outgrows
+    FLOW_MAX_PENDING_EVENTS, or which has more than FLOW_MAX_UNACKED_EVENTS of the
+    events sent to it not yet covered by its ``{"type": "ack", "seq": ...}``
+    messages, is closed with ``CLOSE_RESYNC`` so the client reconnects for a
+    fresh snapshot. Acks may carry ``render`` samples, the browser's
+    frame-to-render times, which go into the latency histograms next to the
+    server-side stages.
+
+    Before a deploy, ``manage.py drain_flow`` asks every socket to flush its
+    queue, send a ``drain`` frame with a randomized ``reconnect_after_ms`` and
+    a ``resume_from`` sequence, and close, so boards come back spread out and
+    replay from where they were instead of reloading.
+
+    Clients offering the ``clinicflow.compact.v1`` subprotocol get positional rows
+    instead of keyed objects, after a ``hello`` frame with the label dictionaries.
+    Events arrive already encoded for both formats, so nothing is re-serialized
+    per socket.
+
+    Boards can also run workflow actions over the socket by sending
+    ``{"action": ..., "appointment_id": ..., "room_id": ..., "ref": ...}``; the
+    transition runs on a bounded thread pool and is answered with an ``ack`` or
+    ``error`` frame echoing ``ref``.
+
+    Subscribed sockets count as staff presence for their board. Clients send
+    ``{"type": "heartbeat"}`` at the interval given in the first ``presence``
+    frame; every board then receives only the online counts that changed,
+    including those of sockets that stopped heartbeating, which the registry
+    sweeps once per heartbeat interval.
+
+    Pages pass a signed ``token`` (see ``tokens.FlowTokenAuthMiddleware``) so a
+    connect needs no session or profile query; its claims also limit room
+    boards to the rooms it lists. When the token has expired the socket falls
+    back to the session and sends a ``{"type": "token"}`` frame with a new one.
+
+    Wall screens and tablets hold their socket all day, so after connect the
+    consumer keeps only the user id and role and trims its scope to
+    ``RETAINED_SCOPE_KEYS``; actions load the user again on the worker thread.
+    ``manage.py bench_flow --idle N`` reports the resulting bytes per idle socket.
+    """
+
     async def connect(self):
-        if not self.scope.get("user") or self.scope["user"].is_anonymous:
+        claims = self.scope.get("flow_auth")
+        if claims:
+            self.user_id = claims["user_id"]
+            self.role = claims["role"]
+            self.rooms = claims["rooms"]
+        elif self.scope.get("user") and not self.scope["user"].is_anonymous:
+            self.user_id = self.scope["user"].pk
+            self.role = await database_sync_to_async(get_user_role)(self.scope["user"])
+            self.rooms = None
+        else:
             await self.close()
             return
+        refresh_token = self.scope.get("flow_token_stale", False)
+        self.subscribed_groups = []
+
+        params = parse_qs(self.scope.get("query_string", b"").decode())
+        subprotocols = self.scope.get("subprotocols") or []
+        self.scope = {
+            key: self.scope[key] for key in RETAINED_SCOPE_KEYS if key in self.scope
+        }
+
+        batch_ms = params.get("batch", [""])[0]
+        self.batch_window = (
+            min(int(batch_ms), MAX_BATCH_WINDOW_MS) / 1000 if batch_ms.isdigit() else 0
+        )
+        self.pending_events = {}
+        self.flush_task = None
+        self.present = False
+        self.presence_entry = None
+        self.sent_seq = 0
+        self.acked_seq = None
+        # Seqs sent to this socket and not acked yet, kept from its first ack;
+        # only the length matters past the limit, since sequence numbers are
+        # shared by every board.
+        self.unacked_seqs = None
+        self.closing = False
+
+        topic = params.get("topic", [""])[0]
+        room_code = params.get("room", [""])[0]
+        if topic and not self._can_subscribe(topic, room_code):
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+
+        if COMPACT_SUBPROTOCOL in subprotocols:
+            self.wire = WIRE_COMPACT
+            await self.accept(subprotocol=COMPACT_SUBPROTOCOL)
+            await self.send(text_data=await database_sync_to_async(hello_frame)())
+        else:
+            self.wire = WIRE_JSON
+            await self.accept(
+                subprotocol=JSON_SUBPROTOCOL
+                if JSON_SUBPROTOCOL in subprotocols
+                else None
+            )
+        remember_serving_loop()
+        await self.channel_layer.group_add(CONTROL_GROUP, self.channel_name)
+        if refresh_token:
+            token = await database_sync_to_async(connect_token)(self.user_id, self.role)
+            await self.send(text_data=json.dumps({"type": "token", "token": token}))
 
-        await self.channel_layer.group_add(WORKFLOW_GROUP, self.channel_name)
-        await self.accept()
+        if topic:
+            await self._subscribe(topic, room_code)
+            resume_from = params.get("resume_from", [""])[0]
+            await self._catch_up(int(resume_from) if resume_from.isdigit() else None)
+            await self._join_presence()
 
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard(WORKFLOW_GROUP, self.channel_name)
+        flush_task = getattr(self, "flush_task", None)
+        if flush_task is not None and flush_task is not asyncio.current_task():
+            flush_task.cancel()
+        if getattr(self, "present", False):
+            await self.channel_layer.group_discard(PRESENCE_GROUP, self.channel_name)
+            await self._broadcast_presence(
+                await sync_to_async(leave)(self.channel_name, self.presence_entry)
+            )
+        for group in [CONTROL_GROUP, *getattr(self, "subscribed_groups", [])]:
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data or "")
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        if message.get("action"):
+            await self._run_action(message)
+            return
+
+        if message.get("type") == "ack":
+            seq = message.get("seq")
+            if isinstance(seq, int):
+                self.acked_seq = max(seq, self.acked_seq or 0)
+                if self.unacked_seqs is None:
+                    self.unacked_seqs = deque(
+                        maxlen=settings.FLOW_MAX_UNACKED_EVENTS + 1
+                    )
+                while self.unacked_seqs and self.unacked_seqs[0] <= self.acked_seq:
+                    self.unacked_seqs.popleft()
+            samples = message.get("render")
+            if isinstance(samples, list):
+                for sample in samples[:MAX_RENDER_SAMPLES]:
+                    if isinstance(sample, (int, float)):
+                        observe(STAGE_RENDER, sample)
+            return
+
+        if message.get("type") == "heartbeat":
+            if self.present:
+                await self._update_presence()
+                await self._broadcast_presence(
+                    await database_sync_to_async(sweep_if_due)()
+                )
+            return
+
+        if message.get("type") == "subscribe":
+            topic = str(message.get("topic") or "")
+            room_code = str(message.get("room") or "")
+            if not self._can_subscribe(topic, room_code):
+                await self.send(
+                    text_data=json.dumps(
+                        {"type": "error", "message": "Subscription not allowed."}
+                    )
+                )
+                return
+            await self._subscribe(topic, room_code)
+            resume_from = message.get("resume_from")
+            await self._catch_up(resume_from if isinstance(resume_from, int) else None)
+            await self._join_presence()
 
     async def workflow_event(self, event):
-        await self.send(text_data=json.dumps(event["payload"]))
+        if self.closing:
+            return
+
+        appointment_id = event["appointment_id"]
+        if self.pending_events.pop(appointment_id, None) is not None:
+            increment(COALESCED)
+        self.pending_events[appointment_id] = (
+            event.get("seq"),
+            event["frames"][self.wire],
+            event.get("published"),
+        )
+
+        if len(self.pending_events) > settings.FLOW_MAX_PENDING_EVENTS:
+            increment(RESYNC_QUEUE)
+            await self._close_for_resync()
+            return
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._drain_pending())
+
+    async def workflow_events(self, event):
+        for message in event["events"]:
+            await self.workflow_event(message)
+
+    async def presence_update(self, event):
+        if event["origin"] != self.channel_name:
+            await self.send(text_data=event["frame"])
+
+    async def flow_drain(self, event):
+        if self.closing:
+            return
+        self.closing = True
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        pending = list(self.pending_events.values())
+        self.pending_events = {}
+        if pending:
+            await self._send_pending(pending)
+
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "type": "drain",
+                    "reconnect_after_ms": event["min_delay_ms"]
+                    + random.randint(0, event["spread_ms"]),
+                    "resume_from": self.sent_seq,
+                }
+            )
+        )
+        await self.close(code=CLOSE_SERVICE_RESTART)
+
+    async def _drain_pending(self):
+        while self.pending_events and not self.closing:
+            await asyncio.sleep(self.batch_window)
+            pending = list(self.pending_events.values())
+            self.pending_events = {}
+            await self._send_pending(pending)
+            if (
+                self.unacked_seqs is not None
+                and len(self.unacked_seqs) > settings.FLOW_MAX_UNACKED_EVENTS
+            ):
+                increment(RESYNC_LAG)
+                await self._close_for_resync()
+        self.flush_task = None
+
+    async def _send_pending(self, pending):
+        frames = [frame for _seq, frame, _published in pending]
+        if self.batch_window or len(frames) > 1:
+            await self.send(text_data=join_frames(frames))
+        else:
+            for frame in frames:
+                await self.send(text_data=frame)
+        increment(SENT, len(frames))
+
+        sent_at = now_ms()
+        for _seq, _frame, published in pending:
+            if published:
+                observe(STAGE_FANOUT, sent_at - published)
+        seqs = sorted(seq for seq, _frame, _published in pending if seq)
+        if self.unacked_seqs is not None:
+            self.unacked_seqs.extend(seqs)
+        self.sent_seq = max(seqs + [self.sent_seq])
+
+    async def _close_for_resync(self):
+        self.closing = True
+        self.pending_events = {}
+        await self.close(code=CLOSE_RESYNC)
+
+    async def _run_action(self, message):
+        ref = message.get("ref")
+        action = message.get("action")
+        appointment_id = message.get("appointment_id")
+        if action not in ACTION_RULES or not isinstance(appointment_id, int):
+            await self._send_action_error(ref, "Unknown workflow action.")
+            return
+
+        try:
+            result = await perform_action(
+                self.user_id,
+                action,
+                appointment_id,
+                message.get("room_id") or None,
+            )
+        except PermissionDenied as exc:
+            await self._send_action_error(ref, str(exc))
+        except ValidationError as exc:
+            await self._send_action_error(ref, " ".join(exc.messages))
+        except Appointment.DoesNotExist:
+            await self._send_action_error(ref, "Appointment not found.")
+        else:
+            await self.send(text_data=json.dumps(dict(result, type="ack", ref=ref)))
+
+    async def _send_action_error(self, ref, text):
+        await self.send(
+            text_data=json.dumps({"type": "error", "ref": ref, "message": text})
+        )
+
+    @property
+    def board_doctor_id(self):
+        """Doctors follow their own queue; admins follow every doctor's."""
+        return self.user_id if self.role == "doctor" else None
+
+    def _can_subscribe(self, topic, room_code=""):
+        if self.role not in TOPIC_ROLES.get(topic, set()):
+            return False
+        return topic != TOPIC_ROOM or self.rooms is None or room_code in self.rooms
+
+    async def _subscribe(self, topic, room_code):
+        self.subscribed_groups = await join_topic(
+            self.channel_layer,
+            self.channel_name,
+            topic,
+            room_code,
+            joined=self.subscribed_groups,
+            doctor_id=self.board_doctor_id,
+        )
+        self.topic = topic
+        self.room_code = room_code
+
+    async def _join_presence(self):
+        if not self.present:
+            await self.channel_layer.group_add(PRESENCE_GROUP, self.channel_name)
+            self.present = True
+        await self._update_presence()
+        counts = await database_sync_to_async(current_counts)()
+        await self.send(text_data=presence_frame(counts, full=True))
+
+    async def _update_presence(self):
+        entry = presence_entry(
+            user_id=self.user_id,
+            role=self.role,
+            topic=self.topic,
+            room_code=self.room_code,
+        )
+        previous, self.presence_entry = self.presence_entry, entry
+        if previous is not None and presence_board(previous) != presence_board(entry):
+            await self._broadcast_presence(
+                await sync_to_async(leave)(self.channel_name, previous)
+            )
+        await self._broadcast_presence(
+            await sync_to_async(heartbeat)(self.channel_name, entry)
+        )
+
+    async def _broadcast_presence(self, counts):
+        diff = counts_diff(*counts)
+        if not diff:
+            return
+        try:
+            await self.channel_layer.group_send(
+                PRESENCE_GROUP,
+                {
+                    "type": "presence_update",
+                    "origin": self.channel_name,
+                    "frame": presence_frame(diff),
+                },
+            )
+        except (ChannelFull, OSError):
+            # Counts are best effort; the next heartbeat's diff catches boards up.
+            logger.warning("Presence update was not delivered.", exc_info=True)
+
+    async def _catch_up(self, resume_from):
+        seq, payloads = await database_sync_to_async(catch_up)(
+            self.topic,
+            self.room_code,
+            self.subscribed_groups,
+            resume_from,
+            self.board_doctor_id,
+        )
+        if seq is None:
+            await self._send_payloads(payloads)
+            seq = max([payload.get("seq") or 0 for payload in payloads] + [resume_from])
+        else:
+            await self.send(text_data=snapshot_frame(seq, payloads, self.wire))
+        self.sent_seq = max(self.sent_seq, seq)
+
+    async def _send_payloads(self, payloads):
+        frames = [encode(payload, self.wire) for payload in payloads]
+        if self.batch_window:
+            if frames:
+                await self.send(text_data=join_frames(frames))
+            return
+        for frame in frames:
+            await self.send(text_data=frame)
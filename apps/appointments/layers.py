@@ -0,0 +1,419 @@
+import asyncio
+import atexit
+import copy
+import json
+import logging
+import os
+import random
+import socket
+import string
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+
+logger = logging.getLogger(__name__)
+
+# Below the default socket send buffer, so a datagram this size can always be
+# sent; larger messages travel as several chunks.
+MAX_DATAGRAM_BYTES = 64 * 1024
+SOCKET_BUFFER_BYTES = 1024 * 1024
+# A peer's full buffer is retried this often, yielding to its reader in between,
+# before the send fails.
+SEND_ATTEMPTS = 20
+SEND_RETRY_SECONDS = 0.005
+CHUNK_PREFIX = b"#"
+CHUNK_HEADER_BYTES = 64
+# Chunks of a message that is still incomplete after this long are dropped.
+CHUNK_TIMEOUT_SECONDS = 10
+
+
+class LeanInMemoryChannelLayer(InMemoryChannelLayer):
+    """In-memory channel layer that costs next to nothing per idle channel.
+
+    The stock layer parks every waiting receiver on its own ``asyncio.Queue``,
+    about 3 KB per open socket even when nothing is queued, and sweeps all of
+    those queues for expired messages on every receive. Here a channel holds a
+    deque only while messages are buffered for it, and a waiting receiver holds
+    a single future, so thousands of idle board sockets stay cheap to keep.
+    Expired messages are dropped per channel as it is used, and the whole layer
+    is swept at most once per ``expiry`` seconds for channels nobody reads.
+    Capacity, expiry and group semantics are unchanged.
+
+    ``send`` and ``group_send`` may run on another thread's loop (an outbox
+    dispatcher thread, say); receivers are then woken on their own loop.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.waiters = {}
+        self.buffer_lock = threading.Lock()
+        self.next_sweep = 0
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+
+        now = time.time()
+        with self.buffer_lock:
+            buffer = self.channels.setdefault(channel, deque())
+            self._expire(channel, buffer, now)
+            if len(buffer) >= self.get_capacity(channel):
+                raise ChannelFull(channel)
+            buffer.append((now + self.expiry, copy.deepcopy(message)))
+            waiters = self.waiters.get(channel, ())
+            waiter = next((item for item in waiters if not item.done()), None)
+        if waiter is not None:
+            _wake(waiter)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self._sweep()
+
+        while True:
+            with self.buffer_lock:
+                buffer = self.channels.get(channel)
+                if buffer:
+                    self._expire(channel, buffer, time.time())
+                if buffer:
+                    _expires, message = buffer.popleft()
+                    if not buffer:
+                        del self.channels[channel]
+                    return message
+
+                waiter = asyncio.get_running_loop().create_future()
+                waiters = self.waiters.setdefault(channel, [])
+                waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                with self.buffer_lock:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        self.waiters.pop(channel, None)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._sweep()
+
+        # send() never suspends here, so there is no need for a task per member.
+        for channel in list(self.groups.get(group, ())):
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
+
+    def _expire(self, channel, buffer, now):
+        """Drop ``channel``'s expired messages; as on the stock layer, a channel
+        that let a message expire leaves its groups."""
+        if buffer and buffer[0][0] < now:
+            while buffer and buffer[0][0] < now:
+                buffer.popleft()
+            self._remove_from_groups(channel)
+
+    def _sweep(self):
+        """Expire abandoned channels and group memberships, at most once per
+        ``expiry`` seconds."""
+        now = time.time()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + self.expiry
+
+        with self.buffer_lock:
+            for channel, buffer in list(self.channels.items()):
+                self._expire(channel, buffer, now)
+                if not buffer:
+                    del self.channels[channel]
+
+        timeout = int(now) - self.group_expiry
+        for channels in list(self.groups.values()):
+            for name, joined in list(channels.items()):
+                if joined and joined < timeout:
+                    channels.pop(name, None)
+
+
+def _wake(waiter):
+    """Resolve a receiver's future on its own loop, from any thread."""
+    loop = waiter.get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        waiter.set_result(None)
+    elif not loop.is_closed():
+        loop.call_soon_threadsafe(_resolve, waiter)
+
+
+def _resolve(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+async def _run_on(loop, coroutine):
+    """Run ``coroutine`` on ``loop``, another thread's, and await its result."""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, loop))
+
+
+class UnixSocketChannelLayer(LeanInMemoryChannelLayer):
+    """Channel layer shared by the worker processes of one host, without Redis.
+
+    Each process binds a Unix datagram socket in ``socket_dir``. ``group_send``
+    writes the message to every socket in the directory, including its own, and
+    each process delivers it to the local members of the group. Messages for a
+    specific channel go only to the process that created the channel.
+
+    Delivery stays in memory. Sockets whose process has gone away are skipped,
+    but a live peer that cannot take a message, for example because its socket
+    buffer is full, makes the send raise once every peer was tried, so callers
+    such as the outbox can retry. Messages must be JSON-serializable; those
+    larger than MAX_DATAGRAM_BYTES are split into chunks and joined back by the
+    receiving process.
+
+    The socket is read on the process's serving loop. Calls made from another
+    thread's loop (``async_to_sync`` in a view or the outbox dispatcher) run on
+    the serving loop instead of moving the socket to theirs.
+    """
+
+    def __init__(self, socket_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_dir = Path(socket_dir)
+        self.peer_id = None
+        self._receiver = None
+        self._sender = None
+        self._sender_pid = None
+        self._receiver_pid = None
+        self._loop = None
+        # Chunk id -> (expiry, {index: piece}) for messages still arriving.
+        self._chunks = {}
+        atexit.register(self._unbind)
+
+    # Process wiring
+
+    def _socket_path(self, peer_id):
+        return self.socket_dir / f"{peer_id}.sock"
+
+    def _bind(self):
+        """Read this process's socket on the running loop.
+
+        The socket is bound once per process and keeps its path. It only moves
+        to another loop once the loop it was read on has stopped, as happens
+        between test cases.
+        """
+        loop = asyncio.get_running_loop()
+        if self._receiver is not None and self._receiver_pid != os.getpid():
+            # Inherited across a fork; the socket belongs to the parent.
+            self._receiver.close()
+            self._receiver = None
+            self._loop = None
+        if self._receiver is not None and self._loop is loop:
+            return
+
+        if self._receiver is None:
+            self.socket_dir.mkdir(parents=True, exist_ok=True)
+            self.peer_id = f"{os.getpid()}-{random.randrange(16**6):06x}"
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            receiver.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES
+            )
+            receiver.bind(str(self._socket_path(self.peer_id)))
+            receiver.setblocking(False)
+            self._receiver = receiver
+            self._receiver_pid = os.getpid()
+        elif not self._loop.is_closed():
+            self._loop.remove_reader(self._receiver.fileno())
+
+        loop.add_reader(self._receiver.fileno(), self._on_readable)
+        self._loop = loop
+
+    def _other_serving_loop(self):
+        """The serving loop, when it is running and the caller is not on it."""
+        loop = self._loop
+        if (
+            loop is None
+            or self._receiver_pid != os.getpid()
+            or not loop.is_running()
+            or loop is asyncio.get_running_loop()
+        ):
+            return None
+        return loop
+
+    def _unbind(self):
+        if self._receiver is None:
+            return
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self._receiver.fileno())
+        self._receiver.close()
+        if self._receiver_pid == os.getpid():
+            self._socket_path(self.peer_id).unlink(missing_ok=True)
+        self._receiver = None
+        self._loop = None
+
+    def _sender_socket(self):
+        if self._sender is None or self._sender_pid != os.getpid():
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # Datagrams count against the sender's buffer until they are read.
+            self._sender.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES
+            )
+            self._sender.setblocking(False)
+            self._sender_pid = os.getpid()
+        return self._sender
+
+    def _datagrams(self, envelope):
+        """``envelope`` as datagrams of at most MAX_DATAGRAM_BYTES.
+
+        A larger one is split into chunks, each headed ``#<id> <index> <count>``
+        and a newline, which JSON text never contains unescaped.
+        """
+        data = json.dumps(envelope).encode()
+        if len(data) <= MAX_DATAGRAM_BYTES:
+            return [data]
+        size = MAX_DATAGRAM_BYTES - CHUNK_HEADER_BYTES
+        pieces = [data[start : start + size] for start in range(0, len(data), size)]
+        chunk_id = uuid.uuid4().hex
+        return [
+            CHUNK_PREFIX + f"{chunk_id} {index} {len(pieces)}\n".encode() + piece
+            for index, piece in enumerate(pieces)
+        ]
+
+    async def _post(self, path, datagrams):
+        """Send ``datagrams`` to the peer bound at ``path``.
+
+        A socket nobody reads any more is skipped. A live peer whose buffer stays
+        full raises ChannelFull, and any other failure raises its OSError.
+        """
+        sender = self._sender_socket()
+        try:
+            for datagram in datagrams:
+                for attempt in range(1, SEND_ATTEMPTS + 1):
+                    try:
+                        sender.sendto(datagram, str(path))
+                        break
+                    except BlockingIOError:
+                        if attempt == SEND_ATTEMPTS:
+                            raise ChannelFull(path.name) from None
+                        await asyncio.sleep(SEND_RETRY_SECONDS)
+        except ConnectionRefusedError:
+            # Nobody is bound to it any more: a worker that exited uncleanly.
+            path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._receiver.recv(MAX_DATAGRAM_BYTES)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                envelope = self._receive(data)
+            except ValueError:
+                logger.warning("Channel layer dropped an unreadable message.")
+                continue
+            if envelope is not None:
+                self._loop.create_task(self._deliver(envelope))
+
+    def _receive(self, data):
+        """The envelope ``data`` carries, or ``None`` while its chunks arrive.
+
+        Raises ValueError for a datagram that is not one this layer sent.
+        """
+        if data.startswith(CHUNK_PREFIX):
+            header, _newline, piece = data.partition(b"\n")
+            chunk_id, index, count = header[len(CHUNK_PREFIX) :].decode().split()
+            index, count = int(index), int(count)
+            now = time.monotonic()
+            for stale in [
+                key for key, (expires, _pieces) in self._chunks.items() if expires < now
+            ]:
+                del self._chunks[stale]
+            _expires, pieces = self._chunks.setdefault(
+                chunk_id, (now + CHUNK_TIMEOUT_SECONDS, {})
+            )
+            pieces[index] = piece
+            if len(pieces) < count:
+                return None
+            del self._chunks[chunk_id]
+            data = b"".join(pieces.get(position, b"") for position in range(count))
+        envelope = json.loads(data)
+        if not (
+            isinstance(envelope, dict)
+            and isinstance(envelope.get("message"), dict)
+            and ("group" in envelope or "channel" in envelope)
+        ):
+            raise ValueError("Not a channel layer envelope.")
+        return envelope
+
+    async def _deliver(self, envelope):
+        if "group" in envelope:
+            await super().group_send(envelope["group"], envelope["message"])
+        else:
+            await super().send(envelope["channel"], envelope["message"])
+
+    # Channel layer API
+
+    async def new_channel(self, prefix="specific."):
+        loop = self._other_serving_loop()
+        if loop is not None:
+            return await _run_on(loop, self.new_channel(prefix))
+        self._bind()
+        suffix = "".join(random.choice(string.ascii_letters) for _i in range(12))
+        return f"{prefix}.{self.peer_id}!{suffix}"
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if "!" in channel:
+            peer_id = channel.split("!", 1)[0].rsplit(".", 1)[-1]
+            if peer_id != self.peer_id:
+                await self._post(
+                    self._socket_path(peer_id),
+                    self._datagrams({"channel": channel, "message": message}),
+                )
+                return
+        await super().send(channel, message)
+
+    async def receive(self, channel):
+        loop = self._other_serving_loop()
+        if loop is not None:
+            return await _run_on(loop, self.receive(channel))
+        self._bind()
+        return await super().receive(channel)
+
+    async def group_add(self, group, channel):
+        loop = self._other_serving_loop()
+        if loop is not None:
+            return await _run_on(loop, self.group_add(group, channel))
+        self._bind()
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        loop = self._other_serving_loop()
+        if loop is not None:
+            return await _run_on(loop, self.group_discard(group, channel))
+        await super().group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        datagrams = self._datagrams({"group": group, "message": message})
+        failure = None
+        for path in self.socket_dir.glob("*.sock"):
+            try:
+                await self._post(path, datagrams)
+            except (ChannelFull, OSError) as exc:
+                logger.warning("Channel layer message to %s failed: %r", path.name, exc)
+                failure = failure or exc
+        if failure is not None:
+            raise failure
+
+    async def close(self):
+        self._unbind()
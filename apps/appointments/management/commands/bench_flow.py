@@ -0,0 +1,299 @@
+import asyncio
+import gc
+import json
+import resource
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from asgiref import testing
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+
+from apps.accounts.audit import flush_action_logs
+from apps.accounts.models import ActionLog
+from apps.appointments.models import Appointment, CareRoom, WorkflowOutbox
+from apps.appointments.outbox import dispatch_inline, drain
+from apps.appointments.workflow import transition_appointment
+from apps.patients.models import Patient
+
+
+CYCLE = ["check_in", "doctor_accept", "transfer_to_room", "room_accept", "complete"]
+RECEIVE_TIMEOUT = 10
+# Deep enough to tell allocations made by the test client from the server's.
+TRACE_FRAMES = 25
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(percent / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure live-board fan-out: connect N in-process flow sockets, run M "
+        "workflow transitions and report delivery latency, throughput and memory"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--clients",
+            default="10,50,100",
+            help="Comma-separated socket counts to measure, one round each",
+        )
+        parser.add_argument(
+            "--transitions",
+            type=int,
+            default=50,
+            help="Workflow transitions fired per round",
+        )
+        parser.add_argument(
+            "--allow-redis",
+            action="store_true",
+            help="Run against a non in-memory channel layer (use a local Redis only)",
+        )
+        parser.add_argument(
+            "--idle",
+            type=int,
+            default=0,
+            help="Instead of fan-out rounds, open this many idle sockets and report "
+            "the memory each one keeps",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            client_counts = [int(value) for value in options["clients"].split(",")]
+        except ValueError:
+            raise CommandError("--clients must be a comma-separated list of numbers.")
+        transitions = max(1, options["transitions"])
+
+        if not isinstance(get_channel_layer(), InMemoryChannelLayer) and not options[
+            "allow_redis"
+        ]:
+            raise CommandError(
+                "The channel layer is shared with live boards; pass --allow-redis "
+                "only when REDIS_URL points at a local Redis."
+            )
+
+        # The DEBUG query log would grow with every connect and skew the numbers.
+        if settings.DEBUG:
+            raise CommandError("Run the benchmark with DEBUG=false.")
+
+        # Events are drained inline after each transition, so no dispatcher thread
+        # publishes into the in-memory layer from outside the benchmark loop.
+        with dispatch_inline():
+            fixture = self._create_fixture()
+            try:
+                if options["idle"] > 0:
+                    per_socket = asyncio.run(
+                        self._closing_connections(
+                            self._measure_idle(options["idle"], fixture)
+                        )
+                    )
+                else:
+                    results = asyncio.run(
+                        self._closing_connections(
+                            self._run(client_counts, transitions, fixture)
+                        )
+                    )
+            finally:
+                self._delete_fixture(fixture)
+
+        if options["idle"] > 0:
+            self.stdout.write(f"{'idle':>8} {'bytes/socket':>14}")
+            self.stdout.write(f"{options['idle']:>8} {per_socket:>14}")
+            return
+
+        self.stdout.write(
+            f"{'clients':>8} {'events':>8} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'frames/s':>10} {'lost':>6} {'RSS MB':>8}"
+        )
+        for row in results:
+            self.stdout.write(
+                f"{row['clients']:>8} {row['events']:>8} {row['p50']:>8.1f} "
+                f"{row['p95']:>8.1f} {row['p99']:>8.1f} {row['fps']:>10.0f} "
+                f"{row['lost']:>6} {row['rss']:>8.1f}"
+            )
+
+    def _create_fixture(self):
+        tag = uuid.uuid4().hex[:8]
+        user = get_user_model().objects.create_user(
+            f"bench-{tag}", is_staff=True, is_superuser=True
+        )
+        client = Client()
+        client.force_login(user)
+        return {
+            "user": user,
+            "cookie": f"{settings.SESSION_COOKIE_NAME}="
+            f"{client.cookies[settings.SESSION_COOKIE_NAME].value}",
+            "patient": Patient.objects.create(
+                full_name=f"Bench Patient {tag}", phone="+000000000", sex="M"
+            ),
+            "room": CareRoom.objects.create(code=f"BENCH-{tag}", name=f"Bench {tag}"),
+        }
+
+    def _delete_fixture(self, fixture):
+        flush_action_logs()
+        WorkflowOutbox.objects.filter(
+            payload__patient_id=fixture["patient"].id
+        ).delete()
+        ActionLog.objects.filter(user=fixture["user"]).delete()
+        fixture["patient"].delete()
+        fixture["room"].delete()
+        fixture["user"].delete()
+
+    async def _closing_connections(self, coroutine):
+        """Await ``coroutine``, then close the connections its sockets opened.
+
+        Outside a server, database calls from async code run on asgiref's shared
+        thread, whose connection would otherwise outlive the command.
+        """
+        try:
+            return await coroutine
+        finally:
+            await sync_to_async(connections.close_all)()
+
+    async def _run(self, client_counts, transitions, fixture):
+        return [
+            await self._run_round(clients, transitions, fixture)
+            for clients in client_counts
+        ]
+
+    async def _run_round(self, clients, transitions, fixture):
+        communicators = [await self._connect(fixture) for _index in range(clients)]
+        for communicator in communicators:
+            await self._wait_for_frame(communicator, "presence")
+
+        receivers = [
+            asyncio.create_task(self._collect(communicator, transitions))
+            for communicator in communicators
+        ]
+        started = time.perf_counter()
+        await sync_to_async(self._fire)(fixture, transitions)
+        received = await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - started
+
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        latencies = [latency for batch in received for latency in batch]
+        return {
+            "clients": clients,
+            "events": transitions,
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "fps": len(latencies) / elapsed if elapsed else 0.0,
+            "lost": clients * transitions - len(latencies),
+            "rss": _peak_rss_mb(),
+        }
+
+    async def _measure_idle(self, count, fixture):
+        """Bytes kept per open, subscribed socket that receives no events."""
+        # Connect one socket first so one-off imports and caches are not counted.
+        communicators = [await self._connect(fixture)]
+        await self._wait_for_frame(communicators[0], "presence")
+        gc.collect()
+        tracemalloc.start(TRACE_FRAMES)
+        try:
+            before = tracemalloc.take_snapshot()
+            for _index in range(count):
+                communicator = await self._connect(fixture)
+                await self._wait_for_frame(communicator, "presence")
+                communicators.append(communicator)
+            # Presence diffs from later joins wait unread in the test client.
+            for communicator in communicators:
+                while not communicator.output_queue.empty():
+                    communicator.output_queue.get_nowait()
+            gc.collect()
+            after = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        # The test client's own message queues have no counterpart under daphne.
+        harness = [tracemalloc.Filter(False, testing.__file__, all_frames=True)]
+        retained = sum(
+            stat.size_diff
+            for stat in after.filter_traces(harness).compare_to(
+                before.filter_traces(harness), "filename"
+            )
+        )
+        for communicator in communicators:
+            await communicator.disconnect()
+        return retained // count
+
+    async def _connect(self, fixture):
+        communicator = WebsocketCommunicator(
+            self._application(),
+            "/ws/flow/?topic=frontdesk",
+            headers=[(b"cookie", fixture["cookie"].encode())],
+        )
+        connected, _subprotocol = await communicator.connect()
+        if not connected:
+            raise CommandError("A benchmark socket was refused.")
+        return communicator
+
+    def _application(self):
+        from config.asgi import application
+
+        return application
+
+    async def _wait_for_frame(self, communicator, frame_type):
+        while True:
+            message = json.loads(await communicator.receive_from(RECEIVE_TIMEOUT))
+            if isinstance(message, dict) and message.get("type") == frame_type:
+                return
+
+    async def _collect(self, communicator, expected):
+        """Receive ``expected`` events and return their latencies in ms.
+
+        Coalesced and batched events arrive as one array frame; each event in
+        it counts.
+        """
+        latencies = []
+        while len(latencies) < expected:
+            try:
+                frame = await communicator.receive_from(RECEIVE_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            received_at = time.time()
+            message = json.loads(frame)
+            events = message if isinstance(message, list) else [message]
+            for event in events:
+                if not isinstance(event, dict) or event.get("type"):
+                    continue
+                sent_at = datetime.fromisoformat(event["timestamp"]).timestamp()
+                latencies.append((received_at - sent_at) * 1000)
+        return latencies
+
+    def _fire(self, fixture, transitions):
+        appointment = None
+        for index in range(transitions):
+            step = index % len(CYCLE)
+            if step == 0:
+                appointment = Appointment.objects.create(
+                    patient=fixture["patient"], reason="[BENCH]"
+                )
+            transition_appointment(
+                appointment_id=appointment.id,
+                action=CYCLE[step],
+                user=fixture["user"],
+                room_id=fixture["room"].id,
+                enforce_doctor_capacity=False,
+            )
+            drain()
@@ -0,0 +1,53 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.appointments.outbox import PRUNE_INTERVAL_SECONDS, drain, prune_delivered
+
+
+class Command(BaseCommand):
+    help = "Publish queued workflow events from the outbox to the live boards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Drain the outbox once and exit",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=settings.FLOW_OUTBOX_BATCH_SIZE,
+            help="How many events to publish per batch",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=settings.FLOW_OUTBOX_POLL_SECONDS,
+            help="Seconds to wait between passes",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options["batch_size"])
+
+        if options["once"]:
+            delivered = drain(batch_size)
+            pruned = prune_delivered()
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Published {delivered} events, pruned {pruned} delivered rows"
+                )
+            )
+            return
+
+        self.stdout.write(self.style.SUCCESS("Dispatching workflow outbox..."))
+        last_prune = 0.0
+        while True:
+            delivered = drain(batch_size)
+            if delivered:
+                self.stdout.write(f"Published {delivered} events")
+            if time.monotonic() - last_prune > PRUNE_INTERVAL_SECONDS:
+                prune_delivered()
+                last_prune = time.monotonic()
+            time.sleep(options["poll"])
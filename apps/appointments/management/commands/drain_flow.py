@@ -0,0 +1,48 @@
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.appointments.layers import UnixSocketChannelLayer
+from apps.appointments.realtime import CONTROL_GROUP
+
+
+class Command(BaseCommand):
+    help = (
+        "Ask every open live board to disconnect and come back after a "
+        "randomized delay, resuming from its last event (run before a restart)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-delay",
+            type=float,
+            default=settings.FLOW_DRAIN_MIN_SECONDS,
+            help="Seconds every board waits before reconnecting",
+        )
+        parser.add_argument(
+            "--spread",
+            type=float,
+            default=settings.FLOW_DRAIN_SPREAD_SECONDS,
+            help="Extra random wait, up to this many seconds, per board",
+        )
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if isinstance(channel_layer, InMemoryChannelLayer) and not isinstance(
+            channel_layer, UnixSocketChannelLayer
+        ):
+            raise CommandError(
+                "The in-memory channel layer cannot reach the web server's sockets; "
+                "drain needs REDIS_URL or FLOW_LAYER_SOCKET_DIR."
+            )
+
+        async_to_sync(channel_layer.group_send)(
+            CONTROL_GROUP,
+            {
+                "type": "flow.drain",
+                "min_delay_ms": int(max(0, options["min_delay"]) * 1000),
+                "spread_ms": int(max(0, options["spread"]) * 1000),
+            },
+        )
+        self.stdout.write(self.style.SUCCESS("Asked live boards to drain"))
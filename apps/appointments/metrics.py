@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import Counter
+
+
+COALESCED = "coalesced"
+SENT = "sent"
+RESYNC_QUEUE = "resync_queue"
+RESYNC_LAG = "resync_lag"
+
+# Latency stages of a workflow event, in the order it passes through them.
+STAGE_COMMIT = "commit"  # payload built -> transaction committed
+STAGE_DISPATCH = "dispatch"  # committed -> published by the outbox
+STAGE_FANOUT = "fanout"  # published -> written to a board socket
+STAGE_RENDER = "render"  # frame received -> board updated, measured in the browser
+
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+_BUCKET_LABELS = [str(bound) for bound in BUCKETS_MS] + ["+Inf"]
+
+_counters = Counter()
+_histograms = {}
+_lock = threading.Lock()
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(stage, value_ms):
+    """Record one latency sample for ``stage`` in its bucketed histogram."""
+    value_ms = max(0, value_ms)
+    with _lock:
+        histogram = _histograms.setdefault(
+            stage, {"buckets": [0] * (len(BUCKETS_MS) + 1), "count": 0, "sum": 0}
+        )
+        index = next(
+            (i for i, bound in enumerate(BUCKETS_MS) if value_ms <= bound),
+            len(BUCKETS_MS),
+        )
+        histogram["buckets"][index] += 1
+        histogram["count"] += 1
+        histogram["sum"] += value_ms
+
+
+def flow_stats():
+    """Live-board counters and latency histograms for this process."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {
+            stage: {
+                "buckets": dict(zip(_BUCKET_LABELS, data["buckets"])),
+                "count": data["count"],
+                "sum": data["sum"],
+            }
+            for stage, data in _histograms.items()
+        }
+    return {"pid": os.getpid(), "counters": counters, "latency_ms": histograms}
+
+
+def prometheus_text():
+    """The same numbers in the Prometheus text exposition format."""
+    stats = flow_stats()
+    lines = ["# TYPE clinicflow_events_total counter"]
+    for name, value in sorted(stats["counters"].items()):
+        lines.append(f'clinicflow_events_total{{kind="{name}"}} {value}')
+
+    lines.append("# TYPE clinicflow_event_latency_ms histogram")
+    for stage, data in sorted(stats["latency_ms"].items()):
+        cumulative = 0
+        for bound, count in data["buckets"].items():
+            cumulative += count
+            lines.append(
+                f'clinicflow_event_latency_ms_bucket{{stage="{stage}",le="{bound}"}} '
+                f"{cumulative}"
+            )
+        lines.append(
+            f'clinicflow_event_latency_ms_sum{{stage="{stage}"}} {data["sum"]}'
+        )
+        lines.append(
+            f'clinicflow_event_latency_ms_count{{stage="{stage}"}} {data["count"]}'
+        )
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
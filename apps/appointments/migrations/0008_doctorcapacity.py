@@ -0,0 +1,40 @@
+# Generated by Django 6.0.1 on 2026-10-18 05:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_capacity_row(apps, schema_editor):
+    Appointment = apps.get_model("appointments", "Appointment")
+    DoctorCapacity = apps.get_model("appointments", "DoctorCapacity")
+    active = (
+        Appointment.objects.filter(status="MD", scheduled_at__date=timezone.localdate())
+        .order_by("id")
+        .last()
+    )
+    DoctorCapacity.objects.update_or_create(
+        pk=1, defaults={"active_appointment": active}
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0007_workflowoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorCapacity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('active_appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='appointments.appointment')),
+            ],
+            options={
+                'verbose_name_plural': 'Doctor capacity',
+            },
+        ),
+        migrations.RunPython(create_capacity_row, migrations.RunPython.noop),
+    ]
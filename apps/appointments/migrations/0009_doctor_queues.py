@@ -0,0 +1,68 @@
+# Generated by Django 6.0.1 on 2026-10-18 07:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+
+def assign_doctors(apps, schema_editor):
+    """Credit past sessions to the doctor who accepted them, then rebuild capacity."""
+    Appointment = apps.get_model("appointments", "Appointment")
+    AppointmentEvent = apps.get_model("appointments", "AppointmentEvent")
+    DoctorCapacity = apps.get_model("appointments", "DoctorCapacity")
+
+    accepted_by = (
+        AppointmentEvent.objects.filter(
+            appointment=OuterRef("pk"), event_type="doctor_accepted"
+        )
+        .order_by("-created_at", "-id")
+        .values("performed_by")[:1]
+    )
+    Appointment.objects.filter(
+        doctor__isnull=True, status__in=["MD", "WR", "MR", "CM"]
+    ).update(doctor=Subquery(accepted_by))
+
+    active = {}
+    for appointment in Appointment.objects.filter(
+        status="MD",
+        scheduled_at__date=timezone.localdate(),
+        doctor__isnull=False,
+    ).order_by("id"):
+        active[appointment.doctor_id] = appointment
+    for doctor_id, appointment in active.items():
+        DoctorCapacity.objects.create(doctor_id=doctor_id, active_appointment=appointment)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0008_doctorcapacity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='doctor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='doctor_appointments', to=settings.AUTH_USER_MODEL),
+        ),
+        # The single clinic-wide row becomes one row per doctor; the rows are
+        # derived from the appointments, so they are rebuilt rather than altered.
+        migrations.DeleteModel(
+            name='DoctorCapacity',
+        ),
+        migrations.CreateModel(
+            name='DoctorCapacity',
+            fields=[
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='capacity', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('active_appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='appointments.appointment')),
+            ],
+            options={
+                'verbose_name_plural': 'Doctor capacity',
+            },
+        ),
+        migrations.RunPython(assign_doctors, migrations.RunPython.noop),
+    ]
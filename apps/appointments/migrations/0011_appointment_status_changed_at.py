@@ -0,0 +1,37 @@
+# Generated by Django 6.0.1 on 2026-10-18 12:05
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_status_changed_at(apps, schema_editor):
+    """Date each appointment's current status from its latest event."""
+    Appointment = apps.get_model("appointments", "Appointment")
+    AppointmentEvent = apps.get_model("appointments", "AppointmentEvent")
+
+    latest_event = (
+        AppointmentEvent.objects.filter(appointment=OuterRef("pk"))
+        .order_by("-created_at", "-id")
+        .values("created_at")[:1]
+    )
+    Appointment.objects.update(
+        status_changed_at=Coalesce(Subquery(latest_event), F("created_at"))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0010_appointment_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='status_changed_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.RunPython(backfill_status_changed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 6.0.1 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0011_appointment_status_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='workflowoutbox',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='workflowoutbox',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
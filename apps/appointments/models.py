@@ -2,6 +2,7 @@ from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
+from apps.accounts.models import ActionLog
 from apps.patients.models import Patient
 
 
@@ -52,6 +53,19 @@ class Appointment(models.Model):
         blank=True,
         related_name="appointments",
     )
+    doctor = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="doctor_appointments",
+    )
+    # Bumped by every workflow transition; optimistic transitions write only
+    # when it still matches the value they read.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # When the appointment entered its current status; orders the waiting
+    # queues and times sessions for the wait estimates.
+    status_changed_at = models.DateTimeField(default=timezone.now, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -107,3 +121,83 @@ class AppointmentEvent(models.Model):
 
     def __str__(self):
         return f"{self.event_type} #{self.appointment_id}"
+
+    @property
+    def description(self):
+        patient_name = self.appointment.patient.full_name
+        room = self.room
+        if self.event_type == self.EVENT_CHECKED_IN:
+            return f"Checked in patient: {patient_name}"
+        if self.event_type == self.EVENT_DOCTOR_ACCEPTED:
+            return f"Doctor accepted patient: {patient_name}"
+        if self.event_type == self.EVENT_TRANSFERRED_TO_ROOM and room:
+            return f"Doctor transferred patient to {room.name}: {patient_name}"
+        if self.event_type == self.EVENT_ROOM_ACCEPTED and room:
+            return f"Room accepted patient in {room.name}: {patient_name}"
+        if self.event_type == self.EVENT_ROOM_TRANSFERRED and room:
+            return f"Room transferred patient to {room.name}: {patient_name}"
+        if self.event_type == self.EVENT_COMPLETED:
+            return f"Completed appointment for patient: {patient_name}"
+        return f"Updated appointment for patient: {patient_name}"
+
+    def as_action_log(self):
+        """The activity log entry for this event, built on read and never saved.
+
+        Event types share their codes with the ActionLog actions they replace.
+        """
+        return ActionLog(
+            user=self.performed_by,
+            action=self.event_type,
+            target_type="appointment",
+            target_id=self.appointment_id,
+            description=self.description,
+            created_at=self.created_at,
+        )
+
+
+class DoctorCapacity(models.Model):
+    """The patient a doctor is seeing, locked by transitions that change it."""
+
+    doctor = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="capacity",
+    )
+    active_appointment = models.ForeignKey(
+        Appointment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Doctor capacity"
+
+    def __str__(self):
+        appointment = self.active_appointment_id or "-"
+        return f"Doctor {self.doctor_id} with appointment #{appointment}"
+
+
+class WorkflowOutbox(models.Model):
+    """Workflow broadcast written in the same transaction as the change it reports."""
+
+    groups = models.JSONField(default=list)
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    # Set while a dispatcher publishes the row; a lapsed claim is retried.
+    claimed_until = models.DateTimeField(null=True, blank=True)
+    # Set when the row ran out of attempts; it is never published.
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["delivered_at", "id"])]
+
+    def __str__(self):
+        return f"{self.payload.get('action', 'event')} #{self.payload.get('appointment_id')}"
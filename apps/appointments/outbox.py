@@ -0,0 +1,354 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .metrics import STAGE_COMMIT, now_ms, observe
+from .models import WorkflowOutbox
+from .queues import queue_key, queue_updates, touched_queues
+from .realtime import (
+    PUBLISH_TIMEOUT_SECONDS,
+    event_groups,
+    publish_workflow_events,
+    workflow_payload,
+)
+
+
+logger = logging.getLogger(__name__)
+
+COMMIT_CACHE_KEY = "flow:commit:{entry_id}"
+COMMIT_STAMP_TIMEOUT = 600
+# How often dispatchers delete delivered rows older than the retention window.
+PRUNE_INTERVAL_SECONDS = 3600
+# How long claimed rows stay with one dispatcher; longer than any publish takes,
+# so only a dispatcher that died mid-publish loses its claim.
+CLAIM_SECONDS = 2 * PUBLISH_TIMEOUT_SECONDS
+
+
+def broadcast_workflow_event(
+    *,
+    appointment,
+    action,
+    actor,
+    previous_status=None,
+    previous_room=None,
+    previous_doctor_id=None,
+):
+    """Queue a workflow event for the live boards.
+
+    The outbox row joins the caller's transaction, so the event is only
+    published once the change it describes has been committed. It carries
+    fresh estimates for everyone waiting in the queues the appointment left
+    and joined.
+    """
+    previous_queue = _previous_queue(previous_status, previous_room, previous_doctor_id)
+    updates = queue_updates([(appointment, previous_queue)])
+    rows = [row for queue_rows in updates.values() for row in queue_rows]
+    entry = _outbox_entry(
+        appointment=appointment,
+        action=action,
+        actor=actor,
+        previous_status=previous_status,
+        previous_room=previous_room,
+        previous_doctor_id=previous_doctor_id,
+        estimate=_estimates(rows).get(appointment.id),
+        queue_updates=rows,
+    )
+    entry.save()
+    transaction.on_commit(partial(_stamp_commits, [entry.id]))
+    transaction.on_commit(notify_dispatcher)
+    return entry
+
+
+def broadcast_workflow_events(events):
+    """Queue several workflow events with one outbox insert.
+
+    ``events`` are dicts of ``broadcast_workflow_event`` keyword arguments. The
+    dispatcher is woken once and publishes them in order in a single pass.
+    Estimates are worked out once for all of them; each queue's fresh estimates
+    ride on the last event that changed it.
+    """
+    moves = [
+        (
+            event["appointment"],
+            _previous_queue(
+                event.get("previous_status"),
+                event.get("previous_room"),
+                event.get("previous_doctor_id"),
+            ),
+        )
+        for event in events
+    ]
+    updates = queue_updates(moves)
+    estimates = _estimates(
+        [row for queue_rows in updates.values() for row in queue_rows]
+    )
+    carriers = {}
+    for index, move in enumerate(moves):
+        for day_key in touched_queues(*move):
+            carriers[day_key] = index
+    entries = WorkflowOutbox.objects.bulk_create(
+        [
+            _outbox_entry(
+                **event,
+                estimate=estimates.get(event["appointment"].id),
+                queue_updates=[
+                    row
+                    for day_key, carrier in carriers.items()
+                    if carrier == index
+                    for row in updates[day_key]
+                ],
+            )
+            for index, event in enumerate(events)
+        ]
+    )
+    if entries:
+        transaction.on_commit(
+            partial(_stamp_commits, [entry.id for entry in entries])
+        )
+        transaction.on_commit(notify_dispatcher)
+    return entries
+
+
+def _outbox_entry(
+    *,
+    appointment,
+    action,
+    actor,
+    previous_status=None,
+    previous_room=None,
+    previous_doctor_id=None,
+    estimate=None,
+    queue_updates=(),
+):
+    payload = workflow_payload(
+        appointment=appointment,
+        action=action,
+        actor=actor,
+        estimate=estimate,
+        queue_updates=queue_updates,
+    )
+    payload["trace"] = {"created": now_ms()}
+    groups = event_groups(
+        status=appointment.status,
+        room_code=payload["room"],
+        previous_status=previous_status,
+        previous_room_code=previous_room.code if previous_room else None,
+        doctor_id=appointment.doctor_id,
+        previous_doctor_id=previous_doctor_id,
+    )
+    return WorkflowOutbox(groups=groups, payload=payload)
+
+
+def _previous_queue(previous_status, previous_room, previous_doctor_id):
+    if previous_status is None:
+        return None
+    return queue_key(
+        previous_status, previous_doctor_id, previous_room.id if previous_room else None
+    )
+
+
+def _estimates(rows):
+    return {appointment_id: (position, eta) for appointment_id, position, eta in rows}
+
+
+def _stamp_commits(entry_ids):
+    # Kept in the cache rather than the row, so tracing costs no extra write.
+    committed = now_ms()
+    cache.set_many(
+        {
+            COMMIT_CACHE_KEY.format(entry_id=entry_id): committed
+            for entry_id in entry_ids
+        },
+        timeout=COMMIT_STAMP_TIMEOUT,
+    )
+
+
+def _traced_payload(entry, committed):
+    """The entry's payload with its commit time, recording the commit stage."""
+    trace = entry.payload.get("trace")
+    if not trace or committed is None:
+        return entry.payload
+    observe(STAGE_COMMIT, committed - trace["created"])
+    return dict(entry.payload, trace=dict(trace, committed=committed))
+
+
+def _claim(batch_size):
+    """Claim the oldest rows waiting to be published, committing the claim.
+
+    Other dispatchers skip claimed rows, so the publish can run outside any
+    transaction without holding row locks or a connection in one.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        entries = list(
+            WorkflowOutbox.objects.select_for_update(skip_locked=True)
+            .filter(delivered_at__isnull=True, failed_at__isnull=True)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+            .order_by("id")[:batch_size]
+        )
+        if entries:
+            WorkflowOutbox.objects.filter(
+                pk__in=[entry.id for entry in entries]
+            ).update(claimed_until=now + timedelta(seconds=CLAIM_SECONDS))
+    return entries
+
+
+def _record_failure(entries, exc):
+    """Count a failed publish against ``entries``, giving up on exhausted ones."""
+    now = timezone.now()
+    failed = []
+    for entry in entries:
+        entry.attempts += 1
+        entry.last_error = str(exc)[:255]
+        entry.claimed_until = None
+        if entry.attempts >= settings.FLOW_OUTBOX_MAX_ATTEMPTS:
+            entry.failed_at = now
+            failed.append(entry.id)
+    WorkflowOutbox.objects.bulk_update(
+        entries, ["attempts", "last_error", "claimed_until", "failed_at"]
+    )
+    logger.warning(
+        "Workflow outbox entries %s-%s failed: %s", entries[0].id, entries[-1].id, exc
+    )
+    if failed:
+        logger.error(
+            "Gave up on workflow outbox entries %s after %s attempts; boards "
+            "that missed them catch up on their next snapshot.",
+            failed,
+            settings.FLOW_OUTBOX_MAX_ATTEMPTS,
+        )
+
+
+def dispatch_pending(batch_size=None):
+    """Publish the oldest undelivered outbox rows and return how many went out.
+
+    The rows are claimed in a short transaction and published outside it, all
+    together, one channel layer message per group. If that fails, every row is
+    retried on the next pass, in the same order; rows that fail
+    FLOW_OUTBOX_MAX_ATTEMPTS times are logged and marked failed.
+    """
+    batch_size = batch_size or settings.FLOW_OUTBOX_BATCH_SIZE
+    entries = _claim(batch_size)
+    if not entries:
+        return 0
+
+    commit_keys = {
+        entry.id: COMMIT_CACHE_KEY.format(entry_id=entry.id) for entry in entries
+    }
+    commits = cache.get_many(commit_keys.values())
+    try:
+        publish_workflow_events(
+            [
+                (
+                    entry.groups,
+                    _traced_payload(entry, commits.get(commit_keys[entry.id])),
+                )
+                for entry in entries
+            ]
+        )
+    except Exception as exc:
+        _record_failure(entries, exc)
+        return 0
+
+    WorkflowOutbox.objects.filter(pk__in=list(commit_keys)).update(
+        delivered_at=timezone.now(), claimed_until=None
+    )
+    cache.delete_many(list(commit_keys.values()))
+    return len(entries)
+
+
+def drain(batch_size=None):
+    batch_size = batch_size or settings.FLOW_OUTBOX_BATCH_SIZE
+    total = 0
+    while True:
+        delivered = dispatch_pending(batch_size)
+        total += delivered
+        if delivered < batch_size:
+            return total
+
+
+def prune_delivered(hours=None):
+    """Delete rows delivered, or given up on, more than ``hours`` ago."""
+    hours = settings.FLOW_OUTBOX_RETENTION_HOURS if hours is None else hours
+    cutoff = timezone.now() - timedelta(hours=hours)
+    deleted, _details = WorkflowOutbox.objects.filter(
+        Q(delivered_at__lt=cutoff) | Q(failed_at__lt=cutoff)
+    ).delete()
+    return deleted
+
+
+class OutboxDispatcher(threading.Thread):
+    """Drains the outbox whenever a commit queues an event, and on a poll timer.
+
+    Delivered rows are pruned once every PRUNE_INTERVAL_SECONDS.
+    """
+
+    def __init__(self):
+        super().__init__(name="workflow-outbox", daemon=True)
+        self.wakeup = threading.Event()
+        self.last_prune = None
+
+    def run(self):
+        while True:
+            self.wakeup.wait(settings.FLOW_OUTBOX_POLL_SECONDS)
+            self.wakeup.clear()
+            close_old_connections()
+            try:
+                drain()
+                self.prune_if_due()
+            except Exception:
+                logger.exception("Workflow outbox dispatch failed.")
+            finally:
+                close_old_connections()
+
+    def prune_if_due(self):
+        now = time.monotonic()
+        if self.last_prune is None or now - self.last_prune >= PRUNE_INTERVAL_SECONDS:
+            prune_delivered()
+            self.last_prune = now
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_inline_callers = 0
+
+
+@contextmanager
+def dispatch_inline():
+    """Leave queued events to the caller's own ``drain()`` while the block runs.
+
+    Commits anywhere in the process stop waking the dispatcher thread.
+    """
+    global _inline_callers
+
+    with _dispatcher_lock:
+        _inline_callers += 1
+    try:
+        yield
+    finally:
+        with _dispatcher_lock:
+            _inline_callers -= 1
+
+
+def notify_dispatcher():
+    global _dispatcher
+
+    if settings.FLOW_OUTBOX_DISPATCH != "thread":
+        return
+
+    with _dispatcher_lock:
+        if _inline_callers:
+            return
+        if _dispatcher is None:
+            _dispatcher = OutboxDispatcher()
+            _dispatcher.start()
+    _dispatcher.wakeup.set()
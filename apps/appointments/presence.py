@@ -0,0 +1,178 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .realtime import TOPIC_DOCTOR, TOPIC_FRONTDESK, TOPIC_ROOM
+from .rooms import all_rooms
+
+
+PRESENCE_GROUP = "flow.presence"
+PRESENCE_CACHE_KEY = "flow:presence:{board}"
+ROOM_BOARD_PREFIX = "room:"
+
+_last_sweep = None
+
+
+def presence_entry(*, user_id, role, topic, room_code=""):
+    return {"user": user_id, "role": role, "topic": topic, "room": room_code}
+
+
+def presence_board(entry):
+    """The board ``entry`` is counted on: front desk, doctor or one room."""
+    if entry["topic"] in (TOPIC_FRONTDESK, TOPIC_DOCTOR):
+        return entry["topic"]
+    if entry["topic"] == TOPIC_ROOM and entry["room"]:
+        return f"{ROOM_BOARD_PREFIX}{entry['room']}"
+    return None
+
+
+def _live(entries, now):
+    """Entries whose last heartbeat is still within the TTL."""
+    cutoff = now - settings.FLOW_PRESENCE_TTL_SECONDS
+    return {
+        channel_name: entry
+        for channel_name, entry in (entries or {}).items()
+        if entry["seen"] >= cutoff
+    }
+
+
+def _cache_timeout():
+    # Boards outlive their entries' TTL, so a sweep still finds the entries of
+    # sockets that died without leaving and reports them gone.
+    return 2 * settings.FLOW_PRESENCE_TTL_SECONDS
+
+
+def _board_keys():
+    boards = [TOPIC_FRONTDESK, TOPIC_DOCTOR] + [
+        f"{ROOM_BOARD_PREFIX}{room.code}" for room in all_rooms()
+    ]
+    return {board: PRESENCE_CACHE_KEY.format(board=board) for board in boards}
+
+
+def _board_counts(board, entries):
+    """Distinct users on ``board``, shaped like a slice of ``current_counts``."""
+    users = len({entry["user"] for entry in entries.values()})
+    if board.startswith(ROOM_BOARD_PREFIX):
+        return {"rooms": {board[len(ROOM_BOARD_PREFIX) :]: users}}
+    return {board: users}
+
+
+def counts_diff(before, after):
+    """Only the counts that changed; rooms nobody watches any more report 0.
+
+    Either side may hold only some boards; a missing board counts as 0.
+    """
+    diff = {
+        key: after.get(key, 0)
+        for key in ("frontdesk", "doctor")
+        if (key in before or key in after) and before.get(key, 0) != after.get(key, 0)
+    }
+    before_rooms, after_rooms = before.get("rooms", {}), after.get("rooms", {})
+    rooms = {
+        code: after_rooms.get(code, 0)
+        for code in set(before_rooms) | set(after_rooms)
+        if before_rooms.get(code, 0) != after_rooms.get(code, 0)
+    }
+    if rooms:
+        diff["rooms"] = rooms
+    return diff
+
+
+def _update(channel_name, entry, now, *, present):
+    board = presence_board(entry)
+    if board is None:
+        return {}, {}
+    now = time.time() if now is None else now
+    key = PRESENCE_CACHE_KEY.format(board=board)
+    cached = cache.get(key) or {}
+    # Counted with the expired entries, so their expiry is reported as a change.
+    before = _board_counts(board, cached)
+    entries = _live(cached, now)
+    if present:
+        entries[channel_name] = dict(entry, seen=now)
+    else:
+        entries.pop(channel_name, None)
+    cache.set(key, entries, timeout=_cache_timeout())
+    return before, _board_counts(board, entries)
+
+
+def heartbeat(channel_name, entry, now=None):
+    """Record ``channel_name`` as online and return its board's counts before and after.
+
+    Each board has its own cache key, so a heartbeat reads and writes only the
+    sockets on its board. Concurrent writers on one board from different
+    processes can drop each other's entry, which the socket's next heartbeat
+    puts back, so counts may lag by at most one heartbeat interval.
+    """
+    return _update(channel_name, entry, now, present=True)
+
+
+def leave(channel_name, entry, now=None):
+    """Drop ``channel_name`` from the board of ``entry``; returns like ``heartbeat``."""
+    return _update(channel_name, entry, now, present=False)
+
+
+def sweep_expired(now=None):
+    """Drop expired entries from every board; returns counts like ``heartbeat``.
+
+    Only the boards that lost an entry are reported, so a socket that died
+    without leaving still reaches the other boards as a diff, even when nobody
+    else heartbeats on its board.
+    """
+    now = time.time() if now is None else now
+    keys = _board_keys()
+    cached = cache.get_many(keys.values())
+    before, after, swept = {"rooms": {}}, {"rooms": {}}, {}
+    for board, key in keys.items():
+        entries = cached.get(key)
+        if not entries:
+            continue
+        live = _live(entries, now)
+        if len(live) == len(entries):
+            continue
+        swept[key] = live
+        for counts, board_entries in ((before, entries), (after, live)):
+            board_counts = _board_counts(board, board_entries)
+            counts["rooms"].update(board_counts.pop("rooms", {}))
+            counts.update(board_counts)
+    if swept:
+        cache.set_many(swept, timeout=_cache_timeout())
+    return before, after
+
+
+def sweep_if_due(now=None):
+    """``sweep_expired``, at most once per heartbeat interval in this process."""
+    global _last_sweep
+
+    due = time.monotonic()
+    if (
+        _last_sweep is not None
+        and due - _last_sweep < settings.FLOW_PRESENCE_HEARTBEAT_SECONDS
+    ):
+        return {}, {}
+    _last_sweep = due
+    return sweep_expired(now)
+
+
+def current_counts(now=None):
+    """Online counts for the front desk, doctor and every room board."""
+    now = time.time() if now is None else now
+    keys = _board_keys()
+    cached = cache.get_many(keys.values())
+    counts = {"frontdesk": 0, "doctor": 0, "rooms": {}}
+    for board, key in keys.items():
+        board_counts = _board_counts(board, _live(cached.get(key), now))
+        for code, users in board_counts.pop("rooms", {}).items():
+            if users:
+                counts["rooms"][code] = users
+        counts.update(board_counts)
+    return counts
+
+
+def presence_frame(counts, *, full=False):
+    frame = {"type": "presence", "full": full, "counts": counts}
+    if full:
+        frame["heartbeat"] = settings.FLOW_PRESENCE_HEARTBEAT_SECONDS
+    return json.dumps(frame, separators=(",", ":"))
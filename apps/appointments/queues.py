@@ -0,0 +1,351 @@
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.utils import timezone
+
+from .models import Appointment, AppointmentEvent
+
+
+SERVICE_CACHE_KEY = "flow:service:{stage}"
+QUEUE_CACHE_KEY = "flow:queue:{day}:{kind}:{value}"
+
+# Each waiting status and the status of the session it waits for.
+WAITING_STATUSES = {
+    Appointment.STATUS_WAITING_DOCTOR: Appointment.STATUS_WITH_DOCTOR,
+    Appointment.STATUS_WAITING_ROOM: Appointment.STATUS_WITH_ROOM,
+}
+SESSION_STATUSES = set(WAITING_STATUSES.values())
+
+QUEUE_DOCTOR = "doctor"
+QUEUE_ROOM = "room"
+
+# Sessions longer than this were left open by mistake rather than served.
+MAX_SESSION_SECONDS = 4 * 3600
+
+
+def queue_key(status, doctor_id, room_id):
+    """The queue an appointment in ``status`` waits in or is being seen from.
+
+    Each doctor and each room has one; patients checked in while no doctor was
+    on shift share the ``(QUEUE_DOCTOR, None)`` queue.
+    """
+    if status in (Appointment.STATUS_WAITING_DOCTOR, Appointment.STATUS_WITH_DOCTOR):
+        return (QUEUE_DOCTOR, doctor_id)
+    if status in (Appointment.STATUS_WAITING_ROOM, Appointment.STATUS_WITH_ROOM):
+        if room_id is not None:
+            return (QUEUE_ROOM, room_id)
+    return None
+
+
+def _appointment_queue(appointment):
+    return queue_key(
+        appointment.status, appointment.doctor_id, appointment.assigned_room_id
+    )
+
+
+def _stage(key):
+    """Doctors share one service-time stage; every room has its own."""
+    kind, value = key
+    return QUEUE_DOCTOR if kind == QUEUE_DOCTOR else f"{QUEUE_ROOM}:{value}"
+
+
+def _recent_sessions(key):
+    """Lengths in seconds of the stage's latest finished sessions, from events.
+
+    A session runs from the event that started it to the appointment's next
+    event.
+    """
+    kind, room_id = key
+    if kind == QUEUE_DOCTOR:
+        starts = AppointmentEvent.objects.filter(
+            event_type=AppointmentEvent.EVENT_DOCTOR_ACCEPTED
+        )
+    else:
+        starts = AppointmentEvent.objects.filter(
+            event_type=AppointmentEvent.EVENT_ROOM_ACCEPTED, room_id=room_id
+        )
+    next_event = (
+        AppointmentEvent.objects.filter(
+            appointment_id=OuterRef("appointment_id"), id__gt=OuterRef("id")
+        )
+        .order_by("id")
+        .values("created_at")[:1]
+    )
+    rows = (
+        starts.annotate(ended_at=Subquery(next_event))
+        .filter(ended_at__isnull=False)
+        .order_by("-id")
+        .values_list("created_at", "ended_at")[: settings.FLOW_ETA_SEED_SESSIONS]
+    )
+    lengths = [(ended_at - started_at).total_seconds() for started_at, ended_at in rows]
+    return [seconds for seconds in lengths if 0 < seconds <= MAX_SESSION_SECONDS]
+
+
+def service_seconds(key):
+    """Rolling average session length for the queue ``key`` is served by.
+
+    A stage missing from the cache is seeded from its recent sessions, or from
+    FLOW_ETA_DEFAULT_MINUTES when it has none yet.
+    """
+    cache_key = SERVICE_CACHE_KEY.format(stage=_stage(key))
+    average = cache.get(cache_key)
+    if average is None:
+        sessions = _recent_sessions(key)
+        if sessions:
+            average = sum(sessions) / len(sessions)
+        else:
+            average = settings.FLOW_ETA_DEFAULT_MINUTES * 60
+        cache.add(cache_key, average, timeout=None)
+    return average
+
+
+def record_service_time(key, seconds):
+    """Fold one finished session into its stage's rolling average.
+
+    Concurrent writers from different processes can drop each other's sample;
+    an average that misses the odd session is still an estimate.
+    """
+    if not 0 < seconds <= MAX_SESSION_SECONDS:
+        return
+    average = service_seconds(key)
+    average += settings.FLOW_ETA_SMOOTHING * (seconds - average)
+    cache.set(SERVICE_CACHE_KEY.format(stage=_stage(key)), average, timeout=None)
+
+
+def session_ended(*, status, doctor_id, room_id, started_at, ended_at):
+    """Record a session that a transition out of ``status`` just ended.
+
+    The sample is taken once the transaction commits, so a rolled back
+    transition never reaches the averages.
+    """
+    if status not in SESSION_STATUSES:
+        return
+    key = queue_key(status, doctor_id, room_id)
+    if key is None:
+        return
+    seconds = (ended_at - started_at).total_seconds()
+    transaction.on_commit(partial(record_service_time, key, seconds))
+
+
+def _empty_state():
+    return {"waiting": [], "serving": []}
+
+
+def _add(state, appointment_id, status, changed_at):
+    if status in WAITING_STATUSES:
+        state["waiting"].append((changed_at, appointment_id))
+    elif status in SESSION_STATUSES:
+        state["serving"].append((changed_at, appointment_id))
+
+
+def _place(state, appointment_id, status, changed_at):
+    """Put ``appointment_id`` where ``status`` puts it in ``state``, idempotently.
+
+    A ``status`` outside the queue removes it.
+    """
+    for kind in ("waiting", "serving"):
+        state[kind] = [item for item in state[kind] if item[1] != appointment_id]
+    _add(state, appointment_id, status, changed_at)
+    state["waiting"].sort()
+
+
+def _state_estimates(state, average, now):
+    """``[appointment_id, queue_position, eta_minutes]`` for each waiting patient.
+
+    Positions follow the order patients joined the queue; the ETA is the time
+    left in the current session plus an average session for each patient ahead.
+    """
+    remaining = 0
+    if state["serving"]:
+        # The session that started first is the one expected to end first.
+        elapsed = (now - min(state["serving"])[0]).total_seconds()
+        remaining = max(average - elapsed, 0)
+    return [
+        [appointment_id, position, round((remaining + (position - 1) * average) / 60)]
+        for position, (_changed_at, appointment_id) in enumerate(
+            state["waiting"], start=1
+        )
+    ]
+
+
+def queue_estimates(appointments, now=None):
+    """Queue position and ETA of each waiting appointment in ``appointments``.
+
+    Every queue present must be complete, waiting and in session, for its day,
+    as a board's rows provide.
+
+    Returns ``{appointment_id: (queue_position, eta_minutes)}``.
+    """
+    now = now or timezone.now()
+    states = {}
+    for appointment in appointments:
+        key = _appointment_queue(appointment)
+        if key is not None:
+            day_key = (timezone.localdate(appointment.scheduled_at), key)
+            _add(
+                states.setdefault(day_key, _empty_state()),
+                appointment.id,
+                appointment.status,
+                appointment.status_changed_at,
+            )
+
+    estimates = {}
+    averages = {}
+    for (_day, key), state in states.items():
+        if key not in averages:
+            averages[key] = service_seconds(key)
+        state["waiting"].sort()
+        for appointment_id, position, eta in _state_estimates(
+            state, averages[key], now
+        ):
+            estimates[appointment_id] = (position, eta)
+    return estimates
+
+
+def _state_cache_key(day_key):
+    day, (kind, value) = day_key
+    return QUEUE_CACHE_KEY.format(day=day.isoformat(), kind=kind, value=value)
+
+
+def _queue_condition(day, key):
+    kind, value = key
+    if kind == QUEUE_DOCTOR:
+        queue = Q(
+            status__in=[
+                Appointment.STATUS_WAITING_DOCTOR,
+                Appointment.STATUS_WITH_DOCTOR,
+            ]
+        )
+        queue &= Q(doctor__isnull=True) if value is None else Q(doctor_id=value)
+    else:
+        queue = Q(
+            status__in=[
+                Appointment.STATUS_WAITING_ROOM,
+                Appointment.STATUS_WITH_ROOM,
+            ],
+            assigned_room_id=value,
+        )
+    return queue & Q(scheduled_at__date=day)
+
+
+def _load_states(day_keys):
+    """Members of each ``(day, queue)`` in ``day_keys``, from the cache.
+
+    Queues missing from the cache are rebuilt together with one query.
+    """
+    cache_keys = {day_key: _state_cache_key(day_key) for day_key in day_keys}
+    cached = cache.get_many(cache_keys.values())
+    states = {}
+    missing = Q()
+    for day_key, cache_key in cache_keys.items():
+        if cache_key in cached:
+            states[day_key] = cached[cache_key]
+        else:
+            states[day_key] = _empty_state()
+            missing |= _queue_condition(*day_key)
+    if missing:
+        rows = Appointment.objects.filter(missing).only(
+            "id",
+            "status",
+            "doctor_id",
+            "assigned_room_id",
+            "scheduled_at",
+            "status_changed_at",
+        )
+        for appointment in rows:
+            day_key = (
+                timezone.localdate(appointment.scheduled_at),
+                _appointment_queue(appointment),
+            )
+            if day_key in states and cache_keys[day_key] not in cached:
+                _add(
+                    states[day_key],
+                    appointment.id,
+                    appointment.status,
+                    appointment.status_changed_at,
+                )
+        for state in states.values():
+            state["waiting"].sort()
+    return states
+
+
+def _store_placements(states, placements):
+    """Apply committed ``placements`` to the cached queues.
+
+    Queues other processes cached meanwhile get the placements applied on top;
+    missing ones take ``states``. A write lost to a concurrent process heals
+    when the queue expires after FLOW_QUEUE_STATE_SECONDS.
+    """
+    cache_keys = {day_key: _state_cache_key(day_key) for day_key in states}
+    cached = cache.get_many(cache_keys.values())
+    updated = {}
+    for day_key, cache_key in cache_keys.items():
+        if cache_key not in cached:
+            cache.add(
+                cache_key, states[day_key], timeout=settings.FLOW_QUEUE_STATE_SECONDS
+            )
+            continue
+        state = cached[cache_key]
+        for placed_key, appointment_id, status, changed_at in placements:
+            if placed_key == day_key:
+                _place(state, appointment_id, status, changed_at)
+        updated[cache_key] = state
+    if updated:
+        cache.set_many(updated, timeout=settings.FLOW_QUEUE_STATE_SECONDS)
+
+
+def touched_queues(appointment, previous_queue):
+    """The ``(day, queue)`` pairs a move out of ``previous_queue`` changed."""
+    day = timezone.localdate(appointment.scheduled_at)
+    return {
+        (day, key)
+        for key in (previous_queue, _appointment_queue(appointment))
+        if key is not None
+    }
+
+
+def queue_updates(moves, now=None):
+    """Fresh estimates for everyone waiting in the queues ``moves`` changed.
+
+    ``moves`` are ``(appointment, previous_queue)`` pairs, ``previous_queue``
+    being the ``queue_key`` the appointment was in before its transition. Each
+    move is applied to the queues held in the cache, and the cache is updated
+    once the transaction commits, so no queue is re-read from the database
+    unless it has expired.
+
+    Returns ``{(day, queue): [[appointment_id, queue_position, eta_minutes]]}``.
+    """
+    placements = []
+    for appointment, previous_queue in moves:
+        day = timezone.localdate(appointment.scheduled_at)
+        current_queue = _appointment_queue(appointment)
+        if previous_queue is not None and previous_queue != current_queue:
+            placements.append(((day, previous_queue), appointment.id, None, None))
+        if current_queue is not None:
+            placements.append(
+                (
+                    (day, current_queue),
+                    appointment.id,
+                    appointment.status,
+                    appointment.status_changed_at,
+                )
+            )
+    if not placements:
+        return {}
+
+    states = _load_states({placement[0] for placement in placements})
+    for day_key, appointment_id, status, changed_at in placements:
+        _place(states[day_key], appointment_id, status, changed_at)
+    transaction.on_commit(partial(_store_placements, states, placements))
+
+    now = now or timezone.now()
+    updates = {}
+    for day_key, state in states.items():
+        updates[day_key] = []
+        if state["waiting"]:
+            average = service_seconds(day_key[1])
+            updates[day_key] = _state_estimates(state, average, now)
+    return updates
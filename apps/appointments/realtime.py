@@ -1,17 +1,188 @@
+import asyncio
+import re
+import threading
+from contextlib import contextmanager
+
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
 from django.utils import timezone
 
+from .codec import encode_frames
+from .metrics import STAGE_DISPATCH, now_ms, observe
+from .models import Appointment
+from .queues import queue_estimates
 
-WORKFLOW_GROUP = "clinicflow.live"
 
+FRONTDESK_GROUP = "flow.frontdesk"
+DOCTOR_GROUP = "flow.doctor"
+# Each doctor's board listens on their own group plus the unassigned one, which
+# carries patients checked in while no doctor was on shift.
+DOCTOR_GROUP_PREFIX = "flow.doctor."
+DOCTOR_UNASSIGNED_GROUP = "flow.doctor.unassigned"
+ROOM_GROUP_PREFIX = "flow.room."
+# Every open flow socket, for control messages such as drain.
+CONTROL_GROUP = "flow.control"
 
-def broadcast_workflow_event(*, appointment, action, actor):
-    channel_layer = get_channel_layer()
-    if channel_layer is None:
+TOPIC_FRONTDESK = "frontdesk"
+TOPIC_DOCTOR = "doctor"
+TOPIC_ROOM = "room"
+
+TOPIC_ROLES = {
+    TOPIC_FRONTDESK: {"receptionist", "admin"},
+    TOPIC_DOCTOR: {"doctor", "admin"},
+    TOPIC_ROOM: {"nurse", "admin"},
+}
+
+DOCTOR_STATUSES = {Appointment.STATUS_WAITING_DOCTOR, Appointment.STATUS_WITH_DOCTOR}
+ROOM_STATUSES = {Appointment.STATUS_WAITING_ROOM, Appointment.STATUS_WITH_ROOM}
+
+SEQUENCE_CACHE_KEY = "flow:seq"
+BUFFER_CACHE_KEY = "flow:event:{slot}"
+
+# Held from numbering an event until it has been sent, so one process never
+# delivers a lower seq after a higher one.
+_publish_lock = threading.Lock()
+# Publishers on other threads hand their sends to the loop serving the boards.
+PUBLISH_TIMEOUT_SECONDS = 30
+_serving_loop = None
+
+_GROUP_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def room_group(room_code):
+    safe_code = _GROUP_UNSAFE_CHARS.sub("_", room_code)
+    return f"{ROOM_GROUP_PREFIX}{safe_code}"
+
+
+def doctor_group(doctor_id):
+    if doctor_id is None:
+        return DOCTOR_UNASSIGNED_GROUP
+    return f"{DOCTOR_GROUP_PREFIX}{doctor_id}"
+
+
+def topic_groups(topic, room_code="", doctor_id=None):
+    """Return the channel groups a board subscribed to ``topic`` listens on.
+
+    A doctor board with ``doctor_id`` follows that doctor's queue; without one
+    (an admin's board) it follows every doctor.
+    """
+    if topic == TOPIC_FRONTDESK:
+        return [FRONTDESK_GROUP]
+    if topic == TOPIC_DOCTOR:
+        if doctor_id is not None:
+            return [doctor_group(doctor_id), DOCTOR_UNASSIGNED_GROUP]
+        return [DOCTOR_GROUP]
+    if topic == TOPIC_ROOM and room_code:
+        return [room_group(room_code)]
+    return []
+
+
+def event_groups(
+    *,
+    status,
+    room_code,
+    previous_status=None,
+    previous_room_code=None,
+    doctor_id=None,
+    previous_doctor_id=None,
+):
+    """Return the groups whose boards show the appointment before or after a change."""
+    groups = [FRONTDESK_GROUP]
+    if status in DOCTOR_STATUSES or previous_status in DOCTOR_STATUSES:
+        groups.append(DOCTOR_GROUP)
+    if previous_status in DOCTOR_STATUSES:
+        groups.append(doctor_group(previous_doctor_id))
+    if status in DOCTOR_STATUSES:
+        group = doctor_group(doctor_id)
+        if group not in groups:
+            groups.append(group)
+    if previous_room_code and previous_status in ROOM_STATUSES:
+        groups.append(room_group(previous_room_code))
+    if room_code and status in ROOM_STATUSES:
+        group = room_group(room_code)
+        if group not in groups:
+            groups.append(group)
+    return groups
+
+
+def current_sequence():
+    return cache.get(SEQUENCE_CACHE_KEY, 0)
+
+
+@contextmanager
+def _sequence_lock():
+    """Serialize sequence numbers across processes when the cache cannot."""
+    if not settings.FLOW_SEQUENCE_LOCK_FILE:
+        yield
         return
 
-    payload = {
+    import fcntl
+
+    with open(settings.FLOW_SEQUENCE_LOCK_FILE, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _increment_sequence():
+    cache.add(SEQUENCE_CACHE_KEY, 0, timeout=None)
+    return cache.incr(SEQUENCE_CACHE_KEY)
+
+
+def next_sequence():
+    with _sequence_lock():
+        return _increment_sequence()
+
+
+def _buffer_key(seq):
+    return BUFFER_CACHE_KEY.format(slot=seq % settings.FLOW_REPLAY_BUFFER_SIZE)
+
+
+def remember_event(seq, groups, payload):
+    cache.set(
+        _buffer_key(seq),
+        {"seq": seq, "groups": groups, "payload": payload},
+        timeout=None,
+    )
+
+
+def events_since(seq, groups):
+    """Return buffered payloads after ``seq`` for ``groups``, oldest first.
+
+    Returns ``None`` when part of the gap has already been overwritten in the
+    ring buffer, so the caller has to fall back to a full refresh.
+    """
+    current = current_sequence()
+    if seq == current:
+        return []
+    if seq > current or current - seq > settings.FLOW_REPLAY_BUFFER_SIZE:
+        return None
+
+    wanted = set(groups)
+    keys = [_buffer_key(item) for item in range(seq + 1, current + 1)]
+    entries = cache.get_many(keys)
+    payloads = []
+    for item, key in zip(range(seq + 1, current + 1), keys):
+        entry = entries.get(key)
+        if entry is None or entry["seq"] != item:
+            return None
+        if wanted.intersection(entry["groups"]):
+            payloads.append(entry["payload"])
+    return payloads
+
+
+def workflow_payload(*, appointment, action, actor, estimate=None, queue_updates=()):
+    """Board row for ``appointment``; ``estimate`` is its ``(queue_position,
+    eta_minutes)`` while it waits, and ``queue_updates`` the fresh
+    ``[appointment_id, queue_position, eta_minutes]`` of the patients waiting in
+    the queues the event changed."""
+    queue_position, eta_minutes = estimate or (None, None)
+    return {
         "appointment_id": appointment.id,
         "patient_id": appointment.patient_id,
         "patient_name": appointment.patient.full_name,
@@ -22,21 +193,178 @@ def broadcast_workflow_event(*, appointment, action, actor):
             "%H:%M"
         ),
         "reason": appointment.reason or "",
+        "room_id": appointment.assigned_room_id,
         "room": appointment.assigned_room.code if appointment.assigned_room else None,
         "room_name": appointment.assigned_room.name
         if appointment.assigned_room
         else None,
+        "doctor_id": appointment.doctor_id,
+        "queue_position": queue_position,
+        "eta_minutes": eta_minutes,
+        "queue_updates": list(queue_updates),
         "actor": actor,
         "timestamp": timezone.now().isoformat(),
     }
 
-    try:
-        async_to_sync(channel_layer.group_send)(
-            WORKFLOW_GROUP,
+
+def board_snapshot(topic, room_code="", doctor_id=None):
+    """Return ``(seq, payloads)`` for every row a board on ``topic`` shows today.
+
+    The sequence is read before the query, so replaying from it afterwards can
+    only repeat events the snapshot already reflects, never skip one.
+    """
+    seq = current_sequence()
+    appointments = Appointment.objects.filter(
+        scheduled_at__date=timezone.localdate()
+    ).select_related("patient", "assigned_room")
+
+    if topic == TOPIC_FRONTDESK:
+        appointments = appointments.exclude(
+            status__in=[Appointment.STATUS_COMPLETED, Appointment.STATUS_CANCELLED]
+        )
+    elif topic == TOPIC_DOCTOR:
+        appointments = appointments.filter(status__in=DOCTOR_STATUSES)
+        if doctor_id is not None:
+            appointments = appointments.filter(
+                Q(doctor_id=doctor_id) | Q(doctor__isnull=True)
+            )
+    elif topic == TOPIC_ROOM and room_code:
+        appointments = appointments.filter(
+            status__in=ROOM_STATUSES, assigned_room__code=room_code
+        )
+    else:
+        return seq, []
+
+    appointments = list(appointments.order_by("scheduled_at", "id"))
+    estimates = queue_estimates(appointments)
+    payloads = [
+        workflow_payload(
+            appointment=appointment,
+            action="snapshot",
+            actor="",
+            estimate=estimates.get(appointment.id),
+        )
+        for appointment in appointments
+    ]
+    return seq, payloads
+
+
+def catch_up(topic, room_code, groups, resume_from, doctor_id=None):
+    """Return what a board needs after (re)subscribing, as ``(snapshot_seq, payloads)``.
+
+    ``snapshot_seq`` is ``None`` when ``payloads`` are the buffered events after
+    ``resume_from``; otherwise the payloads are a full board snapshot.
+    """
+    if resume_from is not None:
+        payloads = events_since(resume_from, groups)
+        if payloads is not None:
+            return None, payloads
+    return board_snapshot(topic, room_code, doctor_id)
+
+
+def remember_serving_loop():
+    """Note the running loop as the one this process serves board sockets on."""
+    global _serving_loop
+    _serving_loop = asyncio.get_running_loop()
+
+
+async def join_topic(
+    channel_layer, channel_name, topic, room_code="", joined=(), doctor_id=None
+):
+    """Move ``channel_name`` from the ``joined`` groups to those of ``topic``."""
+    remember_serving_loop()
+    groups = topic_groups(topic, room_code, doctor_id)
+    for group in joined:
+        if group not in groups:
+            await channel_layer.group_discard(group, channel_name)
+    for group in groups:
+        if group not in joined:
+            await channel_layer.group_add(group, channel_name)
+    return groups
+
+
+def workflow_message(payload):
+    """Channel layer message carrying ``payload`` pre-encoded for each wire format."""
+    return {
+        "type": "workflow_event",
+        "appointment_id": payload["appointment_id"],
+        "seq": payload.get("seq"),
+        "published": (payload.get("trace") or {}).get("published"),
+        "frames": encode_frames(payload),
+    }
+
+
+def workflow_batch_message(messages):
+    """Channel layer message carrying several ``workflow_message``s in seq order."""
+    return {"type": "workflow_events", "events": messages}
+
+
+def publish_workflow_event(groups, payload):
+    """Number ``payload``, buffer it for replay and send it to ``groups``."""
+    publish_workflow_events([(groups, payload)])
+
+
+def publish_workflow_events(events):
+    """Number each ``(groups, payload)`` in ``events``, buffer and send them.
+
+    Each group gets one channel layer message, batching every event bound for
+    it. Numbering and sending happen under one lock, shared across processes
+    when FLOW_SEQUENCE_LOCK_FILE is set, so events go out in seq order.
+    Publishers that share no lock (processes on the Redis layer) can still
+    interleave; boards order events per appointment rather than dropping a
+    late one.
+
+    Channel layer errors propagate so the outbox can retry the delivery.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    with _publish_lock, _sequence_lock():
+        by_group = {}
+        for groups, payload in events:
+            payload = dict(payload, seq=_increment_sequence())
+            trace = payload.get("trace")
+            if trace:
+                payload["trace"] = dict(trace, published=now_ms())
+                if "committed" in trace:
+                    observe(
+                        STAGE_DISPATCH,
+                        payload["trace"]["published"] - trace["committed"],
+                    )
+            remember_event(payload["seq"], groups, payload)
+            message = workflow_message(payload)
+            for group in groups:
+                by_group.setdefault(group, []).append(message)
+
+        _send_to_groups(
+            channel_layer,
             {
-                "type": "workflow_event",
-                "payload": payload,
+                group: messages[0]
+                if len(messages) == 1
+                else workflow_batch_message(messages)
+                for group, messages in by_group.items()
             },
         )
-    except Exception:
+
+
+async def _group_send_all(channel_layer, messages):
+    for group, message in messages.items():
+        await channel_layer.group_send(group, message)
+
+
+def _send_to_groups(channel_layer, messages):
+    """Send each group its message in ``messages`` from synchronous code.
+
+    In a process that serves board sockets, the sends run on the serving loop,
+    so in-process layers wake their receivers on the loop that owns them. A
+    separate process such as ``dispatch_outbox`` uses a loop of its own.
+    """
+    loop = _serving_loop
+    if loop is not None and loop.is_running():
+        future = asyncio.run_coroutine_threadsafe(
+            _group_send_all(channel_layer, messages), loop
+        )
+        future.result(timeout=PUBLISH_TIMEOUT_SECONDS)
         return
+    async_to_sync(_group_send_all)(channel_layer, messages)
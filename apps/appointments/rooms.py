@@ -0,0 +1,87 @@
+import copy
+import threading
+import time
+
+from django.core.cache import cache
+
+from .models import CareRoom
+
+
+ROOMS_VERSION_CACHE_KEY = "rooms:version"
+
+_lock = threading.Lock()
+_registry = None
+
+
+class _Registry:
+    """Every room, loaded at one version, with lookups by id and code.
+
+    The instances are shared by every thread, so lookups hand out copies.
+    """
+
+    def __init__(self, version, rooms):
+        self.version = version
+        self.rooms = rooms
+        self.active = [room for room in rooms if room.is_active]
+        self.by_id = {room.id: room for room in rooms}
+        self.by_code = {room.code: room for room in rooms}
+
+
+def rooms_version():
+    version = cache.get(ROOMS_VERSION_CACHE_KEY)
+    if version is None:
+        # Start from the clock, so a version lost from the cache is never
+        # mistaken for one a process has already loaded.
+        cache.add(ROOMS_VERSION_CACHE_KEY, time.time_ns(), timeout=None)
+        version = cache.get(ROOMS_VERSION_CACHE_KEY)
+    return version
+
+
+def bump_rooms_version():
+    """Make every process reload its rooms on their next lookup."""
+    try:
+        cache.incr(ROOMS_VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(ROOMS_VERSION_CACHE_KEY, time.time_ns(), timeout=None)
+
+
+def _current():
+    """This process's registry, reloaded when the shared version has moved on."""
+    global _registry
+
+    version = rooms_version()
+    registry = _registry
+    if registry is None or registry.version != version:
+        with _lock:
+            registry = _registry
+            if registry is None or registry.version != version:
+                registry = _Registry(version, list(CareRoom.objects.all()))
+                _registry = registry
+    return registry
+
+
+def all_rooms():
+    """Every room, active or not, in display order."""
+    return [copy.copy(room) for room in _current().rooms]
+
+
+def active_rooms():
+    """The rooms patients can be sent to, in display order."""
+    return [copy.copy(room) for room in _current().active]
+
+
+def room_by_id(room_id, active_only=True):
+    try:
+        room = _current().by_id.get(int(room_id))
+    except (TypeError, ValueError):
+        return None
+    if room is None or (active_only and not room.is_active):
+        return None
+    return copy.copy(room)
+
+
+def room_by_code(code, active_only=True):
+    room = _current().by_code.get(code)
+    if room is None or (active_only and not room.is_active):
+        return None
+    return copy.copy(room)
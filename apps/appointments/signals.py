@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import CareRoom
+from .rooms import bump_rooms_version
+
+
+@receiver(post_save, sender=CareRoom)
+@receiver(post_delete, sender=CareRoom)
+def forget_rooms(sender, **kwargs):
+    # Bumped now for the writer's own lookups, and again on commit, since a
+    # process reloading in between would keep the rows from before the change.
+    bump_rooms_version()
+    transaction.on_commit(bump_rooms_version)
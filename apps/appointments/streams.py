@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .codec import WIRE_JSON, snapshot_frame
+from .realtime import catch_up, join_topic
+
+
+KEEPALIVE_SECONDS = 15
+RETRY_MS = 3000
+
+
+def sse_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+
+async def flow_event_stream(topic, room_code="", resume_from=None, doctor_id=None):
+    """Server-Sent Events for a board topic, fed by the flow channel groups.
+
+    Mirrors what ``ClinicFlowConsumer`` sends a JSON socket: a ``snapshot``
+    event, or the missed ``workflow`` events when ``resume_from`` is still
+    buffered, then one ``workflow`` event per broadcast. Event ids are
+    sequence numbers, so the browser's ``Last-Event-ID`` resumes the stream.
+    """
+    channel_layer = get_channel_layer()
+    channel_name = await channel_layer.new_channel()
+    groups = await join_topic(
+        channel_layer, channel_name, topic, room_code, doctor_id=doctor_id
+    )
+    try:
+        yield f"retry: {RETRY_MS}\n\n"
+
+        seq, payloads = await database_sync_to_async(catch_up)(
+            topic, room_code, groups, resume_from, doctor_id
+        )
+        if seq is None:
+            for payload in payloads:
+                yield sse_event("workflow", json.dumps(payload), payload.get("seq"))
+        else:
+            yield sse_event("snapshot", snapshot_frame(seq, payloads, WIRE_JSON), seq)
+
+        while True:
+            try:
+                message = await asyncio.wait_for(
+                    channel_layer.receive(channel_name), KEEPALIVE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # A comment line keeps idle proxies from closing the stream.
+                yield ": keepalive\n\n"
+                continue
+            if message.get("type") == "workflow_event":
+                events = [message]
+            elif message.get("type") == "workflow_events":
+                events = message["events"]
+            else:
+                continue
+            for event in events:
+                yield sse_event(
+                    "workflow", event["frames"][WIRE_JSON], event.get("seq")
+                )
+    finally:
+        for group in groups:
+            await channel_layer.group_discard(group, channel_name)
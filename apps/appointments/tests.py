@@ -1,16 +1,121 @@
+import asyncio
+import json
+import socket
+import tempfile
+import threading
+import time
 from datetime import timedelta
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.test import TestCase
+from django.db import connection, connections
+from django.db.models import F
+from django.test import (
+    Client,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 
-from apps.accounts.models import UserProfile
+from apps.accounts.models import ActionLog, UserProfile
 from apps.patients.models import Patient
 
-from .models import Appointment, AppointmentEvent, CareRoom
-from .workflow import transition_appointment
+from .capacity import all_doctors_busy, doctor_is_busy
+from .codec import COMPACT_SUBPROTOCOL, STATUS_CODES
+from .consumers import (
+    CLOSE_FORBIDDEN,
+    CLOSE_RESYNC,
+    CLOSE_SERVICE_RESTART,
+    ClinicFlowConsumer,
+    _action_executor,
+)
+from .layers import (
+    MAX_DATAGRAM_BYTES,
+    LeanInMemoryChannelLayer,
+    UnixSocketChannelLayer,
+)
+from .management.commands.bench_flow import Command as BenchFlowCommand
+from .metrics import (
+    RESYNC_LAG,
+    RESYNC_QUEUE,
+    STAGE_COMMIT,
+    STAGE_DISPATCH,
+    STAGE_FANOUT,
+    STAGE_RENDER,
+    flow_stats,
+    now_ms,
+    prometheus_text,
+    reset,
+)
+from .models import (
+    Appointment,
+    AppointmentEvent,
+    CareRoom,
+    DoctorCapacity,
+    WorkflowOutbox,
+)
+from .outbox import (
+    OutboxDispatcher,
+    dispatch_inline,
+    dispatch_pending,
+    notify_dispatcher,
+    prune_delivered,
+)
+from .presence import (
+    counts_diff,
+    current_counts,
+    heartbeat,
+    leave,
+    presence_entry,
+    sweep_expired,
+)
+from .queues import (
+    QUEUE_DOCTOR,
+    QUEUE_ROOM,
+    queue_estimates,
+    queue_updates,
+    service_seconds,
+)
+from .realtime import (
+    CONTROL_GROUP,
+    DOCTOR_GROUP,
+    DOCTOR_UNASSIGNED_GROUP,
+    FRONTDESK_GROUP,
+    TOPIC_DOCTOR,
+    board_snapshot,
+    doctor_group,
+    event_groups,
+    events_since,
+    next_sequence,
+    publish_workflow_event,
+    remember_event,
+    remember_serving_loop,
+    room_group,
+    workflow_batch_message,
+    workflow_message,
+)
+from .rooms import active_rooms, bump_rooms_version, room_by_code, room_by_id
+from . import workflow
+from .tokens import FlowTokenAuthMiddleware, connect_token, read_connect_token
+from .workflow import transition_appointment, transition_appointments
+
+
+# Measured at about 13 KB per idle board socket; see `bench_flow --idle`.
+IDLE_SOCKET_BUDGET_BYTES = 15 * 1024
 
 
 class WorkflowTests(TestCase):
@@ -132,6 +237,55 @@ class WorkflowTests(TestCase):
         second_appointment.refresh_from_db()
         self.assertEqual(second_appointment.status, Appointment.STATUS_WAITING_DOCTOR)
 
+    def test_capacity_ledger_follows_the_doctor_session(self):
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="check_in",
+            user=self.receptionist,
+        )
+        self.assertFalse(doctor_is_busy(doctor_id=self.doctor.pk))
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="doctor_accept",
+            user=self.doctor,
+        )
+        self.assertTrue(doctor_is_busy(doctor_id=self.doctor.pk))
+        self.assertEqual(
+            DoctorCapacity.objects.get(doctor=self.doctor).active_appointment_id,
+            self.appointment.id,
+        )
+
+        with self.assertNumQueries(1):
+            doctor_is_busy(doctor_id=self.doctor.pk)
+
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="transfer_to_room",
+            user=self.doctor,
+            room_id=self.room_lab.id,
+        )
+        self.assertFalse(doctor_is_busy(doctor_id=self.doctor.pk))
+        self.assertIsNone(
+            DoctorCapacity.objects.get(doctor=self.doctor).active_appointment_id
+        )
+
+    def test_session_ended_outside_workflow_frees_the_doctor(self):
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="check_in",
+            user=self.receptionist,
+        )
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="doctor_accept",
+            user=self.doctor,
+        )
+        Appointment.objects.filter(pk=self.appointment.id).update(
+            status=Appointment.STATUS_CANCELLED
+        )
+
+        self.assertFalse(doctor_is_busy(doctor_id=self.doctor.pk))
+
     def test_full_doctor_and_room_flow(self):
         transition_appointment(
             appointment_id=self.appointment.id,
@@ -203,6 +357,423 @@ class WorkflowTests(TestCase):
         self.assertEqual(updated.assigned_room_id, self.room_pharm.id)
 
 
+class DoctorQueueTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.receptionist = User.objects.create_user("reception", password="pass1234")
+        self.first_doctor = User.objects.create_user("first", password="pass1234")
+        self.second_doctor = User.objects.create_user("second", password="pass1234")
+        UserProfile.objects.create(user=self.receptionist, role="receptionist")
+        UserProfile.objects.create(user=self.first_doctor, role="doctor")
+        UserProfile.objects.create(user=self.second_doctor, role="doctor")
+        self.appointments = [
+            Appointment.objects.create(
+                patient=Patient.objects.create(
+                    full_name=f"Queue Patient {index}",
+                    phone=f"+25191100000{index}",
+                    sex="F",
+                ),
+                status=Appointment.STATUS_PLANNED,
+            )
+            for index in range(4)
+        ]
+
+    def _transition(self, appointment, action, user):
+        updated, _event = transition_appointment(
+            appointment_id=appointment.id, action=action, user=user
+        )
+        return updated
+
+    def test_check_ins_are_spread_over_the_doctors(self):
+        first = self._transition(self.appointments[0], "check_in", self.receptionist)
+        second = self._transition(self.appointments[1], "check_in", self.receptionist)
+
+        self.assertEqual(
+            {first.doctor_id, second.doctor_id},
+            {self.first_doctor.pk, self.second_doctor.pk},
+        )
+
+    def test_busy_doctor_does_not_pause_the_other_queue(self):
+        first = self._transition(self.appointments[0], "check_in", self.receptionist)
+        doctor = get_user_model().objects.get(pk=first.doctor_id)
+        self._transition(first, "doctor_accept", doctor)
+        self.assertFalse(all_doctors_busy())
+
+        second = self._transition(self.appointments[1], "check_in", self.receptionist)
+        self.assertNotEqual(second.doctor_id, doctor.pk)
+        other = get_user_model().objects.get(pk=second.doctor_id)
+        self._transition(second, "doctor_accept", other)
+
+        self.assertTrue(all_doctors_busy())
+        with self.assertRaises(ValidationError):
+            self._transition(self.appointments[2], "check_in", self.receptionist)
+
+    def test_doctor_board_shows_only_its_own_queue(self):
+        first = self._transition(self.appointments[0], "check_in", self.receptionist)
+        second = self._transition(self.appointments[1], "check_in", self.receptionist)
+        unassigned = self.appointments[2]
+        Appointment.objects.filter(pk=unassigned.pk).update(
+            status=Appointment.STATUS_WAITING_DOCTOR
+        )
+
+        _seq, payloads = board_snapshot(TOPIC_DOCTOR, doctor_id=first.doctor_id)
+        self.assertEqual(
+            {payload["appointment_id"] for payload in payloads},
+            {first.id, unassigned.id},
+        )
+        _seq, payloads = board_snapshot(TOPIC_DOCTOR)
+        self.assertEqual(
+            {payload["appointment_id"] for payload in payloads},
+            {first.id, second.id, unassigned.id},
+        )
+
+
+class BulkTransitionTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.nurse = User.objects.create_user("nurse", password="pass1234")
+        self.doctor = User.objects.create_user("doctor", password="pass1234")
+        UserProfile.objects.create(user=self.nurse, role="nurse")
+        UserProfile.objects.create(user=self.doctor, role="doctor")
+        self.room = CareRoom.objects.create(code="LAB", name="Lab", sort_order=1)
+
+    def _appointments(self, count, status, room=None):
+        return [
+            Appointment.objects.create(
+                patient=Patient.objects.create(
+                    full_name=f"Sweep Patient {index}",
+                    phone=f"+25192200000{index}",
+                    sex="M",
+                ),
+                status=status,
+                assigned_room=room,
+            )
+            for index in range(count)
+        ]
+
+    def test_sweep_reports_failures_without_aborting_the_rest(self):
+        in_room = self._appointments(3, Appointment.STATUS_WITH_ROOM, self.room)
+        waiting = Appointment.objects.create(
+            patient=in_room[0].patient, status=Appointment.STATUS_WAITING_DOCTOR
+        )
+
+        transitioned, failures = transition_appointments(
+            appointment_ids=[item.id for item in in_room] + [waiting.id, 999999],
+            action="complete",
+            user=self.nurse,
+        )
+
+        self.assertEqual(
+            [appointment.id for appointment, _event in transitioned],
+            [item.id for item in in_room],
+        )
+        self.assertEqual(
+            failures,
+            {
+                waiting.id: "Appointment is not in the right state for this action.",
+                999999: "Appointment not found.",
+            },
+        )
+        self.assertEqual(
+            Appointment.objects.filter(status=Appointment.STATUS_COMPLETED).count(), 3
+        )
+        self.assertEqual(AppointmentEvent.objects.count(), 3)
+        self.assertFalse(ActionLog.objects.exists())
+        self.assertEqual(WorkflowOutbox.objects.count(), 3)
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        def sweep(count):
+            appointments = self._appointments(
+                count, Appointment.STATUS_WITH_ROOM, self.room
+            )
+            with CaptureQueriesContext(connection) as queries:
+                transition_appointments(
+                    appointment_ids=[item.id for item in appointments],
+                    action="complete",
+                    user=self.nurse,
+                )
+            Appointment.objects.all().delete()
+            Patient.objects.all().delete()
+            return len(queries)
+
+        self.assertEqual(sweep(2), sweep(6))
+
+    def test_doctor_accepts_only_one_patient_per_batch(self):
+        waiting = self._appointments(2, Appointment.STATUS_WAITING_DOCTOR)
+
+        transitioned, failures = transition_appointments(
+            appointment_ids=[item.id for item in waiting],
+            action="doctor_accept",
+            user=self.doctor,
+        )
+
+        self.assertEqual(len(transitioned), 1)
+        self.assertEqual(list(failures), [waiting[1].id])
+        self.assertTrue(doctor_is_busy(doctor_id=self.doctor.pk))
+
+
+@override_settings(FLOW_TRANSITION_LOCKING="optimistic", FLOW_TRANSITION_RETRIES=2)
+class OptimisticTransitionTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.doctor = User.objects.create_user("doctor", password="pass1234")
+        UserProfile.objects.create(user=self.doctor, role="doctor")
+        self.appointment = Appointment.objects.create(
+            patient=Patient.objects.create(
+                full_name="Swap Patient", phone="+251933000000", sex="F"
+            ),
+            status=Appointment.STATUS_WAITING_DOCTOR,
+        )
+
+    def _accept(self):
+        return transition_appointment(
+            appointment_id=self.appointment.id,
+            action="doctor_accept",
+            user=self.doctor,
+        )
+
+    def _race(self, times):
+        """Bump the appointment's version between the read and the write, as a
+        concurrent transition would, for the first ``times`` attempts."""
+        apply_rule = workflow._apply_rule
+        calls = []
+
+        def racing_apply_rule(appointment, action, destination_room):
+            calls.append(action)
+            if len(calls) <= times:
+                Appointment.objects.filter(pk=appointment.pk).update(
+                    version=F("version") + 1
+                )
+            apply_rule(appointment, action, destination_room)
+
+        return mock.patch.object(workflow, "_apply_rule", racing_apply_rule), calls
+
+    def test_transition_bumps_version_without_locking(self):
+        with CaptureQueriesContext(connection) as queries:
+            appointment, _event = self._accept()
+
+        self.assertFalse(
+            any("FOR UPDATE" in query["sql"] for query in queries.captured_queries)
+        )
+        self.assertEqual(appointment.version, 1)
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, Appointment.STATUS_WITH_DOCTOR)
+        self.assertEqual(self.appointment.version, 1)
+        self.assertEqual(
+            DoctorCapacity.objects.get(doctor=self.doctor).active_appointment_id,
+            self.appointment.id,
+        )
+
+    def test_lost_race_is_retried_from_a_fresh_read(self):
+        race, calls = self._race(times=1)
+        with race:
+            appointment, _event = self._accept()
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(appointment.status, Appointment.STATUS_WITH_DOCTOR)
+        self.assertEqual(AppointmentEvent.objects.count(), 1)
+
+    def test_gives_up_after_the_configured_retries(self):
+        race, calls = self._race(times=3)
+        with race, self.assertRaisesMessage(ValidationError, "Please try again."):
+            self._accept()
+
+        self.assertEqual(len(calls), 3)
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.status, Appointment.STATUS_WAITING_DOCTOR)
+        self.assertFalse(AppointmentEvent.objects.exists())
+        self.assertFalse(
+            DoctorCapacity.objects.filter(active_appointment__isnull=False).exists()
+        )
+
+    @override_settings(FLOW_TRANSITION_LOCKING="lock")
+    def test_locking_transitions_bump_version_too(self):
+        appointment, _event = self._accept()
+        self.assertEqual(appointment.version, 1)
+        self.appointment.refresh_from_db()
+        self.assertEqual(self.appointment.version, 1)
+
+
+class WorkflowOutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.receptionist = User.objects.create_user("reception", password="pass1234")
+        UserProfile.objects.create(user=self.receptionist, role="receptionist")
+        patient = Patient.objects.create(
+            full_name="Outbox Patient",
+            phone="+251911000000",
+            sex="F",
+        )
+        self.appointment = Appointment.objects.create(
+            patient=patient,
+            status=Appointment.STATUS_PLANNED,
+        )
+
+    def _check_in(self):
+        transition_appointment(
+            appointment_id=self.appointment.id,
+            action="check_in",
+            user=self.receptionist,
+        )
+
+    def test_transition_queues_event_for_affected_groups(self):
+        self._check_in()
+
+        entry = WorkflowOutbox.objects.get()
+        self.assertEqual(
+            entry.groups, [FRONTDESK_GROUP, DOCTOR_GROUP, DOCTOR_UNASSIGNED_GROUP]
+        )
+        self.assertEqual(entry.payload["status"], Appointment.STATUS_WAITING_DOCTOR)
+        self.assertIsNone(entry.delivered_at)
+
+    def test_dispatch_marks_rows_delivered(self):
+        self._check_in()
+
+        with mock.patch("apps.appointments.outbox.publish_workflow_events") as publish:
+            self.assertEqual(dispatch_pending(), 1)
+
+        publish.assert_called_once()
+        self.assertIsNotNone(WorkflowOutbox.objects.get().delivered_at)
+
+    def test_dispatch_sends_one_message_per_group(self):
+        self._check_in()
+        WorkflowOutbox.objects.create(
+            groups=[FRONTDESK_GROUP], payload={"appointment_id": 99}
+        )
+
+        with mock.patch("apps.appointments.realtime.get_channel_layer") as layer:
+            layer.return_value.group_send = mock.AsyncMock()
+            self.assertEqual(dispatch_pending(), 2)
+
+        sends = {
+            call.args[0]: call.args[1]
+            for call in layer.return_value.group_send.call_args_list
+        }
+        self.assertEqual(len(layer.return_value.group_send.call_args_list), 3)
+        self.assertEqual(sends[FRONTDESK_GROUP]["type"], "workflow_events")
+        self.assertEqual(
+            [event["appointment_id"] for event in sends[FRONTDESK_GROUP]["events"]],
+            [self.appointment.id, 99],
+        )
+        self.assertEqual(sends[DOCTOR_GROUP]["type"], "workflow_event")
+
+    @override_settings(FLOW_OUTBOX_DISPATCH="command", ACTION_LOG_WRITE="sync")
+    def test_dispatch_records_commit_and_dispatch_latency(self):
+        reset()
+        with self.captureOnCommitCallbacks(execute=True):
+            self._check_in()
+
+        with mock.patch("apps.appointments.realtime.get_channel_layer") as layer:
+            layer.return_value.group_send = mock.AsyncMock()
+            dispatch_pending()
+
+        message = layer.return_value.group_send.call_args.args[1]
+        self.assertIsNotNone(message["published"])
+        latency = flow_stats()["latency_ms"]
+        self.assertEqual(latency[STAGE_COMMIT]["count"], 1)
+        self.assertEqual(latency[STAGE_DISPATCH]["count"], 1)
+
+    def test_failed_publish_is_kept_for_retry(self):
+        self._check_in()
+
+        with mock.patch(
+            "apps.appointments.outbox.publish_workflow_events",
+            side_effect=RuntimeError("layer down"),
+        ), self.assertLogs("apps.appointments.outbox", "WARNING"):
+            self.assertEqual(dispatch_pending(), 0)
+
+        entry = WorkflowOutbox.objects.get()
+        self.assertIsNone(entry.delivered_at)
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.last_error, "layer down")
+        self.assertIsNone(entry.claimed_until)
+
+    def test_rows_are_claimed_and_published_outside_a_transaction(self):
+        self._check_in()
+        savepoints = list(connection.savepoint_ids)
+        seen = {}
+
+        def publish(events):
+            seen["savepoints"] = list(connection.savepoint_ids)
+            seen["claimed_until"] = WorkflowOutbox.objects.get().claimed_until
+
+        with mock.patch(
+            "apps.appointments.outbox.publish_workflow_events", side_effect=publish
+        ):
+            self.assertEqual(dispatch_pending(), 1)
+
+        self.assertEqual(seen["savepoints"], savepoints)
+        self.assertIsNotNone(seen["claimed_until"])
+        self.assertIsNone(WorkflowOutbox.objects.get().claimed_until)
+
+    def test_claimed_rows_wait_until_the_claim_lapses(self):
+        self._check_in()
+        WorkflowOutbox.objects.update(
+            claimed_until=timezone.now() + timedelta(minutes=1)
+        )
+
+        with mock.patch("apps.appointments.outbox.publish_workflow_events") as publish:
+            self.assertEqual(dispatch_pending(), 0)
+            WorkflowOutbox.objects.update(
+                claimed_until=timezone.now() - timedelta(seconds=1)
+            )
+            self.assertEqual(dispatch_pending(), 1)
+
+        publish.assert_called_once()
+
+    @override_settings(FLOW_OUTBOX_MAX_ATTEMPTS=2)
+    def test_rows_out_of_attempts_are_logged_marked_failed_and_pruned(self):
+        self._check_in()
+
+        with mock.patch(
+            "apps.appointments.outbox.publish_workflow_events",
+            side_effect=RuntimeError("layer down"),
+        ) as publish, self.assertLogs("apps.appointments.outbox", "WARNING") as logs:
+            dispatch_pending()
+            dispatch_pending()
+            dispatch_pending()
+
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(
+            [record.levelname for record in logs.records],
+            ["WARNING", "WARNING", "ERROR"],
+        )
+        entry = WorkflowOutbox.objects.get()
+        self.assertEqual(entry.attempts, 2)
+        self.assertIsNotNone(entry.failed_at)
+
+        WorkflowOutbox.objects.update(failed_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(prune_delivered(), 1)
+
+    def test_dispatcher_thread_prunes_delivered_rows_once_per_interval(self):
+        self._check_in()
+        WorkflowOutbox.objects.update(
+            delivered_at=timezone.now() - timedelta(days=30)
+        )
+        dispatcher = OutboxDispatcher()
+
+        dispatcher.prune_if_due()
+        self.assertFalse(WorkflowOutbox.objects.exists())
+
+        with mock.patch("apps.appointments.outbox.prune_delivered") as prune:
+            dispatcher.prune_if_due()
+        prune.assert_not_called()
+
+    @override_settings(FLOW_OUTBOX_DISPATCH="thread")
+    def test_inline_dispatch_leaves_the_dispatcher_thread_asleep(self):
+        # An unstarted dispatcher, so only the wakeup is observed.
+        dispatcher = OutboxDispatcher()
+
+        with mock.patch("apps.appointments.outbox._dispatcher", dispatcher):
+            with dispatch_inline():
+                notify_dispatcher()
+            self.assertFalse(dispatcher.wakeup.is_set())
+
+            notify_dispatcher()
+        self.assertTrue(dispatcher.wakeup.is_set())
+
+
 class FrontdeskIntakeTests(TestCase):
     def setUp(self):
         User = get_user_model()
@@ -246,3 +817,1200 @@ class FrontdeskIntakeTests(TestCase):
 
         appointment = Appointment.objects.get(patient=self.patient)
         self.assertTrue(appointment.reason.startswith("[EMERGENCY]"))
+
+    def test_board_renders_rows_unless_snapshot_boards_is_on(self):
+        appointment = Appointment.objects.create(
+            patient=self.patient, status=Appointment.STATUS_PLANNED
+        )
+        row = f'data-appointment-id="{appointment.id}"'
+        self.client.force_login(self.receptionist)
+
+        response = self.client.get(reverse("appointments:frontdesk_feed"))
+        self.assertContains(response, row)
+
+        with override_settings(FLOW_SNAPSHOT_BOARDS=True):
+            response = self.client.get(reverse("appointments:frontdesk_feed"))
+        self.assertNotContains(response, row)
+
+    def test_board_reads_its_sequence_before_its_rows(self):
+        created = []
+
+        def publish_while_reading_the_sequence():
+            # An event committed just after the sequence was read must still
+            # reach the page, since the socket only replays what follows it.
+            created.append(
+                Appointment.objects.create(
+                    patient=self.patient, status=Appointment.STATUS_PLANNED
+                )
+            )
+            return 5
+
+        self.client.force_login(self.receptionist)
+        with mock.patch(
+            "apps.appointments.views.current_sequence",
+            side_effect=publish_while_reading_the_sequence,
+        ):
+            response = self.client.get(reverse("appointments:frontdesk_feed"))
+
+        self.assertEqual(response.context["flow_seq"], 5)
+        self.assertContains(response, f'data-appointment-id="{created[0].id}"')
+
+
+class RoomRegistryTests(TestCase):
+    def setUp(self):
+        self.lab = CareRoom.objects.create(code="LAB", name="Lab", sort_order=2)
+        self.xray = CareRoom.objects.create(code="XRAY", name="X-Ray", sort_order=1)
+
+    def test_lookups_are_served_from_the_registry(self):
+        active_rooms()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(active_rooms(), [self.xray, self.lab])
+            self.assertEqual(room_by_code("LAB"), self.lab)
+            self.assertEqual(room_by_id(str(self.xray.id)), self.xray)
+            self.assertIsNone(room_by_id("not-a-room"))
+
+    def test_saving_or_deleting_a_room_reloads_the_registry(self):
+        active_rooms()
+
+        self.lab.is_active = False
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.lab.save()
+        self.assertIsNone(room_by_code("LAB"))
+        self.assertEqual(room_by_code("LAB", active_only=False).name, "Lab")
+        self.assertEqual(callbacks, [bump_rooms_version])
+
+        self.xray.delete()
+        self.assertEqual(active_rooms(), [])
+
+    def test_lookups_hand_out_copies(self):
+        room = room_by_code("LAB")
+        room.name = "Changed"
+
+        self.assertEqual(room_by_code("LAB").name, "Lab")
+        self.assertEqual(active_rooms()[1].name, "Lab")
+
+
+@override_settings(
+    FLOW_ETA_DEFAULT_MINUTES=10,
+    FLOW_ETA_SMOOTHING=0.5,
+    FLOW_OUTBOX_DISPATCH="command",
+    ACTION_LOG_WRITE="sync",
+)
+class QueueEstimateTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.admin = User.objects.create_user("admin", password="pass1234")
+        self.doctor = User.objects.create_user("doctor", password="pass1234")
+        UserProfile.objects.create(user=self.admin, role="admin")
+        UserProfile.objects.create(user=self.doctor, role="doctor")
+        self.room = CareRoom.objects.create(code="LAB", name="Lab", sort_order=1)
+        self.now = timezone.now()
+
+    def _appointment(self, status, minutes_ago, **fields):
+        return Appointment.objects.create(
+            patient=Patient.objects.create(
+                full_name=f"Queue Patient {minutes_ago}",
+                phone=f"+2519440000{minutes_ago:02d}",
+                sex="M",
+            ),
+            status=status,
+            doctor=self.doctor,
+            status_changed_at=self.now - timedelta(minutes=minutes_ago),
+            **fields,
+        )
+
+    def test_positions_follow_join_order_behind_the_current_session(self):
+        self._appointment(Appointment.STATUS_WITH_DOCTOR, 4)
+        later = self._appointment(Appointment.STATUS_WAITING_DOCTOR, 3)
+        first = self._appointment(Appointment.STATUS_WAITING_DOCTOR, 9)
+        in_room = self._appointment(
+            Appointment.STATUS_WAITING_ROOM, 1, assigned_room=self.room
+        )
+
+        estimates = queue_estimates(Appointment.objects.all(), now=self.now)
+
+        self.assertEqual(
+            estimates, {first.id: (1, 6), later.id: (2, 16), in_room.id: (1, 0)}
+        )
+
+    def test_finished_sessions_update_the_rolling_average(self):
+        key = (QUEUE_DOCTOR, self.doctor.pk)
+        self.assertEqual(service_seconds(key), 600)
+        appointment = self._appointment(Appointment.STATUS_WITH_DOCTOR, 20)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_appointment(
+                appointment_id=appointment.id,
+                action="transfer_to_room",
+                user=self.admin,
+                room_id=self.room.id,
+            )
+
+        self.assertAlmostEqual(service_seconds(key), 900, delta=1)
+
+    def test_average_is_seeded_from_recent_events(self):
+        appointment = self._appointment(Appointment.STATUS_WAITING_ROOM, 0)
+        for event_type, minutes_ago in (
+            (AppointmentEvent.EVENT_ROOM_ACCEPTED, 30),
+            (AppointmentEvent.EVENT_ROOM_TRANSFERRED, 26),
+        ):
+            event = AppointmentEvent.objects.create(
+                appointment=appointment,
+                event_type=event_type,
+                to_status=Appointment.STATUS_WITH_ROOM,
+                room=self.room,
+            )
+            AppointmentEvent.objects.filter(pk=event.pk).update(
+                created_at=self.now - timedelta(minutes=minutes_ago)
+            )
+
+        self.assertEqual(service_seconds((QUEUE_ROOM, self.room.id)), 240)
+
+    def test_broadcast_and_today_api_carry_the_estimate(self):
+        self._appointment(Appointment.STATUS_WAITING_DOCTOR, 5)
+        appointment = self._appointment(Appointment.STATUS_PLANNED, 0)
+
+        transition_appointment(
+            appointment_id=appointment.id,
+            action="check_in",
+            user=self.admin,
+            enforce_doctor_capacity=False,
+        )
+
+        payload = WorkflowOutbox.objects.get().payload
+        self.assertEqual((payload["queue_position"], payload["eta_minutes"]), (2, 10))
+
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse("api-appointments-today"))
+        rows = {row["id"]: row for row in response.json()}
+        self.assertEqual(rows[appointment.id]["queue_position"], 2)
+        self.assertEqual(rows[appointment.id]["eta_minutes"], 10)
+
+    def test_patients_behind_a_moved_one_get_fresh_estimates(self):
+        first = self._appointment(Appointment.STATUS_WAITING_DOCTOR, 9)
+        second = self._appointment(Appointment.STATUS_WAITING_DOCTOR, 3)
+
+        transition_appointment(
+            appointment_id=first.id, action="doctor_accept", user=self.doctor
+        )
+
+        payload = WorkflowOutbox.objects.get().payload
+        self.assertEqual(payload["queue_updates"], [[second.id, 1, 10]])
+        self.assertIsNone(payload["queue_position"])
+
+    def test_committed_moves_keep_the_cached_queue_current(self):
+        waiting = self._appointment(Appointment.STATUS_WAITING_DOCTOR, 5)
+        planned = self._appointment(Appointment.STATUS_PLANNED, 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            transition_appointment(
+                appointment_id=planned.id,
+                action="check_in",
+                user=self.admin,
+                enforce_doctor_capacity=False,
+            )
+
+        planned.refresh_from_db()
+        with self.assertNumQueries(0):
+            updates = queue_updates([(planned, None)])
+        self.assertEqual(
+            list(updates.values()), [[[waiting.id, 1, 0], [planned.id, 2, 10]]]
+        )
+
+    @override_settings(FLOW_SNAPSHOT_BOARDS=False)
+    def test_boards_render_the_estimate(self):
+        self._appointment(Appointment.STATUS_WAITING_DOCTOR, 5)
+
+        self.client.force_login(self.doctor)
+        response = self.client.get(reverse("appointments:doctor_feed"))
+
+        self.assertContains(response, "#1 in queue · about 0 min")
+
+
+class EventRoutingTests(SimpleTestCase):
+    def test_check_in_goes_to_frontdesk_and_doctor(self):
+        groups = event_groups(
+            status=Appointment.STATUS_WAITING_DOCTOR,
+            room_code=None,
+            previous_status=Appointment.STATUS_PLANNED,
+            doctor_id=7,
+        )
+        self.assertEqual(groups, [FRONTDESK_GROUP, DOCTOR_GROUP, doctor_group(7)])
+
+    def test_accept_by_another_doctor_reaches_both_queues(self):
+        groups = event_groups(
+            status=Appointment.STATUS_WITH_DOCTOR,
+            room_code=None,
+            previous_status=Appointment.STATUS_WAITING_DOCTOR,
+            doctor_id=8,
+            previous_doctor_id=7,
+        )
+        self.assertEqual(
+            groups,
+            [FRONTDESK_GROUP, DOCTOR_GROUP, doctor_group(7), doctor_group(8)],
+        )
+
+    def test_room_transfer_reaches_both_rooms_but_not_doctor(self):
+        groups = event_groups(
+            status=Appointment.STATUS_WAITING_ROOM,
+            room_code="PHARM",
+            previous_status=Appointment.STATUS_WITH_ROOM,
+            previous_room_code="LAB",
+        )
+        self.assertEqual(
+            groups, [FRONTDESK_GROUP, room_group("LAB"), room_group("PHARM")]
+        )
+
+    def test_room_group_names_are_sanitized(self):
+        self.assertEqual(room_group("Lab 2/B"), "flow.room.Lab_2_B")
+
+
+@override_settings(FLOW_REPLAY_BUFFER_SIZE=4)
+class ReplayBufferTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _publish(self, group, appointment_id):
+        seq = next_sequence()
+        remember_event(seq, [group], {"appointment_id": appointment_id, "seq": seq})
+        return seq
+
+    def test_replays_only_subscribed_groups_after_sequence(self):
+        first = self._publish(DOCTOR_GROUP, 1)
+        self._publish(room_group("LAB"), 2)
+        self._publish(DOCTOR_GROUP, 3)
+
+        payloads = events_since(first, [DOCTOR_GROUP])
+
+        self.assertEqual([item["appointment_id"] for item in payloads], [3])
+
+    def test_gap_older_than_buffer_requires_resync(self):
+        first = self._publish(DOCTOR_GROUP, 1)
+        for appointment_id in range(2, 7):
+            self._publish(DOCTOR_GROUP, appointment_id)
+
+        self.assertIsNone(events_since(first, [DOCTOR_GROUP]))
+        self.assertEqual(len(events_since(first + 1, [DOCTOR_GROUP])), 4)
+
+    def test_concurrent_publishers_send_in_sequence_order(self):
+        delivered = []
+
+        class SlowLayer:
+            async def group_send(self, group, message):
+                await asyncio.sleep(0.005)
+                delivered.append(message["seq"])
+
+        def publish_some():
+            for appointment_id in range(5):
+                publish_workflow_event(
+                    [DOCTOR_GROUP], {"appointment_id": appointment_id}
+                )
+
+        with mock.patch(
+            "apps.appointments.realtime.get_channel_layer", return_value=SlowLayer()
+        ):
+            threads = [threading.Thread(target=publish_some) for _index in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(delivered, sorted(delivered))
+        self.assertEqual(len(delivered), 15)
+
+    def test_publish_from_another_thread_runs_on_the_serving_loop(self):
+        layer = InMemoryChannelLayer()
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        received = []
+
+        async def serve():
+            remember_serving_loop()
+            channel = await layer.new_channel()
+            await layer.group_add(DOCTOR_GROUP, channel)
+            ready.set()
+            received.append(await asyncio.wait_for(layer.receive(channel), 5))
+
+        with mock.patch("apps.appointments.realtime._serving_loop", None):
+            server = threading.Thread(target=loop.run_until_complete, args=(serve(),))
+            server.start()
+            ready.wait(5)
+            started = time.monotonic()
+            with mock.patch(
+                "apps.appointments.realtime.get_channel_layer", return_value=layer
+            ):
+                publish_workflow_event([DOCTOR_GROUP], {"appointment_id": 7})
+            server.join()
+            loop.close()
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(received[0]["appointment_id"], 7)
+
+
+@override_settings(FLOW_OUTBOX_DISPATCH="command", ACTION_LOG_WRITE="sync")
+class ClinicFlowConsumerTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.nurse = User.objects.create_user("nurse", password="pass1234")
+        self.receptionist = User.objects.create_user("reception", password="pass1234")
+        UserProfile.objects.create(user=self.nurse, role="nurse")
+        UserProfile.objects.create(user=self.receptionist, role="receptionist")
+
+    def _communicator(self, user, query, subprotocols=None):
+        communicator = WebsocketCommunicator(
+            ClinicFlowConsumer.as_asgi(),
+            f"/ws/flow/?{query}",
+            subprotocols=subprotocols,
+        )
+        communicator.scope["user"] = user
+        return communicator
+
+    async def test_room_board_only_receives_its_room_events(self):
+        communicator = self._communicator(self.nurse, "topic=room&room=LAB")
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "snapshot")
+        presence = await communicator.receive_json_from()
+        self.assertEqual(presence["type"], "presence")
+
+        layer = get_channel_layer()
+        await layer.group_send(
+            room_group("PHARM"),
+            workflow_message({"appointment_id": 1}),
+        )
+        await layer.group_send(
+            room_group("LAB"),
+            workflow_message({"appointment_id": 2}),
+        )
+
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["appointment_id"], 2)
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_batched_events_arrive_as_one_coalesced_frame(self):
+        reset()
+        communicator = await self._ready_communicator("topic=room&room=LAB")
+
+        await get_channel_layer().group_send(
+            room_group("LAB"),
+            workflow_batch_message(
+                [
+                    workflow_message({"appointment_id": 1, "seq": 1}),
+                    workflow_message({"appointment_id": 2, "seq": 2}),
+                    workflow_message({"appointment_id": 1, "seq": 3}),
+                ]
+            ),
+        )
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual([event["seq"] for event in frame], [2, 3])
+        self.assertEqual(flow_stats()["counters"]["coalesced"], 1)
+        await communicator.disconnect()
+
+    async def test_topic_requires_matching_role(self):
+        communicator = self._communicator(self.receptionist, "topic=doctor")
+        connected, close_code = await communicator.connect()
+
+        self.assertFalse(connected)
+        self.assertEqual(close_code, CLOSE_FORBIDDEN)
+
+    async def test_resume_replays_missed_events(self):
+        await sync_to_async(remember_event)(
+            await sync_to_async(next_sequence)(),
+            [room_group("LAB")],
+            {"appointment_id": 7, "seq": 1},
+        )
+        communicator = self._communicator(
+            self.nurse, "topic=room&room=LAB&resume_from=0"
+        )
+        await communicator.connect()
+
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["appointment_id"], 7)
+        await communicator.disconnect()
+
+    async def test_batch_mode_merges_updates_into_one_frame(self):
+        communicator = self._communicator(self.nurse, "topic=room&room=LAB&batch=20")
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        layer = get_channel_layer()
+        for appointment_id, status in [(1, "WR"), (2, "WR"), (1, "MR")]:
+            await layer.group_send(
+                room_group("LAB"),
+                workflow_message({"appointment_id": appointment_id, "status": status}),
+            )
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(
+            frame,
+            [
+                {"appointment_id": 2, "status": "WR"},
+                {"appointment_id": 1, "status": "MR"},
+            ],
+        )
+        await communicator.disconnect()
+
+    async def test_compact_subprotocol_sends_positional_rows(self):
+        room = await CareRoom.objects.acreate(code="LAB", name="Lab")
+        communicator = self._communicator(
+            self.nurse, "topic=room&room=LAB", subprotocols=[COMPACT_SUBPROTOCOL]
+        )
+        connected, subprotocol = await communicator.connect()
+        self.assertEqual(subprotocol, COMPACT_SUBPROTOCOL)
+
+        hello = await communicator.receive_json_from()
+        self.assertEqual(hello["type"], "hello")
+        self.assertEqual(hello["rooms"][str(room.id)], ["LAB", "Lab"])
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["rows"], [])
+        await communicator.receive_json_from()
+
+        await get_channel_layer().group_send(
+            room_group("LAB"),
+            workflow_message(
+                {
+                    "seq": 9,
+                    "appointment_id": 3,
+                    "action": "room_accept",
+                    "status": Appointment.STATUS_WITH_ROOM,
+                    "room_id": room.id,
+                    "timestamp": "2026-02-07T10:00:00+00:00",
+                }
+            ),
+        )
+
+        row = await communicator.receive_json_from()
+        self.assertEqual(row[:2], [9, 3])
+        self.assertEqual(STATUS_CODES[row[5]], Appointment.STATUS_WITH_ROOM)
+        self.assertEqual(row[8], room.id)
+        await communicator.disconnect()
+
+    async def test_connect_sends_board_snapshot(self):
+        lab = await CareRoom.objects.acreate(code="LAB", name="Lab")
+        pharmacy = await CareRoom.objects.acreate(code="PHARM", name="Pharmacy")
+        patient = await Patient.objects.acreate(
+            full_name="Snapshot Patient", phone="+251911000111", sex="F"
+        )
+        waiting = await Appointment.objects.acreate(
+            patient=patient, status=Appointment.STATUS_WAITING_ROOM, assigned_room=lab
+        )
+        await Appointment.objects.acreate(
+            patient=patient,
+            status=Appointment.STATUS_WAITING_ROOM,
+            assigned_room=pharmacy,
+        )
+        await sync_to_async(next_sequence)()
+
+        communicator = self._communicator(self.nurse, "topic=room&room=LAB")
+        await communicator.connect()
+
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "snapshot")
+        self.assertEqual(snapshot["seq"], 1)
+        self.assertEqual(
+            [row["appointment_id"] for row in snapshot["rows"]], [waiting.id]
+        )
+        self.assertEqual(snapshot["rows"][0]["room"], "LAB")
+        await communicator.disconnect()
+
+    async def test_resume_outside_buffer_falls_back_to_snapshot(self):
+        communicator = self._communicator(
+            self.nurse, "topic=room&room=LAB&resume_from=5"
+        )
+        await communicator.connect()
+
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "snapshot")
+        self.assertEqual(snapshot["seq"], 0)
+        await communicator.disconnect()
+
+    async def _ready_communicator(self, query):
+        communicator = self._communicator(self.nurse, query)
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        return communicator
+
+    @override_settings(FLOW_MAX_PENDING_EVENTS=2)
+    async def test_overflowing_queue_closes_for_resync(self):
+        reset()
+        communicator = await self._ready_communicator("topic=room&room=LAB&batch=1000")
+
+        layer = get_channel_layer()
+        for appointment_id in (1, 1, 2, 3):
+            await layer.group_send(
+                room_group("LAB"), workflow_message({"appointment_id": appointment_id})
+            )
+
+        closed = await communicator.receive_output()
+        self.assertEqual(closed, {"type": "websocket.close", "code": CLOSE_RESYNC})
+        counters = flow_stats()["counters"]
+        self.assertEqual(counters["coalesced"], 1)
+        self.assertEqual(counters[RESYNC_QUEUE], 1)
+
+    @override_settings(FLOW_MAX_UNACKED_EVENTS=1)
+    async def test_lagging_acks_close_for_resync(self):
+        reset()
+        communicator = await self._ready_communicator("topic=room&room=LAB")
+        await communicator.send_json_to({"type": "ack", "seq": 0})
+
+        layer = get_channel_layer()
+        for seq in (1, 2):
+            await layer.group_send(
+                room_group("LAB"),
+                workflow_message({"appointment_id": seq, "seq": seq}),
+            )
+
+        self.assertEqual((await communicator.receive_json_from())["seq"], 1)
+        self.assertEqual((await communicator.receive_json_from())["seq"], 2)
+        closed = await communicator.receive_output()
+        self.assertEqual(closed["code"], CLOSE_RESYNC)
+        self.assertEqual(flow_stats()["counters"][RESYNC_LAG], 1)
+
+    @override_settings(FLOW_MAX_UNACKED_EVENTS=1)
+    async def test_events_for_other_boards_do_not_count_as_lag(self):
+        reset()
+        communicator = await self._ready_communicator("topic=room&room=LAB")
+        await communicator.send_json_to({"type": "ack", "seq": 0})
+
+        await get_channel_layer().group_send(
+            room_group("LAB"), workflow_message({"appointment_id": 1, "seq": 40})
+        )
+
+        self.assertEqual((await communicator.receive_json_from())["seq"], 40)
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(flow_stats()["counters"].get(RESYNC_LAG, 0), 0)
+        await communicator.disconnect()
+
+    async def test_fanout_and_client_render_latency_are_recorded(self):
+        reset()
+        communicator = await self._ready_communicator("topic=room&room=LAB")
+
+        await get_channel_layer().group_send(
+            room_group("LAB"),
+            workflow_message(
+                {"appointment_id": 1, "seq": 1, "trace": {"published": now_ms()}}
+            ),
+        )
+        await communicator.receive_json_from()
+        await communicator.send_json_to({"type": "ack", "seq": 1, "render": [12, 40]})
+        await communicator.disconnect()
+
+        latency = flow_stats()["latency_ms"]
+        self.assertEqual(latency[STAGE_FANOUT]["count"], 1)
+        self.assertEqual(latency[STAGE_RENDER]["count"], 2)
+        self.assertEqual(latency[STAGE_RENDER]["buckets"]["25"], 1)
+        self.assertIn('stage="render",le="50"} 2', prometheus_text())
+
+    async def test_drain_flushes_queue_then_closes_with_resume_point(self):
+        communicator = await self._ready_communicator("topic=room&room=LAB&batch=1000")
+
+        layer = get_channel_layer()
+        await layer.group_send(
+            room_group("LAB"), workflow_message({"appointment_id": 1, "seq": 7})
+        )
+        await layer.group_send(
+            CONTROL_GROUP,
+            {"type": "flow.drain", "min_delay_ms": 1000, "spread_ms": 0},
+        )
+
+        flushed = await communicator.receive_json_from()
+        self.assertEqual([event["seq"] for event in flushed], [7])
+        drain = await communicator.receive_json_from()
+        self.assertEqual(
+            drain, {"type": "drain", "reconnect_after_ms": 1000, "resume_from": 7}
+        )
+        closed = await communicator.receive_output()
+        self.assertEqual(closed["code"], CLOSE_SERVICE_RESTART)
+
+    def test_drain_command_needs_a_shared_channel_layer(self):
+        with self.assertRaisesMessage(CommandError, "REDIS_URL"):
+            call_command("drain_flow", stdout=StringIO())
+
+    async def test_presence_changes_reach_other_boards_as_diffs(self):
+        frontdesk = self._communicator(self.receptionist, "topic=frontdesk")
+        await frontdesk.connect()
+        await frontdesk.receive_json_from()
+        presence = await frontdesk.receive_json_from()
+        self.assertTrue(presence["full"])
+        self.assertEqual(presence["counts"]["frontdesk"], 1)
+
+        room = self._communicator(self.nurse, "topic=room&room=LAB")
+        await room.connect()
+        joined = await frontdesk.receive_json_from()
+        self.assertEqual(joined["counts"], {"rooms": {"LAB": 1}})
+        self.assertFalse(joined["full"])
+
+        await room.send_json_to({"type": "heartbeat"})
+        await room.disconnect()
+        left = await frontdesk.receive_json_from()
+        self.assertEqual(left["counts"], {"rooms": {"LAB": 0}})
+        self.assertTrue(await frontdesk.receive_nothing())
+        await frontdesk.disconnect()
+
+    async def test_switching_topic_moves_presence_to_the_new_board(self):
+        frontdesk = self._communicator(self.receptionist, "topic=frontdesk")
+        await frontdesk.connect()
+        await frontdesk.receive_json_from()
+        await frontdesk.receive_json_from()
+        room = self._communicator(self.nurse, "topic=room&room=LAB")
+        await room.connect()
+        await frontdesk.receive_json_from()
+        await room.receive_json_from()
+        await room.receive_json_from()
+
+        await room.send_json_to({"type": "subscribe", "topic": "room", "room": "XRAY"})
+        moved = [
+            (await frontdesk.receive_json_from())["counts"],
+            (await frontdesk.receive_json_from())["counts"],
+        ]
+
+        self.assertEqual(moved, [{"rooms": {"LAB": 0}}, {"rooms": {"XRAY": 1}}])
+        await room.disconnect()
+        await frontdesk.disconnect()
+
+    async def test_sockets_that_stop_heartbeating_are_swept(self):
+        doctor = presence_entry(user_id=99, role="doctor", topic="doctor")
+        await sync_to_async(cache.set)(
+            "flow:presence:doctor", {"gone": dict(doctor, seen=time.time())}
+        )
+        frontdesk = self._communicator(self.receptionist, "topic=frontdesk")
+        await frontdesk.connect()
+        await frontdesk.receive_json_from()
+        presence = await frontdesk.receive_json_from()
+        self.assertEqual(presence["counts"]["doctor"], 1)
+        room = self._communicator(self.nurse, "topic=room&room=LAB")
+        await room.connect()
+        await frontdesk.receive_json_from()
+        await room.receive_json_from()
+        await room.receive_json_from()
+
+        # The doctor's socket died without leaving and its TTL has passed.
+        await sync_to_async(cache.set)(
+            "flow:presence:doctor", {"gone": dict(doctor, seen=time.time() - 1000)}
+        )
+        with mock.patch("apps.appointments.presence._last_sweep", None):
+            await room.send_json_to({"type": "heartbeat"})
+            swept = await frontdesk.receive_json_from()
+
+        self.assertEqual(swept["counts"], {"doctor": 0})
+        await room.disconnect()
+        await frontdesk.disconnect()
+
+
+@override_settings(FLOW_OUTBOX_DISPATCH="command", ACTION_LOG_WRITE="sync")
+class FlowTokenAuthTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.nurse = get_user_model().objects.create_user("nurse", password="pass1234")
+        UserProfile.objects.create(user=self.nurse, role="nurse")
+        CareRoom.objects.create(code="LAB", name="Lab")
+
+    def _communicator(self, query, headers=None):
+        return WebsocketCommunicator(
+            FlowTokenAuthMiddleware(ClinicFlowConsumer.as_asgi()),
+            f"/ws/flow/?{query}",
+            headers=headers or [],
+        )
+
+    async def test_valid_token_connects_without_profile_lookup(self):
+        token = await sync_to_async(connect_token)(self.nurse.pk, "nurse")
+        communicator = self._communicator(f"topic=room&room=LAB&token={token}")
+
+        with mock.patch(
+            "apps.appointments.consumers.get_user_role",
+            side_effect=AssertionError("role looked up"),
+        ):
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            snapshot = await communicator.receive_json_from()
+            self.assertEqual(snapshot["type"], "snapshot")
+        await communicator.disconnect()
+
+    async def test_token_of_a_deactivated_account_is_refused(self):
+        token = await sync_to_async(connect_token)(self.nurse.pk, "nurse")
+        self.nurse.is_active = False
+        await self.nurse.asave()
+        communicator = self._communicator(f"topic=room&room=LAB&token={token}")
+
+        connected, _code = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_token_limits_room_boards_to_its_rooms(self):
+        token = await sync_to_async(connect_token)(self.nurse.pk, "nurse")
+        communicator = self._communicator(f"topic=room&room=PHARM&token={token}")
+
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, CLOSE_FORBIDDEN)
+
+    async def test_expired_token_falls_back_to_session_and_is_replaced(self):
+        client = Client()
+        await sync_to_async(client.force_login)(self.nurse)
+        cookie = f"sessionid={client.cookies['sessionid'].value}".encode()
+        communicator = self._communicator(
+            "topic=room&room=LAB&token=expired", headers=[(b"cookie", cookie)]
+        )
+
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "token")
+        claims = read_connect_token(frame["token"])
+        self.assertEqual(
+            claims, {"user_id": self.nurse.pk, "role": "nurse", "rooms": ["LAB"]}
+        )
+        self.assertEqual((await communicator.receive_json_from())["type"], "snapshot")
+        await communicator.disconnect()
+
+
+class LeanInMemoryChannelLayerTests(SimpleTestCase):
+    async def test_waiting_receiver_gets_messages_in_order(self):
+        layer = LeanInMemoryChannelLayer(capacity=2)
+        channel = await layer.new_channel()
+        await layer.group_add(FRONTDESK_GROUP, channel)
+
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        self.assertEqual(layer.channels, {})
+
+        for appointment_id in (1, 2, 3):
+            await layer.group_send(
+                FRONTDESK_GROUP, workflow_message({"appointment_id": appointment_id})
+            )
+        self.assertEqual((await receiving)["appointment_id"], 1)
+        self.assertEqual((await layer.receive(channel))["appointment_id"], 2)
+        # The third message found the channel at capacity and was dropped.
+        await layer.send(channel, {"type": "presence_update"})
+        self.assertEqual((await layer.receive(channel))["type"], "presence_update")
+        self.assertEqual(layer.channels, {})
+        self.assertEqual(layer.waiters, {})
+
+    async def test_send_from_another_thread_wakes_the_receiver(self):
+        layer = LeanInMemoryChannelLayer()
+        channel = await layer.new_channel()
+        await layer.group_add(FRONTDESK_GROUP, channel)
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+
+        def send_from_thread():
+            # Built here, async_to_sync runs group_send on a loop of its own.
+            async_to_sync(layer.group_send)(
+                FRONTDESK_GROUP, workflow_message({"appointment_id": 7})
+            )
+
+        started = time.monotonic()
+        sender = threading.Thread(target=send_from_thread)
+        sender.start()
+        message = await asyncio.wait_for(receiving, 5)
+        sender.join()
+
+        self.assertEqual(message["appointment_id"], 7)
+        self.assertLess(time.monotonic() - started, 1)
+
+    async def test_expired_messages_are_dropped_per_channel(self):
+        layer = LeanInMemoryChannelLayer(expiry=60)
+        idle, busy = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add(FRONTDESK_GROUP, idle)
+        await layer.send(idle, {"type": "presence_update"})
+        await layer.send(busy, {"type": "presence_update"})
+        layer.next_sweep = time.time() + 3600
+
+        later = time.time() + 61
+        with mock.patch("apps.appointments.layers.time.time", return_value=later):
+            await layer.send(busy, {"type": "flow_drain"})
+            self.assertEqual((await layer.receive(busy))["type"], "flow_drain")
+            # Nothing touched the idle channel, so it waits for the sweep.
+            self.assertIn(idle, layer.channels)
+
+            layer.next_sweep = 0
+            await layer.group_send(CONTROL_GROUP, {"type": "flow_drain"})
+
+        self.assertEqual(layer.channels, {})
+        self.assertNotIn(idle, layer.groups.get(FRONTDESK_GROUP, {}))
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        socket_dir = tempfile.TemporaryDirectory(prefix="flow-layer-")
+        self.addCleanup(socket_dir.cleanup)
+        self.sender = UnixSocketChannelLayer(socket_dir=socket_dir.name)
+        self.worker = UnixSocketChannelLayer(socket_dir=socket_dir.name)
+
+    def tearDown(self):
+        async_to_sync(self.sender.close)()
+        async_to_sync(self.worker.close)()
+
+    async def test_group_send_reaches_other_process_members(self):
+        await self.sender.new_channel()
+        channel = await self.worker.new_channel()
+        await self.worker.group_add(FRONTDESK_GROUP, channel)
+
+        await self.sender.group_send(
+            FRONTDESK_GROUP, workflow_message({"appointment_id": 4})
+        )
+
+        message = await asyncio.wait_for(self.worker.receive(channel), timeout=2)
+        self.assertEqual(message["appointment_id"], 4)
+        self.assertEqual(message["frames"]["json"], '{"appointment_id": 4}')
+
+    async def test_send_routes_specific_channel_to_its_process(self):
+        await self.sender.new_channel()
+        channel = await self.worker.new_channel()
+
+        await self.sender.send(channel, {"type": "presence_update", "frame": "{}"})
+
+        message = await asyncio.wait_for(self.worker.receive(channel), timeout=2)
+        self.assertEqual(message["type"], "presence_update")
+
+    async def test_calls_from_another_thread_keep_the_serving_loop(self):
+        channel = await self.worker.new_channel()
+        peer_id = self.worker.peer_id
+        receiving = asyncio.ensure_future(self.worker.receive(channel))
+        await asyncio.sleep(0)
+
+        def join_from_thread():
+            async_to_sync(self.worker.group_add)(FRONTDESK_GROUP, channel)
+
+        await asyncio.to_thread(join_from_thread)
+        await self.sender.group_send(
+            FRONTDESK_GROUP, workflow_message({"appointment_id": 5})
+        )
+
+        message = await asyncio.wait_for(receiving, timeout=2)
+        self.assertEqual(message["appointment_id"], 5)
+        self.assertEqual(self.worker.peer_id, peer_id)
+        self.assertIs(self.worker._loop, asyncio.get_running_loop())
+
+    async def test_messages_larger_than_a_datagram_arrive_whole(self):
+        channel = await self.worker.new_channel()
+        await self.worker.group_add(FRONTDESK_GROUP, channel)
+        note = "x" * (4 * MAX_DATAGRAM_BYTES)
+
+        await self.sender.group_send(
+            FRONTDESK_GROUP, workflow_message({"appointment_id": 6, "note": note})
+        )
+
+        message = await asyncio.wait_for(self.worker.receive(channel), timeout=2)
+        self.assertEqual(message["appointment_id"], 6)
+        self.assertIn(note, message["frames"]["json"])
+
+    async def test_peer_that_cannot_take_a_message_fails_the_send(self):
+        await self.worker.new_channel()
+        sender = mock.Mock()
+        sender.sendto.side_effect = BlockingIOError
+
+        with mock.patch.object(
+            self.sender, "_sender_socket", return_value=sender
+        ), self.assertLogs("apps.appointments.layers", "WARNING"):
+            with self.assertRaises(ChannelFull):
+                await self.sender.group_send(
+                    FRONTDESK_GROUP, workflow_message({"appointment_id": 7})
+                )
+
+    async def test_sockets_of_exited_peers_are_skipped(self):
+        stale = Path(self.sender.socket_dir) / "gone.sock"
+        stale.parent.mkdir(parents=True, exist_ok=True)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as orphan:
+            orphan.bind(str(stale))
+
+        await self.sender.group_send(
+            FRONTDESK_GROUP, workflow_message({"appointment_id": 8})
+        )
+
+        self.assertFalse(stale.exists())
+
+    async def test_unreadable_datagrams_do_not_stop_the_reader(self):
+        channel = await self.worker.new_channel()
+        await self.worker.group_add(FRONTDESK_GROUP, channel)
+
+        with self.assertLogs("apps.appointments.layers", "WARNING"):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as stray:
+                stray.sendto(
+                    b"not json", str(self.worker._socket_path(self.worker.peer_id))
+                )
+            await asyncio.sleep(0.05)
+        await self.sender.group_send(
+            FRONTDESK_GROUP, workflow_message({"appointment_id": 9})
+        )
+
+        message = await asyncio.wait_for(self.worker.receive(channel), timeout=2)
+        self.assertEqual(message["appointment_id"], 9)
+
+
+@override_settings(FLOW_OUTBOX_DISPATCH="command", ACTION_LOG_WRITE="sync")
+class FlowStreamTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.nurse = User.objects.create_user("nurse", password="pass1234")
+        UserProfile.objects.create(user=self.nurse, role="nurse")
+
+    async def test_stream_sends_snapshot_then_workflow_events(self):
+        await self.async_client.aforce_login(self.nurse)
+        response = await self.async_client.get(
+            reverse("flow-stream"), {"topic": "room", "room": "LAB"}
+        )
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+
+        self.assertEqual(await anext(chunks), b"retry: 3000\n\n")
+        snapshot = (await anext(chunks)).decode()
+        self.assertTrue(snapshot.startswith("id: 0\nevent: snapshot\n"))
+
+        await get_channel_layer().group_send(
+            room_group("LAB"), workflow_message({"appointment_id": 5, "seq": 1})
+        )
+        self.assertEqual(
+            await anext(chunks),
+            b'id: 1\nevent: workflow\ndata: {"appointment_id": 5, "seq": 1}\n\n',
+        )
+        await chunks.aclose()
+
+    async def test_last_event_id_replays_missed_events(self):
+        await sync_to_async(remember_event)(
+            await sync_to_async(next_sequence)(),
+            [room_group("LAB")],
+            {"appointment_id": 8, "seq": 1},
+        )
+        await self.async_client.aforce_login(self.nurse)
+        response = await self.async_client.get(
+            reverse("flow-stream"),
+            {"topic": "room", "room": "LAB"},
+            headers={"Last-Event-ID": "0"},
+        )
+        chunks = aiter(response.streaming_content)
+
+        await anext(chunks)
+        self.assertIn(b'"appointment_id": 8', await anext(chunks))
+        await chunks.aclose()
+
+    async def test_stream_requires_topic_role(self):
+        await self.async_client.aforce_login(self.nurse)
+        response = await self.async_client.get(
+            reverse("flow-stream"), {"topic": "frontdesk"}
+        )
+
+        self.assertEqual(response.status_code, 403)
+
+
+class PresenceRegistryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        CareRoom.objects.create(code="LAB", name="Lab", sort_order=1)
+
+    def _nurse_entry(self, user_id=1):
+        return presence_entry(
+            user_id=user_id, role="nurse", topic="room", room_code="LAB"
+        )
+
+    def test_counts_distinct_users_per_board(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+        heartbeat("b", self._nurse_entry(), now=100)
+        before, after = heartbeat(
+            "c", presence_entry(user_id=2, role="doctor", topic="doctor"), now=100
+        )
+
+        self.assertEqual(after, {"doctor": 1})
+        self.assertEqual(counts_diff(before, after), {"doctor": 1})
+        self.assertEqual(
+            current_counts(now=100),
+            {"frontdesk": 0, "doctor": 1, "rooms": {"LAB": 1}},
+        )
+
+    @override_settings(FLOW_PRESENCE_TTL_SECONDS=30)
+    def test_missed_heartbeats_expire(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+        heartbeat(
+            "b", presence_entry(user_id=2, role="doctor", topic="doctor"), now=140
+        )
+
+        self.assertEqual(
+            current_counts(now=140), {"frontdesk": 0, "doctor": 1, "rooms": {}}
+        )
+        self.assertEqual(current_counts(now=180)["doctor"], 0)
+
+    @override_settings(FLOW_PRESENCE_TTL_SECONDS=30)
+    def test_heartbeat_reports_entries_that_expired_on_its_board(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+        heartbeat("b", self._nurse_entry(user_id=2), now=120)
+        before, after = heartbeat("b", self._nurse_entry(user_id=2), now=140)
+
+        self.assertEqual(counts_diff(before, after), {"rooms": {"LAB": 1}})
+
+    @override_settings(FLOW_PRESENCE_TTL_SECONDS=30)
+    def test_sweep_reports_boards_whose_only_socket_expired(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+        heartbeat(
+            "b", presence_entry(user_id=2, role="doctor", topic="doctor"), now=140
+        )
+
+        self.assertEqual(counts_diff(*sweep_expired(now=140)), {"rooms": {"LAB": 0}})
+        self.assertEqual(counts_diff(*sweep_expired(now=140)), {})
+
+    def test_leave_reports_empty_room_as_zero(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+        before, after = leave("a", self._nurse_entry(), now=101)
+
+        self.assertEqual(counts_diff(before, after), {"rooms": {"LAB": 0}})
+
+    def test_heartbeat_touches_only_its_board(self):
+        heartbeat("a", self._nurse_entry(), now=100)
+
+        with mock.patch("apps.appointments.presence.cache") as presence_cache:
+            presence_cache.get.return_value = None
+            heartbeat("b", presence_entry(user_id=2, role="doctor", topic="doctor"))
+
+        presence_cache.get.assert_called_once_with("flow:presence:doctor")
+        self.assertEqual(current_counts(now=100)["rooms"], {"LAB": 1})
+
+
+@override_settings(FLOW_OUTBOX_DISPATCH="command", ACTION_LOG_WRITE="sync")
+class SocketActionTests(TransactionTestCase):
+    @classmethod
+    def tearDownClass(cls):
+        # Action threads keep their connections between actions; close each
+        # one's so the test database can be dropped.
+        barrier = threading.Barrier(settings.FLOW_ACTION_WORKERS)
+
+        def close_connections():
+            barrier.wait(timeout=10)
+            connections.close_all()
+
+        for future in [
+            _action_executor.submit(close_connections)
+            for _index in range(settings.FLOW_ACTION_WORKERS)
+        ]:
+            future.result()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        User = get_user_model()
+        self.receptionist = User.objects.create_user("reception", password="pass1234")
+        UserProfile.objects.create(user=self.receptionist, role="receptionist")
+        patient = Patient.objects.create(
+            full_name="Socket Patient",
+            phone="+251911222333",
+            sex="M",
+        )
+        self.appointment = Appointment.objects.create(
+            patient=patient,
+            status=Appointment.STATUS_PLANNED,
+        )
+
+    async def _connect(self):
+        communicator = WebsocketCommunicator(
+            ClinicFlowConsumer.as_asgi(), "/ws/flow/?topic=frontdesk"
+        )
+        communicator.scope["user"] = self.receptionist
+        await communicator.connect()
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["type"], "snapshot")
+        presence = await communicator.receive_json_from()
+        self.assertEqual(presence["type"], "presence")
+        return communicator
+
+    async def test_action_runs_transition_and_acks(self):
+        communicator = await self._connect()
+        await communicator.send_json_to(
+            {"action": "check_in", "appointment_id": self.appointment.id, "ref": 1}
+        )
+
+        reply = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(reply["type"], "ack")
+        self.assertEqual(reply["ref"], 1)
+        self.assertEqual(reply["status"], Appointment.STATUS_WAITING_DOCTOR)
+        await communicator.disconnect()
+
+        await self.appointment.arefresh_from_db()
+        self.assertEqual(self.appointment.status, Appointment.STATUS_WAITING_DOCTOR)
+
+    async def test_rejected_action_replies_with_error(self):
+        communicator = await self._connect()
+        await communicator.send_json_to(
+            {"action": "doctor_accept", "appointment_id": self.appointment.id, "ref": 2}
+        )
+
+        reply = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(reply["type"], "error")
+        self.assertEqual(reply["ref"], 2)
+        await communicator.disconnect()
+
+    async def test_action_from_a_deactivated_or_deleted_account_is_refused(self):
+        communicator = await self._connect()
+        User = get_user_model()
+
+        await User.objects.filter(pk=self.receptionist.pk).aupdate(is_active=False)
+        await communicator.send_json_to(
+            {"action": "check_in", "appointment_id": self.appointment.id, "ref": 3}
+        )
+        reply = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(reply["type"], "error")
+        self.assertEqual(reply["message"], "Your account is no longer active.")
+
+        await User.objects.filter(pk=self.receptionist.pk).adelete()
+        await communicator.send_json_to(
+            {"action": "check_in", "appointment_id": self.appointment.id, "ref": 4}
+        )
+        reply = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(reply["type"], "error")
+        await communicator.disconnect()
+
+        await self.appointment.arefresh_from_db()
+        self.assertEqual(self.appointment.status, Appointment.STATUS_PLANNED)
+
+
+@override_settings(ACTION_LOG_WRITE="sync")
+class BenchFlowCommandTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_reports_every_event_and_cleans_up(self):
+        out = StringIO()
+        call_command("bench_flow", clients="2", transitions=5, stdout=out)
+
+        header, row = out.getvalue().splitlines()
+        self.assertIn("p99 ms", header)
+        columns = row.split()
+        self.assertEqual(columns[:2], ["2", "5"])
+        self.assertEqual(columns[6], "0")
+        self.assertFalse(Appointment.objects.exists())
+        self.assertFalse(get_user_model().objects.exists())
+
+    async def test_events_in_array_frames_are_each_measured(self):
+        sent = timezone.now().isoformat()
+        communicator = mock.Mock()
+        communicator.receive_from = mock.AsyncMock(
+            side_effect=[
+                json.dumps(
+                    [
+                        {"appointment_id": 1, "timestamp": sent},
+                        {"appointment_id": 2, "timestamp": sent},
+                    ]
+                ),
+                json.dumps({"type": "presence", "counts": {}}),
+                json.dumps({"appointment_id": 3, "timestamp": sent}),
+            ]
+        )
+
+        latencies = await BenchFlowCommand()._collect(communicator, 3)
+
+        self.assertEqual(len(latencies), 3)
+
+    def test_idle_socket_memory_stays_within_budget(self):
+        out = StringIO()
+        call_command("bench_flow", idle=100, stdout=out)
+
+        _header, row = out.getvalue().splitlines()
+        idle, per_socket = (int(value) for value in row.split())
+        self.assertEqual(idle, 100)
+        self.assertLess(per_socket, IDLE_SOCKET_BUDGET_BYTES)
+        self.assertFalse(get_user_model().objects.exists())
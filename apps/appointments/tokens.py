@@ -0,0 +1,76 @@
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core import signing
+
+from apps.accounts.permissions import user_is_active
+
+from .realtime import TOPIC_ROLES, TOPIC_ROOM
+from .rooms import active_rooms
+
+
+CONNECT_TOKEN_SALT = "clinicflow.flow-connect"
+
+
+def connect_token(user_id, role):
+    """Signed token that lets a board's socket connect without a session lookup.
+
+    It carries the user id, the role and, for roles that open room boards, the
+    codes of the rooms active when it was issued, so a role or room change is
+    only seen by reconnects once ``FLOW_CONNECT_TOKEN_MAX_AGE_SECONDS`` passes.
+    A deactivated account's token stops working right away.
+    """
+    rooms = None
+    if role in TOPIC_ROLES[TOPIC_ROOM]:
+        rooms = [room.code for room in active_rooms()]
+    return signing.dumps(
+        {"user_id": user_id, "role": role, "rooms": rooms},
+        salt=CONNECT_TOKEN_SALT,
+        compress=True,
+    )
+
+
+def read_connect_token(token):
+    """The claims in ``token``, or ``None`` when it is forged or expired."""
+    try:
+        return signing.loads(
+            token,
+            salt=CONNECT_TOKEN_SALT,
+            max_age=settings.FLOW_CONNECT_TOKEN_MAX_AGE_SECONDS,
+        )
+    except signing.BadSignature:
+        return None
+
+
+class FlowTokenAuthMiddleware:
+    """Authenticate flow sockets from a ``token`` query parameter when present.
+
+    A valid token of an active account puts its claims in ``scope["flow_auth"]``
+    and skips the session and profile queries; whether the account is active is
+    cached per user like roles. Sockets without one, or whose token has expired,
+    go through ``AuthMiddlewareStack`` as before, with ``scope["flow_token_stale"]``
+    set when a token was offered so the consumer can hand out a fresh one.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        params = parse_qs(scope.get("query_string", b"").decode())
+        token = params.get("token", [""])[0]
+        if not token:
+            return await self.session_auth(scope, receive, send)
+
+        claims = read_connect_token(token)
+        if claims is not None and not await database_sync_to_async(user_is_active)(
+            claims["user_id"]
+        ):
+            claims = None
+        if claims is None:
+            return await self.session_auth(
+                dict(scope, flow_token_stale=True), receive, send
+            )
+        return await self.inner(dict(scope, flow_auth=claims), receive, send)
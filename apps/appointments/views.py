@@ -1,18 +1,30 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied, ValidationError
-from django.http import JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.core.handlers.asgi import ASGIRequest
+from django.db.models import Q
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.http import Http404
+from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils import timezone
 from django.views.decorators.http import require_POST
 
+from .capacity import all_doctors_busy, doctor_is_busy, on_shift_doctor_ids
 from .forms import AppointmentForm, FrontdeskIntakeForm
-from .models import Appointment, CareRoom
-from .realtime import broadcast_workflow_event
+from .metrics import flow_stats, prometheus_text
+from .models import Appointment
+from .outbox import broadcast_workflow_event
+from .queues import queue_estimates
+from .realtime import TOPIC_ROLES, current_sequence
+from .rooms import active_rooms, room_by_code
+from .streams import flow_event_stream
+from .tokens import connect_token
 from .workflow import transition_appointment
 from apps.accounts.utils import log_action
-from apps.accounts.permissions import role_home_url, role_required
+from apps.accounts.permissions import get_user_role, role_home_url, role_required
 
 
 def _today_queryset():
@@ -24,16 +36,31 @@ def _today_queryset():
     )
 
 
-def _rooms_queryset():
-    return CareRoom.objects.filter(is_active=True).order_by("sort_order", "name")
+def _live_rows(queryset):
+    """Rows a live board renders server-side; none when it hydrates from a snapshot."""
+    if settings.FLOW_SNAPSHOT_BOARDS:
+        return queryset.none()
+    return queryset
 
 
-def _doctor_busy():
-    today = timezone.localdate()
-    return Appointment.objects.filter(
-        scheduled_at__date=today,
-        status=Appointment.STATUS_WITH_DOCTOR,
-    ).exists()
+def _board_seq():
+    """Sequence the rendered rows reflect; ``None`` asks the socket for a snapshot.
+
+    Read it before any of the board's rows, so replaying from it can only repeat
+    events the page already shows, never skip one.
+    """
+    if settings.FLOW_SNAPSHOT_BOARDS:
+        return None
+    return current_sequence()
+
+
+def _flow_token(request):
+    """Connect token the board page hands to its flow socket."""
+    return connect_token(request.user.pk, get_user_role(request.user))
+
+
+def _rooms_queryset():
+    return active_rooms()
 
 
 def _validation_error_text(error):
@@ -42,6 +69,18 @@ def _validation_error_text(error):
     return str(error)
 
 
+def _with_estimates(*row_lists):
+    """Give every row ``queue_position`` and ``eta_minutes``.
+
+    Together the rows must hold their queues whole, as every board's do.
+    """
+    rows = [item for items in row_lists for item in items]
+    estimates = queue_estimates(rows)
+    for item in rows:
+        item.queue_position, item.eta_minutes = estimates.get(item.id, (None, None))
+    return rows
+
+
 def _frontdesk_queue_counts(appointments):
     return {
         "planned": appointments.filter(status=Appointment.STATUS_PLANNED).count(),
@@ -115,20 +154,27 @@ def appointment_new(request):
 @login_required
 @role_required("receptionist")
 def frontdesk_feed(request):
-    appointments = _today_queryset().exclude(
-        status__in=[Appointment.STATUS_COMPLETED, Appointment.STATUS_CANCELLED]
+    seq = _board_seq()
+    appointments = _live_rows(
+        _today_queryset().exclude(
+            status__in=[Appointment.STATUS_COMPLETED, Appointment.STATUS_CANCELLED]
+        )
     )
-    doctor_busy = _doctor_busy()
+    doctor_busy = all_doctors_busy()
+    doctor_count = len(on_shift_doctor_ids())
     queue_counts = _frontdesk_queue_counts(appointments)
     return render(
         request,
         "appointments/frontdesk_feed.html",
         {
-            "appointments": appointments,
+            "appointments": _with_estimates(appointments),
             "rooms": _rooms_queryset(),
             "intake_form": FrontdeskIntakeForm(),
             "doctor_busy": doctor_busy,
+            "doctor_count": doctor_count,
             "queue_counts": queue_counts,
+            "flow_seq": seq,
+            "flow_token": _flow_token(request),
         },
     )
 
@@ -137,10 +183,14 @@ def frontdesk_feed(request):
 @require_POST
 @role_required("receptionist")
 def frontdesk_intake(request):
-    appointments = _today_queryset().exclude(
-        status__in=[Appointment.STATUS_COMPLETED, Appointment.STATUS_CANCELLED]
+    seq = _board_seq()
+    appointments = _live_rows(
+        _today_queryset().exclude(
+            status__in=[Appointment.STATUS_COMPLETED, Appointment.STATUS_CANCELLED]
+        )
     )
-    doctor_busy = _doctor_busy()
+    doctor_busy = all_doctors_busy()
+    doctor_count = len(on_shift_doctor_ids())
     queue_counts = _frontdesk_queue_counts(appointments)
     intake_form = FrontdeskIntakeForm(request.POST)
     if not intake_form.is_valid():
@@ -149,11 +199,14 @@ def frontdesk_intake(request):
             request,
             "appointments/frontdesk_feed.html",
             {
-                "appointments": appointments,
+                "appointments": _with_estimates(appointments),
                 "rooms": _rooms_queryset(),
                 "intake_form": intake_form,
                 "doctor_busy": doctor_busy,
+                "doctor_count": doctor_count,
                 "queue_counts": queue_counts,
+                "flow_seq": seq,
+                "flow_token": _flow_token(request),
             },
         )
 
@@ -194,7 +247,7 @@ def frontdesk_intake(request):
             request,
             (
                 f"{appointment.patient.full_name} added to waiting list. "
-                "Doctor is currently in session, so check-in is temporarily disabled."
+                "Every doctor is currently in session, so check-in is temporarily disabled."
             ),
         )
         return redirect("appointments:frontdesk_feed")
@@ -231,11 +284,20 @@ def frontdesk_intake(request):
 @login_required
 @role_required("doctor")
 def doctor_feed(request):
-    base = _today_queryset()
-    waiting_doctor = base.filter(status=Appointment.STATUS_WAITING_DOCTOR)
-    with_doctor = base.filter(status=Appointment.STATUS_WITH_DOCTOR)
-    doctor_busy = with_doctor.exists()
-    active_patient = with_doctor.first()
+    seq = _board_seq()
+    base = _live_rows(_today_queryset())
+    # Doctors see their own queue plus unassigned patients; admins see everyone.
+    board_doctor_id = None
+    if get_user_role(request.user) == "doctor":
+        board_doctor_id = request.user.pk
+        base = base.filter(Q(doctor=request.user) | Q(doctor__isnull=True))
+        doctor_busy = doctor_is_busy(doctor_id=board_doctor_id)
+    else:
+        doctor_busy = all_doctors_busy()
+    waiting_doctor = list(base.filter(status=Appointment.STATUS_WAITING_DOCTOR))
+    with_doctor = list(base.filter(status=Appointment.STATUS_WITH_DOCTOR))
+    _with_estimates(waiting_doctor, with_doctor)
+    active_patient = with_doctor[0] if with_doctor else None
     return render(
         request,
         "appointments/doctor_feed.html",
@@ -245,6 +307,10 @@ def doctor_feed(request):
             "active_patient": active_patient,
             "rooms": _rooms_queryset(),
             "doctor_busy": doctor_busy,
+            "board_doctor_id": board_doctor_id,
+            "doctor_count": 1 if board_doctor_id else len(on_shift_doctor_ids()),
+            "flow_seq": seq,
+            "flow_token": _flow_token(request),
         },
     )
 
@@ -252,16 +318,24 @@ def doctor_feed(request):
 @login_required
 @role_required("nurse")
 def room_feed(request, room_code):
-    room = get_object_or_404(CareRoom, code=room_code, is_active=True)
-    base = _today_queryset()
-    waiting_room = base.filter(
-        status=Appointment.STATUS_WAITING_ROOM,
-        assigned_room=room,
+    room = room_by_code(room_code)
+    if room is None:
+        raise Http404("No active room with that code.")
+    seq = _board_seq()
+    base = _live_rows(_today_queryset())
+    waiting_room = list(
+        base.filter(
+            status=Appointment.STATUS_WAITING_ROOM,
+            assigned_room=room,
+        )
     )
-    in_room = base.filter(
-        status=Appointment.STATUS_WITH_ROOM,
-        assigned_room=room,
+    in_room = list(
+        base.filter(
+            status=Appointment.STATUS_WITH_ROOM,
+            assigned_room=room,
+        )
     )
+    _with_estimates(waiting_room, in_room)
     return render(
         request,
         "appointments/room_feed.html",
@@ -269,10 +343,12 @@ def room_feed(request, room_code):
             "room": room,
             "waiting_room": waiting_room,
             "in_room": in_room,
-            "queue_count": waiting_room.count(),
-            "active_count": in_room.count(),
+            "queue_count": len(waiting_room),
+            "active_count": len(in_room),
             "rooms": _rooms_queryset(),
-            "other_rooms": _rooms_queryset().exclude(pk=room.pk),
+            "other_rooms": [item for item in _rooms_queryset() if item.pk != room.pk],
+            "flow_seq": seq,
+            "flow_token": _flow_token(request),
         },
     )
 
@@ -376,21 +452,64 @@ def appointment_complete(request, pk):
 @login_required
 @role_required("admin")
 def api_today_appointments(request):
-    appointments = _today_queryset()
+    appointments = list(_today_queryset())
+    estimates = queue_estimates(appointments)
 
-    payload = [
-        {
-            "id": item.id,
-            "patient_id": item.patient_id,
-            "patient_name": item.patient.full_name,
-            "scheduled_at": timezone.localtime(item.scheduled_at).isoformat(),
-            "duration_minutes": item.duration_minutes,
-            "reason": item.reason,
-            "status": item.status,
-            "status_label": item.get_status_display(),
-            "room": item.assigned_room.code if item.assigned_room else None,
-            "room_name": item.assigned_room.name if item.assigned_room else None,
-        }
-        for item in appointments
-    ]
+    payload = []
+    for item in appointments:
+        queue_position, eta_minutes = estimates.get(item.id, (None, None))
+        payload.append(
+            {
+                "id": item.id,
+                "patient_id": item.patient_id,
+                "patient_name": item.patient.full_name,
+                "scheduled_at": timezone.localtime(item.scheduled_at).isoformat(),
+                "duration_minutes": item.duration_minutes,
+                "reason": item.reason,
+                "status": item.status,
+                "status_label": item.get_status_display(),
+                "room": item.assigned_room.code if item.assigned_room else None,
+                "room_name": item.assigned_room.name if item.assigned_room else None,
+                "queue_position": queue_position,
+                "eta_minutes": eta_minutes,
+            }
+        )
     return JsonResponse(payload, safe=False)
+
+
+@login_required
+@role_required("admin")
+def api_flow_stats(request):
+    if request.GET.get("format") == "prometheus":
+        return HttpResponse(prometheus_text(), content_type="text/plain; version=0.0.4")
+    return JsonResponse(flow_stats())
+
+
+@login_required
+async def flow_stream(request):
+    """Server-Sent Events version of the flow socket for read-only screens."""
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse("The live stream needs the ASGI server.", status=501)
+
+    topic = request.GET.get("topic", "")
+    room_code = request.GET.get("room", "")
+    user = await request.auser()
+    role = await sync_to_async(get_user_role)(user)
+    if role not in TOPIC_ROLES.get(topic, set()):
+        return HttpResponse("Stream not allowed.", status=403)
+
+    resume_from = request.headers.get("Last-Event-ID") or request.GET.get(
+        "resume_from", ""
+    )
+    response = StreamingHttpResponse(
+        flow_event_stream(
+            topic,
+            room_code,
+            int(resume_from) if resume_from.isdigit() else None,
+            doctor_id=user.pk if role == "doctor" else None,
+        ),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
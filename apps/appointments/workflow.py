@@ -1,12 +1,22 @@
+from django.conf import settings
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 
-from apps.accounts.models import UserProfile
-from apps.accounts.utils import log_action
+from apps.accounts.permissions import get_user_role
 
-from .models import Appointment, AppointmentEvent, CareRoom
-from .realtime import broadcast_workflow_event
+from .capacity import (
+    doctor_capacities,
+    doctor_is_busy,
+    lock_doctor_capacities,
+    route_check_in,
+    route_check_ins,
+)
+from .models import Appointment, AppointmentEvent, DoctorCapacity
+from .outbox import broadcast_workflow_event, broadcast_workflow_events
+from .queues import session_ended
+from .rooms import room_by_id
 
 
 ACTION_RULES = {
@@ -59,65 +69,117 @@ ACTION_TO_EVENT = {
 }
 
 
-ACTION_TO_LOG = {
-    "check_in": "checked_in",
-    "doctor_accept": "doctor_accepted",
-    "transfer_to_room": "transferred_to_room",
-    "room_accept": "room_accepted",
-    "room_transfer": "room_transferred",
-    "complete": "completed_appointment",
-}
+def _assert_permission(user, action):
+    rule = ACTION_RULES[action]
+    role = get_user_role(user)
+    if role not in rule["roles"]:
+        raise PermissionDenied("You do not have permission for this action.")
 
 
-def _resolve_role(user):
-    if not user.is_authenticated:
-        return ""
-    if user.is_superuser:
-        return "admin"
+def _accepting_doctor_id(appointment, user):
+    """A doctor accepting takes the patient over; an admin accepts on behalf
+    of the assigned doctor, or for themselves when none is assigned."""
+    if appointment.doctor_id is None or get_user_role(user) == "doctor":
+        return user.pk
+    return appointment.doctor_id
 
-    try:
-        return user.profile.role
-    except UserProfile.DoesNotExist:
-        if user.is_staff:
-            return "receptionist"
-        return ""
 
+def _destination_room(action, room_id):
+    """The active room ``action`` moves the patient to, or ``None`` if it needs none."""
+    if not ACTION_RULES[action]["requires_room"]:
+        return None
+    if not room_id:
+        raise ValidationError("Please choose a destination room.")
 
-def _assert_permission(user, action):
+    destination_room = room_by_id(room_id)
+    if destination_room is None:
+        raise ValidationError("Selected room is not available.")
+    return destination_room
+
+
+def _apply_rule(appointment, action, destination_room):
+    """Check ``action`` against ``ACTION_RULES`` and apply it to ``appointment``.
+
+    Only the in-memory instance changes; callers save it.
+    """
     rule = ACTION_RULES[action]
-    role = _resolve_role(user)
-    if role not in rule["roles"]:
-        raise PermissionDenied("You do not have permission for this action.")
+    if appointment.status not in rule["from"]:
+        raise ValidationError(
+            "Appointment is not in the right state for this action."
+        )
+
+    if rule["requires_room"]:
+        if (
+            action == "room_transfer"
+            and appointment.assigned_room_id == destination_room.id
+        ):
+            raise ValidationError("Choose a different room for transfer.")
+
+        appointment.assigned_room = destination_room
+    elif action in {"check_in", "doctor_accept"}:
+        appointment.assigned_room = None
+
+    if action == "room_accept" and appointment.assigned_room is None:
+        raise ValidationError("No room assigned for this appointment yet.")
+
+    appointment.status = rule["to"]
+
 
+class _StaleRead(Exception):
+    """An optimistic write found its row changed since it was read."""
 
-def _action_description(action, appointment, room):
-    patient_name = appointment.patient.full_name
-    if action == "check_in":
-        return f"Checked in patient: {patient_name}"
-    if action == "doctor_accept":
-        return f"Doctor accepted patient: {patient_name}"
-    if action == "transfer_to_room" and room:
-        return f"Doctor transferred patient to {room.name}: {patient_name}"
-    if action == "room_accept" and appointment.assigned_room:
-        return (
-            f"Room accepted patient in {appointment.assigned_room.name}: {patient_name}"
+
+def _save_transition(appointment, previous_status, previous_version, optimistic):
+    """Write the transitioned fields and bump the version.
+
+    Optimistically, the update only lands while the row still has the version
+    and status that were read; otherwise ``_StaleRead`` is raised.
+    """
+    appointment.version = previous_version + 1
+    if not optimistic:
+        appointment.save(
+            update_fields=[
+                "status",
+                "assigned_room",
+                "doctor",
+                "version",
+                "status_changed_at",
+            ]
         )
-    if action == "room_transfer" and room:
-        return f"Room transferred patient to {room.name}: {patient_name}"
-    if action == "complete":
-        return f"Completed appointment for patient: {patient_name}"
-    return f"Updated appointment for patient: {patient_name}"
-
-
-def _doctor_is_busy(*, exclude_appointment_id=None):
-    today = timezone.localdate()
-    busy_qs = Appointment.objects.filter(
-        status=Appointment.STATUS_WITH_DOCTOR,
-        scheduled_at__date=today,
+        return
+
+    updated = Appointment.objects.filter(
+        pk=appointment.pk, version=previous_version, status=previous_status
+    ).update(
+        status=appointment.status,
+        assigned_room=appointment.assigned_room,
+        doctor=appointment.doctor_id,
+        version=F("version") + 1,
+        status_changed_at=appointment.status_changed_at,
     )
-    if exclude_appointment_id:
-        busy_qs = busy_qs.exclude(pk=exclude_appointment_id)
-    return busy_qs.exists()
+    if not updated:
+        raise _StaleRead
+
+
+def _set_active_appointment(capacity, appointment, optimistic):
+    """Point a doctor's capacity row at ``appointment``, or clear it with ``None``.
+
+    Optimistically, the row only changes while it still points where it did
+    when read; otherwise ``_StaleRead`` is raised.
+    """
+    if not optimistic:
+        capacity.active_appointment = appointment
+        capacity.save(update_fields=["active_appointment", "updated_at"])
+        return
+
+    now = timezone.now()
+    updated = DoctorCapacity.objects.filter(
+        pk=capacity.pk, active_appointment_id=capacity.active_appointment_id
+    ).update(active_appointment=appointment, updated_at=now)
+    if not updated:
+        raise _StaleRead
+    capacity.active_appointment = appointment
+    capacity.updated_at = now
 
 
 def transition_appointment(
@@ -128,60 +190,89 @@ def transition_appointment(
     room_id=None,
     enforce_doctor_capacity=True,
 ):
+    """Apply ``action`` to one appointment and return ``(appointment, event)``.
+
+    With ``FLOW_TRANSITION_LOCKING = "optimistic"`` a transition that lost a
+    race to a concurrent one is retried from a fresh read, up to
+    ``FLOW_TRANSITION_RETRIES`` times.
+    """
     if action not in ACTION_RULES:
         raise ValidationError("Unknown workflow action.")
 
     _assert_permission(user, action)
-    rule = ACTION_RULES[action]
-
-    with transaction.atomic():
-        appointment = (
-            Appointment.objects.select_for_update()
-            .select_related("patient")
-            .get(pk=appointment_id)
-        )
 
-        if (
-            enforce_doctor_capacity
-            and action in {"check_in", "doctor_accept"}
-            and _doctor_is_busy(exclude_appointment_id=appointment.id)
-        ):
-            raise ValidationError(
-                "Doctor is currently with another patient. Please wait until the session is finished."
+    optimistic = settings.FLOW_TRANSITION_LOCKING == "optimistic"
+    attempts = 1 + (settings.FLOW_TRANSITION_RETRIES if optimistic else 0)
+    for _attempt in range(attempts):
+        try:
+            return _transition_once(
+                appointment_id=appointment_id,
+                action=action,
+                user=user,
+                room_id=room_id,
+                enforce_doctor_capacity=enforce_doctor_capacity,
+                optimistic=optimistic,
             )
+        except _StaleRead:
+            continue
+    raise ValidationError(
+        "Appointment was updated by someone else at the same time. Please try again."
+    )
 
-        if appointment.status not in rule["from"]:
-            raise ValidationError(
-                "Appointment is not in the right state for this action."
-            )
-
-        destination_room = None
-        if rule["requires_room"]:
-            if not room_id:
-                raise ValidationError("Please choose a destination room.")
-
-            destination_room = CareRoom.objects.filter(
-                pk=room_id, is_active=True
-            ).first()
-            if destination_room is None:
-                raise ValidationError("Selected room is not available.")
 
-            if (
-                action == "room_transfer"
-                and appointment.assigned_room_id == destination_room.id
+def _transition_once(
+    *, appointment_id, action, user, room_id, enforce_doctor_capacity, optimistic
+):
+    with transaction.atomic():
+        queryset = Appointment.objects.select_related("patient")
+        if not optimistic:
+            queryset = queryset.select_for_update()
+        appointment = queryset.get(pk=appointment_id)
+
+        # Actions that read or change who is with a doctor go through the
+        # doctors' capacity rows. Locking takes them after the appointment row.
+        # Optimistic transitions read them unlocked: accepts and transfers
+        # compare-and-swap the row they change, so a doctor still sees one
+        # patient at a time, but a check-in only reads them and can get past
+        # a doctor who became busy after the read.
+        previous_doctor_id = appointment.doctor_id
+        capacity = None
+        lock = not optimistic
+        if action == "check_in":
+            appointment.doctor_id = route_check_in(
+                enforce_capacity=enforce_doctor_capacity, lock=lock
+            )
+        elif action == "doctor_accept":
+            appointment.doctor_id = _accepting_doctor_id(appointment, user)
+            capacity = doctor_capacities([appointment.doctor_id], lock=lock)[0]
+            if enforce_doctor_capacity and doctor_is_busy(
+                capacity, exclude_appointment_id=appointment.id
             ):
-                raise ValidationError("Choose a different room for transfer.")
-
-            appointment.assigned_room = destination_room
-        elif action in {"check_in", "doctor_accept"}:
-            appointment.assigned_room = None
-
-        if action == "room_accept" and appointment.assigned_room is None:
-            raise ValidationError("No room assigned for this appointment yet.")
+                raise ValidationError(
+                    "Doctor is currently with another patient. Please wait until the session is finished."
+                )
+        elif action == "transfer_to_room" and appointment.doctor_id is not None:
+            capacity = doctor_capacities([appointment.doctor_id], lock=lock)[0]
 
         previous_status = appointment.status
-        appointment.status = rule["to"]
-        appointment.save(update_fields=["status", "assigned_room"])
+        previous_room = appointment.assigned_room
+        previous_changed_at = appointment.status_changed_at
+        destination_room = _destination_room(action, room_id)
+        _apply_rule(appointment, action, destination_room)
+        appointment.status_changed_at = timezone.now()
+        _save_transition(appointment, previous_status, appointment.version, optimistic)
+        session_ended(
+            status=previous_status,
+            doctor_id=previous_doctor_id,
+            room_id=previous_room.id if previous_room else None,
+            started_at=previous_changed_at,
+            ended_at=appointment.status_changed_at,
+        )
+
+        if action == "doctor_accept":
+            _set_active_appointment(capacity, appointment, optimistic)
+        elif capacity is not None and capacity.active_appointment_id == appointment.id:
+            _set_active_appointment(capacity, None, optimistic)
 
         event = AppointmentEvent.objects.create(
             appointment=appointment,
@@ -192,15 +283,208 @@ def transition_appointment(
             performed_by=user,
         )
 
-        log_action(
-            user,
-            action=ACTION_TO_LOG[action],
-            target_type="appointment",
-            target_id=appointment.id,
-            description=_action_description(action, appointment, destination_room),
+        broadcast_workflow_event(
+            appointment=appointment,
+            action=action,
+            actor=user.username,
+            previous_status=previous_status,
+            previous_room=previous_room,
+            previous_doctor_id=previous_doctor_id,
         )
 
-    broadcast_workflow_event(
-        appointment=appointment, action=action, actor=user.username
-    )
     return appointment, event
+
+
+def transition_appointments(
+    *,
+    appointment_ids,
+    action,
+    user,
+    room_id=None,
+    enforce_doctor_capacity=True,
+):
+    """Apply ``action`` to many appointments in one transaction.
+
+    Rows are locked in id order and every item is checked against
+    ``ACTION_RULES`` and the doctor capacity rules as ``transition_appointment``
+    would; items that fail are skipped and reported while the rest go ahead.
+    Appointments, events and broadcasts are each written in bulk. Rows are
+    always locked here, whatever ``FLOW_TRANSITION_LOCKING`` says, since a bulk
+    update cannot compare-and-swap each row; versions are still bumped.
+
+    Returns ``(transitioned, failures)``: ``(appointment, event)`` pairs in id
+    order, and a dict of error messages keyed by appointment id.
+    """
+    if action not in ACTION_RULES:
+        raise ValidationError("Unknown workflow action.")
+
+    _assert_permission(user, action)
+    appointment_ids = sorted(set(appointment_ids))
+    failures = {}
+
+    with transaction.atomic():
+        # Only the appointment rows: PostgreSQL cannot lock the nullable side of
+        # the outer join to the assigned room.
+        appointments = list(
+            Appointment.objects.select_for_update(of=("self",))
+            .select_related("patient", "assigned_room")
+            .filter(pk__in=appointment_ids)
+            .order_by("pk")
+        )
+        found = {appointment.id for appointment in appointments}
+        for appointment_id in appointment_ids:
+            if appointment_id not in found:
+                failures[appointment_id] = "Appointment not found."
+
+        try:
+            destination_room = _destination_room(action, room_id)
+        except ValidationError as exc:
+            for appointment in appointments:
+                failures[appointment.id] = " ".join(exc.messages)
+            appointments = []
+
+        # Capacity rows are locked after the appointment rows, in doctor id
+        # order, as in ``transition_appointment``.
+        if action == "check_in":
+            candidates = [
+                appointment
+                for appointment in appointments
+                if appointment.status in ACTION_RULES[action]["from"]
+            ]
+            try:
+                doctor_ids = route_check_ins(
+                    len(candidates), enforce_capacity=enforce_doctor_capacity
+                )
+            except ValidationError as exc:
+                for appointment in candidates:
+                    failures[appointment.id] = " ".join(exc.messages)
+                appointments = [
+                    appointment
+                    for appointment in appointments
+                    if appointment.id not in failures
+                ]
+                doctor_ids = []
+            routes = dict(
+                zip([appointment.id for appointment in candidates], doctor_ids)
+            )
+        capacities = {}
+        if action == "doctor_accept":
+            capacities = {
+                capacity.doctor_id: capacity
+                for capacity in lock_doctor_capacities(
+                    _accepting_doctor_id(appointment, user)
+                    for appointment in appointments
+                )
+            }
+        elif action == "transfer_to_room":
+            capacities = {
+                capacity.doctor_id: capacity
+                for capacity in lock_doctor_capacities(
+                    appointment.doctor_id
+                    for appointment in appointments
+                    if appointment.doctor_id is not None
+                )
+            }
+
+        now = timezone.now()
+        transitioned = []
+        changed_capacities = []
+        for appointment in appointments:
+            previous = (
+                appointment.status,
+                appointment.assigned_room,
+                appointment.doctor_id,
+                appointment.status_changed_at,
+            )
+            try:
+                capacity = None
+                if action == "check_in":
+                    doctor_id = routes.get(appointment.id)
+                elif action == "doctor_accept":
+                    doctor_id = _accepting_doctor_id(appointment, user)
+                    capacity = capacities[doctor_id]
+                    if enforce_doctor_capacity and doctor_is_busy(
+                        capacity, exclude_appointment_id=appointment.id
+                    ):
+                        raise ValidationError(
+                            "Doctor is currently with another patient. Please wait until the session is finished."
+                        )
+                else:
+                    doctor_id = appointment.doctor_id
+                    capacity = capacities.get(doctor_id)
+                _apply_rule(appointment, action, destination_room)
+            except ValidationError as exc:
+                failures[appointment.id] = " ".join(exc.messages)
+                continue
+
+            appointment.doctor_id = doctor_id
+            appointment.version += 1
+            appointment.status_changed_at = now
+            if action == "doctor_accept":
+                capacity.active_appointment = appointment
+                changed_capacities.append(capacity)
+            elif (
+                capacity is not None
+                and capacity.active_appointment_id == appointment.id
+            ):
+                capacity.active_appointment = None
+                changed_capacities.append(capacity)
+            transitioned.append((appointment, previous))
+
+        if not transitioned:
+            return [], failures
+
+        Appointment.objects.bulk_update(
+            [appointment for appointment, _previous in transitioned],
+            ["status", "assigned_room", "doctor", "version", "status_changed_at"],
+        )
+        for appointment, previous in transitioned:
+            session_ended(
+                status=previous[0],
+                doctor_id=previous[2],
+                room_id=previous[1].id if previous[1] else None,
+                started_at=previous[3],
+                ended_at=now,
+            )
+        if changed_capacities:
+            for capacity in changed_capacities:
+                capacity.updated_at = now
+            DoctorCapacity.objects.bulk_update(
+                set(changed_capacities), ["active_appointment", "updated_at"]
+            )
+
+        events = AppointmentEvent.objects.bulk_create(
+            [
+                AppointmentEvent(
+                    appointment=appointment,
+                    event_type=ACTION_TO_EVENT[action],
+                    from_status=previous[0],
+                    to_status=appointment.status,
+                    room=appointment.assigned_room,
+                    performed_by=user,
+                )
+                for appointment, previous in transitioned
+            ]
+        )
+
+        broadcast_workflow_events(
+            [
+                {
+                    "appointment": appointment,
+                    "action": action,
+                    "actor": user.username,
+                    "previous_status": previous[0],
+                    "previous_room": previous[1],
+                    "previous_doctor_id": previous[2],
+                }
+                for appointment, previous in transitioned
+            ]
+        )
+
+    return (
+        [
+            (appointment, event)
+            for (appointment, _previous), event in zip(transitioned, events)
+        ],
+        failures,
+    )
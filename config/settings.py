@@ -140,6 +140,11 @@ else:
         }
 
 REDIS_URL = os.getenv("REDIS_URL")
+# Without Redis, several worker processes on one host can still share live
+# events through Unix sockets in this directory (and a file cache next to them).
+FLOW_LAYER_SOCKET_DIR = os.getenv("FLOW_LAYER_SOCKET_DIR", "").strip()
+FLOW_SEQUENCE_LOCK_FILE = ""
+
 if REDIS_URL:
     CHANNEL_LAYERS = {
         "default": {
@@ -149,13 +154,111 @@ if REDIS_URL:
             },
         },
     }
+elif FLOW_LAYER_SOCKET_DIR:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "apps.appointments.layers.UnixSocketChannelLayer",
+            "CONFIG": {
+                "socket_dir": FLOW_LAYER_SOCKET_DIR,
+            },
+        },
+    }
 else:
     CHANNEL_LAYERS = {
         "default": {
-            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "BACKEND": "apps.appointments.layers.LeanInMemoryChannelLayer",
         },
     }
 
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        },
+    }
+elif FLOW_LAYER_SOCKET_DIR:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.path.join(FLOW_LAYER_SOCKET_DIR, "cache"),
+        },
+    }
+    # The file cache's incr is not atomic across processes; guard the sequence.
+    FLOW_SEQUENCE_LOCK_FILE = os.path.join(FLOW_LAYER_SOCKET_DIR, "sequence.lock")
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        },
+    }
+
+# Number of recent workflow events kept for reconnecting boards to replay.
+FLOW_REPLAY_BUFFER_SIZE = int(os.getenv("FLOW_REPLAY_BUFFER_SIZE", "500"))
+
+# Workflow broadcasts go through an outbox table. "thread" drains it from a
+# background thread in each web process; "command" leaves it to
+# `python manage.py dispatch_outbox`.
+FLOW_OUTBOX_DISPATCH = os.getenv("FLOW_OUTBOX_DISPATCH", "thread").strip().lower()
+FLOW_OUTBOX_BATCH_SIZE = int(os.getenv("FLOW_OUTBOX_BATCH_SIZE", "100"))
+FLOW_OUTBOX_POLL_SECONDS = float(os.getenv("FLOW_OUTBOX_POLL_SECONDS", "2"))
+FLOW_OUTBOX_MAX_ATTEMPTS = int(os.getenv("FLOW_OUTBOX_MAX_ATTEMPTS", "10"))
+FLOW_OUTBOX_RETENTION_HOURS = int(os.getenv("FLOW_OUTBOX_RETENTION_HOURS", "24"))
+
+# Live boards render their rows server-side. Turn on to render a light shell
+# that hydrates from the socket's snapshot frame instead; a board whose socket
+# cannot connect then stays empty.
+FLOW_SNAPSHOT_BOARDS = env_bool("FLOW_SNAPSHOT_BOARDS", default=False)
+
+# Threads available to workflow actions submitted over the flow socket.
+FLOW_ACTION_WORKERS = int(os.getenv("FLOW_ACTION_WORKERS", "4"))
+
+# A board socket is closed for resync when this many updates are waiting to be
+# sent to it, or when its acks trail the events sent to it by this many.
+FLOW_MAX_PENDING_EVENTS = int(os.getenv("FLOW_MAX_PENDING_EVENTS", "200"))
+FLOW_MAX_UNACKED_EVENTS = int(os.getenv("FLOW_MAX_UNACKED_EVENTS", "500"))
+
+# `manage.py drain_flow` tells boards to reconnect after the minimum delay plus
+# a random share of the spread, so a restart is not met by every board at once.
+FLOW_DRAIN_MIN_SECONDS = float(os.getenv("FLOW_DRAIN_MIN_SECONDS", "5"))
+FLOW_DRAIN_SPREAD_SECONDS = float(os.getenv("FLOW_DRAIN_SPREAD_SECONDS", "30"))
+
+# Board pages embed a signed connect token so sockets skip the session and user
+# queries; an older token falls back to the session and is replaced.
+FLOW_CONNECT_TOKEN_MAX_AGE_SECONDS = int(
+    os.getenv("FLOW_CONNECT_TOKEN_MAX_AGE_SECONDS", "900")
+)
+
+# Workflow transitions lock the appointment and capacity rows they change
+# ("lock"), or read them unlocked and write with a compare-and-swap on the
+# appointment's version ("optimistic"), retrying a lost race up to
+# FLOW_TRANSITION_RETRIES times before asking the user to try again.
+FLOW_TRANSITION_LOCKING = os.getenv("FLOW_TRANSITION_LOCKING", "lock").strip().lower()
+FLOW_TRANSITION_RETRIES = int(os.getenv("FLOW_TRANSITION_RETRIES", "3"))
+
+# Waiting patients get a queue position and an ETA from a rolling average of
+# each stage's session length, seeded from the last FLOW_ETA_SEED_SESSIONS
+# sessions; FLOW_ETA_DEFAULT_MINUTES stands in until a stage has any.
+FLOW_ETA_SMOOTHING = float(os.getenv("FLOW_ETA_SMOOTHING", "0.2"))
+FLOW_ETA_SEED_SESSIONS = int(os.getenv("FLOW_ETA_SEED_SESSIONS", "20"))
+FLOW_ETA_DEFAULT_MINUTES = float(os.getenv("FLOW_ETA_DEFAULT_MINUTES", "15"))
+# Queue members are kept in the cache and updated by each transition; a queue
+# is re-read from the database after FLOW_QUEUE_STATE_SECONDS, healing drift.
+FLOW_QUEUE_STATE_SECONDS = int(os.getenv("FLOW_QUEUE_STATE_SECONDS", "300"))
+
+# Action logs are buffered and written in batches by a background thread, when
+# ACTION_LOG_BATCH_SIZE rows wait or every ACTION_LOG_FLUSH_SECONDS. "sync" saves
+# each entry in the request instead.
+ACTION_LOG_WRITE = os.getenv("ACTION_LOG_WRITE", "buffered").strip().lower()
+ACTION_LOG_BATCH_SIZE = int(os.getenv("ACTION_LOG_BATCH_SIZE", "100"))
+ACTION_LOG_FLUSH_SECONDS = float(os.getenv("ACTION_LOG_FLUSH_SECONDS", "2"))
+ACTION_LOG_MAX_PENDING = int(os.getenv("ACTION_LOG_MAX_PENDING", "10000"))
+
+# Board sockets heartbeat into a cache-held presence registry, one key per
+# board; entries that miss heartbeats for the TTL drop out of the online counts.
+FLOW_PRESENCE_HEARTBEAT_SECONDS = int(os.getenv("FLOW_PRESENCE_HEARTBEAT_SECONDS", "25"))
+FLOW_PRESENCE_TTL_SECONDS = int(os.getenv("FLOW_PRESENCE_TTL_SECONDS", "75"))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -213,3 +316,6 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 LOGIN_URL = "/login/"
 LOGIN_REDIRECT_URL = "/appointments/live/frontdesk/"
 LOGOUT_REDIRECT_URL = "/login/"
+
+# Staff roles are cached per user; saving a user or profile clears the entry.
+ROLE_CACHE_SECONDS = int(os.getenv("ROLE_CACHE_SECONDS", "300"))
@@ -29,5 +29,11 @@ urlpatterns = [
         appointment_views.api_today_appointments,
         name="api-appointments-today",
     ),
+    path("sse/flow/", appointment_views.flow_stream, name="flow-stream"),
+    path(
+        "api/flow/stats/",
+        appointment_views.api_flow_stats,
+        name="api-flow-stats",
+    ),
     path("api/logs/", account_views.api_logs, name="api-logs"),
 ]